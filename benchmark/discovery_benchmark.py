@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Wall time of inventory-subs discovering every tenant's subscriptions one tenant at a time (TENANT_DISCOVERY_THREADS=1,
+how it used to walk the tenants) against the bounded worker pool. The fake SubscriptionClient and credentials sleep
+--list-latency and --token-latency seconds per call, and moto stands in for AWS.
+
+    pip install -r lambda-layer/azure-requirements.txt -r benchmark/requirements.txt
+    python3 benchmark/discovery_benchmark.py --tenants 12 --subscriptions 50 --token-latency 0.3 --list-latency 0.5
+"""
+import os
+import time
+import argparse
+
+from moto import mock_aws
+
+from fakes import FakeEstate, FakeLatency, ApiCounter, configure_fakes
+from end_to_end import ENVIRONMENT, FakeContext, create_aws_resources, load_handler, patch_azure
+
+
+def run(threads, estate):
+    """Returns (discovery seconds, handler seconds, subscriptions found) for one run of the inventory-subs handler"""
+    with mock_aws():
+        create_aws_resources(estate)
+        inventory_subs = load_handler("inventory-subs.py")
+        # Fill the subscription table first, so the timed run writes nothing and mostly measures discovery
+        os.environ['TENANT_DISCOVERY_THREADS'] = "16"
+        inventory_subs.handler({}, FakeContext("benchmark-inventory-subs", 900))
+        os.environ['TENANT_DISCOVERY_THREADS'] = str(threads)
+
+        # Discovery is over once the handler moves on to the table update
+        discovered = []
+        bulk_update_subscriptions = inventory_subs.bulk_update_subscriptions
+
+        def timed_update(*update_args):
+            discovered.append(time.monotonic())
+            return bulk_update_subscriptions(*update_args)
+        inventory_subs.bulk_update_subscriptions = timed_update
+
+        started = time.monotonic()
+        event = inventory_subs.handler({}, FakeContext("benchmark-inventory-subs", 900))
+        return discovered[0] - started, time.monotonic() - started, len(event['subscription_list'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sequential and concurrent tenant subscription discovery")
+    parser.add_argument("--tenants", type=int, default=12)
+    parser.add_argument("--subscriptions", type=int, default=50, help="Subscriptions per tenant")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--token-latency", type=float, default=0.3, help="Seconds per AAD token request")
+    parser.add_argument("--list-latency", type=float, default=0.5, help="Seconds per subscription list call")
+    args = parser.parse_args()
+
+    os.environ.update(ENVIRONMENT)
+    patch_azure()
+    estate = FakeEstate(tenants=args.tenants, subscriptions_per_tenant=args.subscriptions, vms_per_subscription=0)
+    configure_fakes(estate, FakeLatency(token=args.token_latency, subscription_list=args.list_latency), ApiCounter())
+
+    print("{} tenants of {} subscriptions, {:.1f}s token and {:.1f}s list latency\n".format(
+        args.tenants, args.subscriptions, args.token_latency, args.list_latency))
+    print("{:<12} {:>8} {:>12} {:>10} {:>14}".format("discovery", "threads", "discovery s", "handler s", "subscriptions"))
+    for name, threads in (("sequential", 1), ("concurrent", args.threads)):
+        discovery, seconds, found = run(threads, estate)
+        print("{:<12} {:>8} {:>12.2f} {:>10.2f} {:>14}".format(name, threads, discovery, seconds, found))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Run the whole inventory in one process, offline: inventory-subs, trigger_sub_actions, inventory-vm for every dispatched
+group (and any continuations), check-run-status and report-subs. AWS is moto and Azure is the fakes in fakes.py,
+serving a synthetic estate of configurable size with injected latency and throttling.
+Reports wall time, API calls and peak traced memory for each stage.
+
+    pip install -r lambda-layer/azure-requirements.txt -r benchmark/requirements.txt
+    python3 benchmark/end_to_end.py --tenants 2 --subscriptions 20 --vms 200 --nics 2 --query-latency 0.05
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import importlib
+import importlib.util
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+sys.path.insert(0, LAMBDA_DIR)
+
+import boto3
+from moto import mock_aws
+
+from fakes import (FakeEstate, FakeLatency, ApiCounter, FakeServicePrincipalCredentials, FakeSubscriptionClient,
+                   FakeResourceGraphClient, FakeCostManagementClient, configure_fakes)
+
+
+REGION = "us-east-1"
+ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': REGION,
+    'AWS_ACCESS_KEY_ID': "benchmark",
+    'AWS_SECRET_ACCESS_KEY': "benchmark",
+    'INVENTORY_BUCKET': "benchmark-inventory",
+    'SUBSCRIPTION_TABLE': "benchmark-subscriptions",
+    'RUN_TABLE': "benchmark-runs",
+    'AZURE_SECRET_NAME': "benchmark-azure-secret",
+    'METRICS_ENABLED': "False",
+}
+
+
+class FakeContext(object):
+    """The parts of the lambda context the handlers use"""
+    def __init__(self, function_name, timeout):
+        self.function_name = function_name
+        self.aws_request_id = "benchmark"
+        self.log_group_name = "/aws/lambda/" + function_name
+        self.log_stream_name = "benchmark"
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def load_handler(filename):
+    """Import a lambda module by file name, several have a - in their name"""
+    spec = importlib.util.spec_from_file_location(filename.replace('-', '_')[:-3], os.path.join(LAMBDA_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def patch_azure():
+    """
+    Swap the Azure SDK classes for the fakes. The lambdas import SDK classes when they first use them,
+    see subscription.load_sdk_class(), so replacing them on the SDK modules is enough.
+    """
+    replacements = {
+        ('msrestazure.azure_active_directory', 'ServicePrincipalCredentials'): FakeServicePrincipalCredentials,
+        ('azure.mgmt.subscription', 'SubscriptionClient'): FakeSubscriptionClient,
+        ('azure.mgmt.resourcegraph', 'ResourceGraphClient'): FakeResourceGraphClient,
+        ('azure.mgmt.costmanagement', 'CostManagementClient'): FakeCostManagementClient,
+    }
+    for (module_name, class_name), fake in replacements.items():
+        setattr(importlib.import_module(module_name), class_name, fake)
+
+
+class StageRecorder(object):
+    """Times each stage and counts its AWS calls (from botocore events) and Azure calls (from the fakes)"""
+    def __init__(self, azure_counter, trace_memory=True):
+        self.azure_counter = azure_counter
+        self.aws_counter = ApiCounter()
+        self.trace_memory = trace_memory
+        self.stages = []
+        boto3.DEFAULT_SESSION.events.register('before-call', self._count_aws_call)
+
+    def _count_aws_call(self, model, **kwargs):
+        self.aws_counter.add("{}.{}".format(model.service_model.service_name, model.name))
+
+    def run(self, name, func, *args):
+        self.aws_counter.reset()
+        self.azure_counter.reset()
+        if self.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            peak = None
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.stages.append({
+                'stage': name,
+                'seconds': elapsed,
+                'aws_calls': self.aws_counter.reset(),
+                'azure_calls': self.azure_counter.reset(),
+                'peak_bytes': peak,
+            })
+
+    def report(self):
+        print("{:<18} {:>9} {:>10} {:>11} {:>10}".format("stage", "seconds", "aws calls", "azure calls", "peak MiB"))
+        for s in self.stages:
+            peak = "{:.1f}".format(s['peak_bytes'] / 1048576.0) if s['peak_bytes'] is not None else "-"
+            print("{:<18} {:>9.2f} {:>10} {:>11} {:>10}".format(s['stage'], s['seconds'], sum(s['aws_calls'].values()), sum(s['azure_calls'].values()), peak))
+        print("{:<18} {:>9.2f}".format("total", sum(s['seconds'] for s in self.stages)))
+
+
+def create_aws_resources(estate):
+    """The tables, bucket, topic, queues and secret the stack would create"""
+    dynamodb = boto3.client('dynamodb')
+    for table_name, key in ((os.environ['SUBSCRIPTION_TABLE'], "subscription_id"), (os.environ['RUN_TABLE'], "run_id")):
+        dynamodb.create_table(
+            TableName=table_name,
+            BillingMode="PAY_PER_REQUEST",
+            AttributeDefinitions=[{'AttributeName': key, 'AttributeType': "S"}],
+            KeySchema=[{'AttributeName': key, 'KeyType': "HASH"}],
+        )
+
+    boto3.client('s3').create_bucket(Bucket=os.environ['INVENTORY_BUCKET'])
+    boto3.client('secretsmanager').create_secret(Name=os.environ['AZURE_SECRET_NAME'], SecretString=json.dumps(estate.secret()))
+
+    sqs = boto3.client('sqs')
+    os.environ['ERROR_QUEUE'] = sqs.create_queue(QueueName="benchmark-errors")['QueueUrl']
+    os.environ['DISPATCH_QUEUE_URL'] = sqs.create_queue(QueueName="benchmark-dispatch", Attributes={'VisibilityTimeout': "900"})['QueueUrl']
+    os.environ['TRIGGER_ACCOUNT_INVENTORY_ARN'] = boto3.client('sns').create_topic(Name="benchmark-trigger")['TopicArn']
+
+
+def drain_dispatch_queue(inventory_vm, timeout):
+    """Invoke inventory-vm for every message on the dispatch queue, the way the SQS event source would, until it is empty"""
+    # A separate session, so the harness's own queue calls are not counted against the stage
+    sqs = boto3.session.Session().client('sqs', region_name=REGION)
+    queue_url = os.environ['DISPATCH_QUEUE_URL']
+    invocations = 0
+
+    while True:
+        messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages', [])
+        if not messages:
+            attributes = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=["ApproximateNumberOfMessagesDelayed"])['Attributes']
+            if int(attributes['ApproximateNumberOfMessagesDelayed']) == 0:
+                return invocations
+            time.sleep(0.5)
+            continue
+
+        for message in messages:
+            event = {'Records': [{'eventSource': "aws:sqs", 'messageId': message['MessageId'], 'body': message['Body']}]}
+            inventory_vm.lambda_handler(event, FakeContext("benchmark-inventory-vm", timeout))
+            sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+            invocations += 1
+
+
+def run_benchmark(args):
+    os.environ.update(ENVIRONMENT)
+    os.environ.update({
+        'NUM_SUBS_IN_GROUP': str(args.group_size),
+        'SNS_DELAY': "0",
+        'GRAPH_QUERY_BASE_DELAY': "0.05",
+        'OUTPUT_FORMAT': args.output_format,
+        'PIPELINE_MODE': args.pipeline_mode,
+    })
+
+    estate = FakeEstate(args.tenants, args.subscriptions, args.vms, args.nics)
+    latency = FakeLatency(query=args.query_latency, token=args.token_latency, subscription_list=args.query_latency,
+                          cost=args.query_latency, throttle_every=args.throttle_every, retry_after=args.retry_after)
+    azure_counter = ApiCounter()
+    configure_fakes(estate, latency, azure_counter)
+
+    with mock_aws():
+        boto3.setup_default_session(region_name=REGION)
+        create_aws_resources(estate)
+
+        inventory_subs = load_handler("inventory-subs.py")
+        trigger = load_handler("trigger_sub_actions.py")
+        inventory_vm = load_handler("inventory-vm.py")
+        report_subs = load_handler("report-subs.py")
+
+        import retry_policy
+        patch_azure()
+
+        # Without --quota queries are not held to the Resource Graph rate limit, so only the injected latency is measured
+        if not args.quota:
+            for tenant in estate.tenants.values():
+                retry_policy.tenant_buckets[tenant['tenant_id']] = retry_policy.TokenBucket(capacity=10 ** 9, window=1)
+
+        recorder = StageRecorder(azure_counter, trace_memory=not args.no_trace_memory)
+        event = recorder.run("inventory-subs", inventory_subs.handler, {}, FakeContext("benchmark-inventory-subs", args.lambda_timeout))
+        event = recorder.run("trigger", trigger.handler, event, FakeContext("benchmark-trigger", args.lambda_timeout))
+        invocations = recorder.run("inventory-vm", drain_dispatch_queue, inventory_vm, args.lambda_timeout)
+        event = recorder.run("check-run-status", trigger.check_run_status, event, FakeContext("benchmark-check-run-status", args.lambda_timeout))
+        recorder.run("report-subs", report_subs.handler, event, FakeContext("benchmark-report-subs", args.lambda_timeout))
+
+        errors = int(boto3.client('sqs').get_queue_attributes(QueueUrl=os.environ['ERROR_QUEUE'], AttributeNames=["ApproximateNumberOfMessages"])['Attributes']['ApproximateNumberOfMessages'])
+
+    print("Estate: {} tenant(s), {} subscription(s), {} virtual machines with {} network interface(s) each".format(
+        args.tenants, args.tenants * args.subscriptions, estate.resource_count, args.nics))
+    print("inventory-vm invocations: {}, run complete: {}, captured errors: {}\n".format(invocations, event.get('run_complete'), errors))
+    recorder.report()
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(recorder.stages, fh, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run every inventory handler offline against a synthetic Azure estate")
+    parser.add_argument("--tenants", type=int, default=2)
+    parser.add_argument("--subscriptions", type=int, default=10, help="Subscriptions per tenant")
+    parser.add_argument("--vms", type=int, default=100, help="Virtual machines per subscription")
+    parser.add_argument("--nics", type=int, default=1, help="Network interfaces per virtual machine")
+    parser.add_argument("--group-size", type=int, default=10, help="NUM_SUBS_IN_GROUP")
+    parser.add_argument("--query-latency", type=float, default=0.05, help="Seconds per Azure API call")
+    parser.add_argument("--token-latency", type=float, default=0.1, help="Seconds per AAD token request")
+    parser.add_argument("--throttle-every", type=int, default=0, help="Fail every Nth resource graph query with a 429, 0 never does")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="Retry-After seconds sent with the 429s")
+    parser.add_argument("--quota", action="store_true", help="Hold queries to the Resource Graph tenant rate limit")
+    parser.add_argument("--output-format", choices=["object", "ndjson"], default="object")
+    parser.add_argument("--pipeline-mode", choices=["sync", "async"], default="sync")
+    parser.add_argument("--lambda-timeout", type=int, default=900, help="Seconds each simulated invocation gets")
+    parser.add_argument("--no-trace-memory", action="store_true", help="Skip tracemalloc, which slows the stages down")
+    parser.add_argument("--json", help="Also write the per stage results to this file")
+    run_benchmark(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
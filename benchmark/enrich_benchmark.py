@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Resource Graph calls and wall time of the virtual machine network interface lookup, one query per virtual machine
+(how inventory-vm used to do it) against one query per batch of ENRICH_BATCH_SIZE virtual machines, for 10, 1,000 and
+10,000 virtual machines. The ResourceGraphClient is the stub in fakes.py, sleeping --query-latency seconds per call.
+Needs the lambda layer requirements installed (pip install -r lambda-layer/azure-requirements.txt)
+
+    python3 benchmark/enrich_benchmark.py --vms 10 1000 10000 --query-latency 0.002
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+os.environ.setdefault('METRICS_ENABLED', "False")
+
+import retry_policy
+from common import divide_into_batches
+from collectors import get_vm_network_interfaces
+from fakes import FakeEstate, FakeLatency, FakeResourceGraphClient, ApiCounter, configure_fakes, estate_subscriptions
+
+
+def run(vms, batch_size, args):
+    """Returns (resource graph calls, seconds, virtual machines with network interfaces) for one lookup of every vm"""
+    estate = FakeEstate(tenants=1, subscriptions_per_tenant=1, vms_per_subscription=vms, nics_per_vm=args.nics)
+    configure_fakes(estate, FakeLatency(query=args.query_latency), ApiCounter())
+    subscriptions = estate_subscriptions(estate)
+    rows = estate.vm_rows(subscriptions[0].subscription_id)
+
+    # Only the injected latency is measured, not the Resource Graph rate limit
+    retry_policy.tenant_buckets[subscriptions[0].tenant_id] = retry_policy.TokenBucket(capacity=10 ** 9, window=1)
+
+    graph_client = FakeResourceGraphClient()
+    found = {}
+    started = time.monotonic()
+    for batch in divide_into_batches(rows, batch_size):
+        found.update(get_vm_network_interfaces(subscriptions, batch, graph_client))
+    return graph_client.queries, time.monotonic() - started, len(found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the batched virtual machine network interface lookup")
+    parser.add_argument("--vms", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--nics", type=int, default=1, help="Network interfaces per virtual machine")
+    parser.add_argument("--batch-size", type=int, default=int(os.environ.get('ENRICH_BATCH_SIZE', 100)))
+    parser.add_argument("--query-latency", type=float, default=0.002, help="Seconds per resource graph query")
+    args = parser.parse_args()
+
+    print("{:>8} {:<12} {:>8} {:>9} {:>10}".format("vms", "lookup", "queries", "seconds", "vms found"))
+    for vms in args.vms:
+        for name, batch_size in (("per vm", 1), ("batched", args.batch_size)):
+            queries, seconds, found = run(vms, batch_size, args)
+            print("{:>8} {:<12} {:>8} {:>9.2f} {:>10}".format(vms, name, queries, seconds, found))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+Stand-ins for the Azure SDK clients the lambdas use, serving a synthetic estate with injectable latency and throttling.
+Used by the benchmarks in this directory, they are never packaged with the lambdas.
+"""
+import re
+import time
+import threading
+
+
+class FakeEstate(object):
+    """
+    A synthetic Azure estate: tenants, each with subscriptions, each with virtual machines that have network interfaces.
+    Rows are only built when a subscription is first queried.
+    """
+    def __init__(self, tenants=2, subscriptions_per_tenant=10, vms_per_subscription=100, nics_per_vm=1):
+        self.vms_per_subscription = vms_per_subscription
+        self.nics_per_vm = nics_per_vm
+        self.tenants = {}
+        for t in range(tenants):
+            tenant_id = "10000000-0000-0000-0000-{:012d}".format(t)
+            self.tenants["tenant{}".format(t)] = {
+                'tenant_id': tenant_id,
+                'subscriptions': ["20000000-{:04d}-0000-0000-{:012d}".format(t, s) for s in range(subscriptions_per_tenant)]
+            }
+        self.rows = {}
+        self.lock = threading.Lock()
+
+    @property
+    def resource_count(self):
+        return sum(len(t['subscriptions']) for t in self.tenants.values()) * self.vms_per_subscription
+
+    def secret(self):
+        """The Secrets Manager value holding a service principal for each tenant"""
+        return {name: {'application_id': "app-" + name, 'key': "key-" + name, 'tenant_id': tenant['tenant_id']} for name, tenant in self.tenants.items()}
+
+    def tenant_subscriptions(self, tenant_id):
+        for tenant in self.tenants.values():
+            if tenant['tenant_id'] == tenant_id:
+                return tenant['subscriptions']
+        return []
+
+    def vm_rows(self, subscription_id):
+        with self.lock:
+            if subscription_id not in self.rows:
+                self.rows[subscription_id] = [{
+                    'id': "/subscriptions/{}/resourceGroups/rg{}/providers/Microsoft.Compute/virtualMachines/vm{}".format(subscription_id, v % 10, v),
+                    'name': "vm{}".format(v),
+                    'type': "microsoft.compute/virtualmachines",
+                    'location': "eastus",
+                    'resourceGroup': "rg{}".format(v % 10),
+                    'subscriptionId': subscription_id,
+                    'tags': {'environment': "benchmark"},
+                    'properties': {
+                        'vmId': "{}-{:08d}".format(subscription_id[9:], v),
+                        'hardwareProfile': {'vmSize': "Standard_D2s_v3"},
+                        'networkProfile': {'networkInterfaces': [{'id': "nic{}-{}".format(v, n)} for n in range(self.nics_per_vm)]}
+                    }
+                } for v in range(self.vms_per_subscription)]
+            return self.rows[subscription_id]
+
+
+class ApiCounter(object):
+    """Thread safe call counter shared by the fakes, keyed by API name"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def add(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            calls = self.calls
+            self.calls = {}
+        return calls
+
+
+class FakeHttpError(Exception):
+    """Looks like an msrest error with an HTTP response, which is what retry_policy.classify_error() inspects"""
+    def __init__(self, status_code, headers=None):
+        super(FakeHttpError, self).__init__("Fake HTTP {}".format(status_code))
+        self.status_code = status_code
+        self.response = type('Response', (), {'status_code': status_code, 'headers': headers or {}})()
+
+
+class FakeLatency(object):
+    """Latency and throttling settings shared by every fake client"""
+    def __init__(self, query=0.0, token=0.0, subscription_list=0.0, cost=0.0, throttle_every=0, retry_after=0.1):
+        self.query = query
+        self.token = token
+        self.subscription_list = subscription_list
+        self.cost = cost
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+
+
+class FakeSubscription(object):
+    """The parts of an AntiopeAzureSubscription the collectors and graph queries use"""
+    def __init__(self, subscription_id, tenant_name, tenant_id):
+        self.subscription_id = subscription_id
+        self.display_name = "benchmark-{}".format(subscription_id[-6:])
+        self.tenant_id = tenant_id
+        self.tenant_name = tenant_name
+
+
+class FakeQueryResponse(object):
+    def __init__(self, data, skip_token):
+        self.data = data
+        self.skip_token = skip_token
+
+
+class FakeHttpResponse(object):
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+
+class FakeResponse(object):
+    """
+    Looks enough like the msrest raw response for common.send_graph_query(). Plain classes rather than type(),
+    so a page's rows are freed as soon as it is dropped instead of waiting for the cycle collector.
+    """
+    def __init__(self, data, skip_token):
+        self.output = FakeQueryResponse(data, skip_token)
+        self.response = FakeHttpResponse()
+
+
+class FakeServicePrincipalCredentials(object):
+    """Replaces msrestazure's ServicePrincipalCredentials, which requests an AAD token when it is created"""
+    estate = None
+    latency = FakeLatency()
+    counter = ApiCounter()
+
+    def __init__(self, client_id=None, secret=None, tenant=None, **kwargs):
+        self.counter.add("aad.token")
+        time.sleep(self.latency.token)
+        self.tenant = tenant
+        self.token = {'access_token': "fake", 'expires_on': time.time() + 3600}
+
+
+class FakeSubscriptionClient(object):
+    """Replaces azure.mgmt.subscription.SubscriptionClient, listing the tenant's subscriptions from the estate"""
+    estate = None
+    latency = FakeLatency()
+    counter = ApiCounter()
+
+    def __init__(self, credentials, *args, **kwargs):
+        self.credentials = credentials
+        self.subscriptions = self
+
+    def list(self):
+        self.counter.add("subscription.list")
+        time.sleep(self.latency.subscription_list)
+        for n, subscription_id in enumerate(self.estate.tenant_subscriptions(self.credentials.tenant)):
+            yield FakeSubscriptionModel(subscription_id, "benchmark-{}".format(subscription_id[-6:]), "Enabled")
+
+
+class FakeSubscriptionModel(object):
+    """The parts of azure.mgmt.subscription.models.Subscription inventory-subs uses, serialized through _attribute_map like the msrest model"""
+    _attribute_map = {
+        'id': {'key': 'id', 'type': 'str'},
+        'subscription_id': {'key': 'subscriptionId', 'type': 'str'},
+        'display_name': {'key': 'displayName', 'type': 'str'},
+        'state': {'key': 'state', 'type': 'str'},
+    }
+
+    def __init__(self, subscription_id, display_name, state):
+        self.id = "/subscriptions/{}".format(subscription_id)
+        self.subscription_id = subscription_id
+        self.display_name = display_name
+        self.state = state
+
+
+class FakeResourceGraphClient(object):
+    """
+    Replaces azure.mgmt.resourcegraph.ResourceGraphClient, answering the collectors' resource query and the
+    network interface join from the estate. Every throttle_every'th query fails with a 429 and a Retry-After.
+    """
+    estate = None
+    latency = FakeLatency()
+    counter = ApiCounter()
+
+    def __init__(self, credentials=None, *args, **kwargs):
+        self.lock = threading.Lock()
+        self.queries = 0
+
+    def resources(self, query, raw=False):
+        with self.lock:
+            self.queries += 1
+            throttled = self.latency.throttle_every and self.queries % self.latency.throttle_every == 0
+
+        time.sleep(self.latency.query)
+        if throttled:
+            self.counter.add("resourcegraph.throttled")
+            raise FakeHttpError(429, {'Retry-After': str(self.latency.retry_after)})
+
+        # The network interface join for a batch of virtual machines
+        if "mvexpand" in query.query:
+            self.counter.add("resourcegraph.enrich")
+            rows = []
+            for vm_id in re.findall(r"'(/subscriptions/[^']+)'", query.query):
+                for n in range(self.estate.nics_per_vm):
+                    rows.append({'vmResourceId': vm_id.lower(), 'nicId': "{}-nic{}".format(vm_id, n), 'privateNetworkInterfaceName': "nic{}".format(n),
+                                 'privateNetworkProperties': {'ipConfigurations': [{'properties': {'privateIPAddress': "10.0.0.{}".format(n + 4)}}]}})
+            return FakeResponse(rows, None)
+
+        self.counter.add("resourcegraph.query")
+        rows = []
+        for subscription_id in query.subscriptions:
+            rows.extend(self.estate.vm_rows(subscription_id))
+        start = int(query.options.skip_token or 0)
+        end = start + query.options.top
+        return FakeResponse(rows[start:end], str(end) if end < len(rows) else None)
+
+
+class FakeCostManagementClient(object):
+    """Replaces azure.mgmt.costmanagement.CostManagementClient with a fixed month to date cost"""
+    latency = FakeLatency()
+    counter = ApiCounter()
+
+    def __init__(self, credentials, subscription_id, base_url=None):
+        self.query = self
+
+    def usage(self, scope, parameters):
+        self.counter.add("costmanagement.query")
+        time.sleep(self.latency.cost)
+        columns = [type('Column', (), {'name': name})() for name in ("totalCost", "Currency")]
+        return type('QueryResult', (), {'rows': [[123.45, "USD"]], 'columns': columns})()
+
+
+class FakeS3Client(object):
+    """Just enough of the S3 client for put_object, sleeping latency seconds per call"""
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.puts = 0
+        self.bytes = 0
+
+    def put_object(self, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            self.puts += 1
+            self.bytes += len(kwargs.get('Body') or b"")
+        return {}
+
+
+def estate_subscriptions(estate):
+    """A FakeSubscription for every subscription in the estate"""
+    return [FakeSubscription(subscription_id, tenant_name, tenant['tenant_id'])
+            for tenant_name, tenant in estate.tenants.items() for subscription_id in tenant['subscriptions']]
+
+
+def configure_fakes(estate, latency, counter):
+    """Point every fake at the same estate, latency settings and call counter"""
+    for fake in (FakeServicePrincipalCredentials, FakeSubscriptionClient, FakeResourceGraphClient, FakeCostManagementClient):
+        fake.estate = estate
+        fake.latency = latency
+        fake.counter = counter
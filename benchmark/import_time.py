@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Cold start import cost of each lambda handler. Every handler is imported in a fresh interpreter with -X importtime
+and the report adds up the time spent importing, and how much of it went to the Azure SDK.
+
+    python3 benchmark/import_time.py [--repeat 5]
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+LAMBDA_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+
+HANDLERS = [
+    "inventory-subs.py",
+    "trigger_sub_actions.py",
+    "inventory-vm.py",
+    "report-subs.py",
+    "export-parquet.py",
+    "sub_handler.py",
+]
+
+# Loads the handler the way the lambda runtime does, by file, with the lambda directory on the path
+LOADER = """
+import sys, importlib.util
+sys.path.insert(0, {lambda_dir!r})
+spec = importlib.util.spec_from_file_location("handler", {path!r})
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+"""
+
+AZURE_PACKAGES = ("azure", "msrest", "msrestazure", "adal")
+
+
+def measure(handler):
+    """Returns (total import microseconds, Azure SDK import microseconds, Azure modules imported), or None if the import failed"""
+    code = LOADER.format(lambda_dir=LAMBDA_DIR, path=os.path.join(LAMBDA_DIR, handler))
+    env = dict(os.environ, AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', "us-east-1"))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, cwd=LAMBDA_DIR, env=env)
+    if result.returncode != 0:
+        return None
+
+    total = azure = modules = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        total += int(self_us)
+        if name.split(".")[0] in AZURE_PACKAGES:
+            azure += int(self_us)
+            modules += 1
+    return total, azure, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of each lambda handler")
+    parser.add_argument("--repeat", type=int, default=5, help="Imports per handler, the fastest is reported")
+    args = parser.parse_args()
+
+    print("{:<24} {:>10} {:>10} {:>14}".format("handler", "total ms", "azure ms", "azure modules"))
+    for handler in HANDLERS:
+        runs = [measure(handler) for i in range(args.repeat)]
+        runs = [r for r in runs if r is not None]
+        if not runs:
+            print("{:<24} {:>10}".format(handler, "failed"))
+            continue
+        total, azure, modules = min(runs)
+        print("{:<24} {:>10.1f} {:>10.1f} {:>14}".format(handler, total / 1000.0, azure / 1000.0, modules))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Scan time of the raw JSON inventory (one object per resource under Azure-Resources/) against the Parquet export
+(Azure-Parquet/, partitioned by tenant and resource type), for a query that counts virtual machines by region.
+S3 is moto, with --get-latency seconds added to every GetObject to stand in for the round trip to S3.
+Needs both lambda layers' requirements and requirements.txt installed.
+
+    python3 benchmark/parquet_benchmark.py --subscriptions 10 --vms 1000 --get-latency 0.01
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+os.environ.update({'AWS_DEFAULT_REGION': "us-east-1", 'AWS_ACCESS_KEY_ID': "benchmark", 'AWS_SECRET_ACCESS_KEY': "benchmark",
+                   'INVENTORY_BUCKET': "benchmark-inventory", 'METRICS_ENABLED': "False"})
+
+import boto3
+import pyarrow.parquet as pq
+from moto import mock_aws
+
+import common
+from collectors import COLLECTORS
+from fakes import FakeEstate, estate_subscriptions
+from end_to_end import load_handler
+
+
+def save_inventory(tenants, subscriptions, vms):
+    """Save the estate's virtual machines one object per resource, as inventory-vm does by default"""
+    estate = FakeEstate(tenants=tenants, subscriptions_per_tenant=subscriptions, vms_per_subscription=vms, nics_per_vm=2)
+    collector = COLLECTORS["microsoft.compute/virtualmachines"]
+    with common.ResourceWriter() as writer:
+        for target_sub in estate_subscriptions(estate):
+            for row in estate.vm_rows(target_sub.subscription_id):
+                resource_item = collector.build_resource_item(target_sub, row, {})
+                writer.write(collector.prefix, resource_item['resourceId'], resource_item)
+        writer.flush()
+
+
+def list_keys(s3_client, prefix, suffix):
+    keys = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=os.environ['INVENTORY_BUCKET'], Prefix=prefix):
+        keys.extend((o['Key'], o['Size']) for o in page.get('Contents', []) if o['Key'].endswith(suffix))
+    return keys
+
+
+def scan_json(s3_client, threads):
+    """Count vms by region from the raw json objects. Returns (counts, objects read, bytes read)"""
+    keys = list_keys(s3_client, "Azure-Resources/vm/instance/", ".json")
+
+    def fetch(key):
+        return json.loads(s3_client.get_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=key)['Body'].read())
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        counts = Counter(record['azureRegion'] for record in executor.map(fetch, [k for k, size in keys]))
+    return counts, len(keys), sum(size for k, size in keys)
+
+
+def scan_parquet(s3_client, threads):
+    """Count vms by region from the Parquet export, reading only the region column. Returns (counts, objects read, bytes read)"""
+    keys = list_keys(s3_client, "Azure-Parquet/", "resource_type=Azure_Compute_VM/part-0000.parquet")
+
+    def fetch(key):
+        body = s3_client.get_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=key)['Body'].read()
+        return pq.read_table(io.BytesIO(body), columns=['azureRegion']).column('azureRegion').to_pylist()
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        counts = Counter(region for regions in executor.map(fetch, [k for k, size in keys]) for region in regions)
+    return counts, len(keys), sum(size for k, size in keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scanning the raw json inventory against the Parquet export")
+    parser.add_argument("--tenants", type=int, default=2)
+    parser.add_argument("--subscriptions", type=int, default=5, help="Subscriptions per tenant")
+    parser.add_argument("--vms", type=int, default=1000, help="Virtual machines per subscription")
+    parser.add_argument("--threads", type=int, default=32, help="Concurrent GetObject requests for either scan")
+    parser.add_argument("--get-latency", type=float, default=0.01, help="Seconds added to every GetObject")
+    args = parser.parse_args()
+
+    with mock_aws():
+        s3_client = boto3.client('s3')
+        s3_client.create_bucket(Bucket=os.environ['INVENTORY_BUCKET'])
+        save_inventory(args.tenants, args.subscriptions, args.vms)
+
+        started = time.monotonic()
+        load_handler("export-parquet.py").handler({'run_date': "benchmark"}, None)
+        export_seconds = time.monotonic() - started
+
+        s3_client.meta.events.register('before-call.s3.GetObject', lambda **kwargs: time.sleep(args.get_latency))
+        print("{} virtual machines, export took {:.2f}s, {:.0f}ms per GetObject\n".format(
+            args.tenants * args.subscriptions * args.vms, export_seconds, args.get_latency * 1000))
+        print("{:<10} {:>9} {:>9} {:>9}".format("layout", "objects", "MiB", "seconds"))
+        results = []
+        for name, scan in (("json", scan_json), ("parquet", scan_parquet)):
+            started = time.monotonic()
+            counts, objects, size = scan(s3_client, args.threads)
+            print("{:<10} {:>9} {:>9.2f} {:>9.2f}".format(name, objects, size / 1048576.0, time.monotonic() - started))
+            results.append(counts)
+        assert results[0] == results[1], "the scans disagree"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Compare the sync collector loop with the async pipeline, offline, against fake Resource Graph and S3 clients that
+sleep to simulate network latency. Needs the lambda layer requirements installed (pip install -r lambda-layer/azure-requirements.txt)
+
+    python3 benchmark/pipeline_benchmark.py --resources 5000 --query-latency 0.3 --put-latency 0.02
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+os.environ.setdefault('INVENTORY_BUCKET', "benchmark-bucket")
+
+import common
+import retry_policy
+from collectors import run_collectors
+from pipeline import run_collectors_async
+from fakes import FakeEstate, FakeLatency, FakeResourceGraphClient, FakeS3Client, ApiCounter, configure_fakes, estate_subscriptions
+
+
+def run(engine, args):
+    estate = FakeEstate(tenants=1, subscriptions_per_tenant=args.subscriptions, vms_per_subscription=args.resources // args.subscriptions)
+    configure_fakes(estate, FakeLatency(query=args.query_latency), ApiCounter())
+    tenant = list(estate.tenants.values())[0]
+    subscriptions = estate_subscriptions(estate)
+
+    graph_client = FakeResourceGraphClient()
+    common._s3_client = FakeS3Client(args.put_latency)
+
+    # Without --quota queries are not held to the Resource Graph rate limit, so only latency is measured
+    if not args.quota:
+        retry_policy.tenant_buckets[tenant['tenant_id']] = retry_policy.TokenBucket(capacity=10 ** 9, window=1)
+
+    writer = common.ResourceWriter()
+    started = time.monotonic()
+    result = engine(subscriptions, graph_client, writer)
+    failures = writer.close()
+    elapsed = time.monotonic() - started
+
+    return {
+        'resources': sum(result.resource_counts.values()),
+        'queries': graph_client.queries,
+        'puts': common._s3_client.puts,
+        'failures': len(failures),
+        'seconds': elapsed,
+        'per_second': sum(result.resource_counts.values()) / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sync and async collector engines against latency injected fakes")
+    parser.add_argument("--resources", type=int, default=5000, help="Resources to inventory")
+    parser.add_argument("--subscriptions", type=int, default=5, help="Subscriptions the resources are spread over")
+    parser.add_argument("--query-latency", type=float, default=0.3, help="Seconds per resource graph query")
+    parser.add_argument("--put-latency", type=float, default=0.02, help="Seconds per S3 put")
+    parser.add_argument("--quota", action="store_true", help="Hold queries to the Resource Graph tenant rate limit")
+    args = parser.parse_args()
+
+    os.environ.setdefault('GRAPH_QUERY_PAGE_SIZE', "1000")
+
+    print("{:<8} {:>10} {:>8} {:>8} {:>9} {:>12}".format("engine", "resources", "queries", "puts", "seconds", "resources/s"))
+    for name, engine in (("sync", run_collectors), ("async", run_collectors_async)):
+        r = run(engine, args)
+        print("{:<8} {:>10} {:>8} {:>8} {:>9.2f} {:>12.1f}".format(name, r['resources'], r['queries'], r['puts'], r['seconds'], r['per_second']))
+        if r['failures']:
+            print("  {} writes failed".format(r['failures']))
+
+
+if __name__ == "__main__":
+    main()
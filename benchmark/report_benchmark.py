@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Render the subscription report for a synthetic list of subscriptions, 10,000 by default, comparing compiling the
+template on every run (what report-subs used to do) with the cached template in lambda/reports.py, and the single
+page with the per tenant reports. Uploads go to moto, so nothing talks to AWS. Needs the lambda layer requirements
+and requirements.txt installed.
+
+    python3 benchmark/report_benchmark.py --subscriptions 10000 --tenants 20
+"""
+import os
+import sys
+import time
+import datetime
+import argparse
+import tracemalloc
+import importlib.util
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+sys.path.insert(0, LAMBDA_DIR)
+os.environ.update({'AWS_DEFAULT_REGION': "us-east-1", 'AWS_ACCESS_KEY_ID': "benchmark", 'AWS_SECRET_ACCESS_KEY': "benchmark",
+                   'INVENTORY_BUCKET': "benchmark-reports", 'METRICS_ENABLED': "False"})
+
+import boto3
+from moto import mock_aws
+from mako.template import Template
+
+import reports
+
+
+class NullWriter(object):
+    """Counts what is rendered into it and throws it away"""
+    def __init__(self):
+        self.characters = 0
+
+    def write(self, text):
+        self.characters += len(text)
+
+
+def report_data(subscriptions, tenants):
+    """The json_data report-subs renders, with subscription records shaped like the subscription table's"""
+    records = [{
+        'subscription_id': "20000000-{:04d}-0000-0000-{:012d}".format(n % tenants, n),
+        'display_name': "subscription-{:05d}".format(n),
+        'tenant_name': "tenant{:02d}".format(n % tenants),
+        'tenant_id': "10000000-0000-0000-0000-{:012d}".format(n % tenants),
+        'subscription_state': "Enabled",
+        'queryable': "true",
+        'cost': round(n * 1.37 % 5000, 2) if n % 17 else "Unknown",
+    } for n in range(subscriptions)]
+    return {'subscriptions': records, 'timestamp': datetime.datetime.now(), 'subscription_count': subscriptions, 'bucket': os.environ['INVENTORY_BUCKET']}
+
+
+def timed(func):
+    """Seconds taken by one call"""
+    started = time.perf_counter()
+    func()
+    return time.perf_counter() - started
+
+
+def peak_memory(func):
+    """Peak traced MiB of one call. Tracing slows everything down, so this is a separate call from the timed ones"""
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1048576.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark rendering the subscription report")
+    parser.add_argument("--subscriptions", type=int, default=10000)
+    parser.add_argument("--tenants", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=3, help="Invocations to simulate, as a warm container would see them")
+    args = parser.parse_args()
+
+    data = report_data(args.subscriptions, args.tenants)
+    template_path = os.path.join(reports.TEMPLATE_DIRECTORY, "subscription_inventory.html")
+
+    def compile_and_render():
+        with open(template_path, "r") as fh:
+            return Template(fh.read()).render(**data)
+
+    def cached_render():
+        reports.get_template("subscription_inventory.html").render_context(reports.Context(NullWriter(), **data))
+
+    with mock_aws():
+        s3_client = boto3.client('s3')
+        s3_client.create_bucket(Bucket=os.environ['INVENTORY_BUCKET'])
+
+        spec = importlib.util.spec_from_file_location("report_subs", os.path.join(LAMBDA_DIR, "report-subs.py"))
+        report_subs = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(report_subs)
+
+        cases = [
+            ("compile and render", compile_and_render),
+            ("cached render", cached_render),
+            ("single page to S3", lambda: reports.render_to_s3("subscription_inventory.html", "Reports/benchmark.html", s3_client=s3_client, **data)),
+            ("per tenant pages to S3", lambda: report_subs.write_tenant_reports(data, s3_client)),
+        ]
+
+        print("{} subscriptions in {} tenants, {} runs each\n".format(args.subscriptions, args.tenants, args.runs))
+        print("{:<24} {:>10} {:>10} {:>10}".format("case", "first s", "warm s", "peak MiB"))
+        for name, func in cases:
+            runs = [timed(func) for i in range(args.runs)]
+            warm = min(runs[1:]) if len(runs) > 1 else runs[0]
+            print("{:<24} {:>10.3f} {:>10.3f} {:>10.1f}".format(name, runs[0], warm, peak_memory(func)))
+
+        single = s3_client.head_object(Bucket=os.environ['INVENTORY_BUCKET'], Key="Reports/benchmark.html")['ContentLength']
+        index = s3_client.head_object(Bucket=os.environ['INVENTORY_BUCKET'], Key="Reports/azure_subscription_inventory.html")['ContentLength']
+        print("\nsingle page {:.1f} KiB, per tenant index page {:.1f} KiB".format(single / 1024.0, index / 1024.0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of lambda/serialization.py against the json.dumps(..., default=str) calls it replaced, on a virtual
+machine resource_item shaped like the ones collectors.py builds and an Azure SDK Subscription model.
+Runs with and without orjson when it is installed. Needs the lambda layer requirements installed.
+
+    python3 benchmark/serialization_benchmark.py --iterations 20000
+"""
+import os
+import sys
+import json
+import timeit
+import datetime
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+
+import serialization
+from fakes import FakeEstate
+
+
+def vm_resource_item():
+    """A resource_item for a virtual machine with two network interfaces, like VirtualMachineCollector builds"""
+    estate = FakeEstate(tenants=1, subscriptions_per_tenant=1, vms_per_subscription=1, nics_per_vm=2)
+    subscription_id = estate.tenants["tenant0"]['subscriptions'][0]
+    row = estate.vm_rows(subscription_id)[0]
+    row['properties'].update({
+        'provisioningState': "Succeeded",
+        'osProfile': {'computerName': "vm0", 'adminUsername': "azureuser", 'linuxConfiguration': {'disablePasswordAuthentication': True}},
+        'storageProfile': {
+            'imageReference': {'publisher': "Canonical", 'offer': "UbuntuServer", 'sku': "18.04-LTS", 'version': "latest"},
+            'osDisk': {'osType': "Linux", 'name': "vm0_OsDisk_1", 'caching': "ReadWrite", 'createOption': "FromImage", 'diskSizeGB': 30,
+                       'managedDisk': {'storageAccountType': "Premium_LRS", 'id': row['id'] + "/disks/vm0_OsDisk_1"}},
+            'dataDisks': [{'lun': n, 'name': "vm0_data{}".format(n), 'diskSizeGB': 128, 'caching': "None"} for n in range(2)]
+        },
+        'diagnosticsProfile': {'bootDiagnostics': {'enabled': True, 'storageUri': "https://diag.blob.core.windows.net/"}},
+    })
+    return {
+        'azureSubscriptionId': subscription_id,
+        'azureSubscriptionName': "benchmark",
+        'azureTenantId': estate.tenants["tenant0"]['tenant_id'],
+        'azureTenantName': "tenant0",
+        'resourceType': "Microsoft.Compute/virtualMachines",
+        'source': "Antiope",
+        'configurationItemCaptureTime': str(datetime.datetime.now()),
+        'configuration': row,
+        'supplementaryConfiguration': {'networkInterfaces': [
+            {'nicId': "nic{}".format(n), 'privateNetworkInterfaceName': "nic{}".format(n), 'privateIpAddress': "10.0.0.{}".format(n + 4)} for n in range(2)
+        ]},
+        'azureRegion': row['location'],
+        'resourceId': row['properties']['vmId'],
+        'resourceCreationTime': "unknown",
+        'errors': {},
+    }
+
+
+def subscription_model():
+    """An azure.mgmt.subscription Subscription, as SubscriptionClient.subscriptions.list() returns them"""
+    from azure.mgmt.subscription.models import Subscription, SubscriptionPolicies, SubscriptionState
+    subscription = Subscription()
+    subscription.id = "/subscriptions/20000000-0000-0000-0000-000000000000"
+    subscription.subscription_id = "20000000-0000-0000-0000-000000000000"
+    subscription.display_name = "benchmark"
+    subscription.state = SubscriptionState.enabled
+    subscription.subscription_policies = SubscriptionPolicies()
+    subscription.subscription_policies.location_placement_id = "Public_2014-09-01"
+    subscription.subscription_policies.quota_id = "EnterpriseAgreement_2014-09-01"
+    subscription.subscription_policies.spending_limit = "Off"
+    return subscription
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lambda/serialization.py on realistic payloads")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    vm = vm_resource_item()
+    subscription = subscription_model()
+    encoders = [("orjson", serialization.orjson), ("json", None)] if serialization.orjson else [("json", None)]
+
+    cases = [("vm json.dumps(default=str)", lambda: json.dumps(vm, sort_keys=False, default=str, separators=(',', ':')))]
+    cases += [("vm dumps_bytes [{}]".format(name), lambda: serialization.dumps_bytes(vm), fast) for name, fast in encoders]
+    cases += [("vm content hash json", lambda: serialization.canonical_dumps(vm))]
+    cases += [("subscription json round trip", lambda: json.loads(json.dumps(subscription, default=str)))]
+    cases += [("subscription to_dynamodb", lambda: serialization.to_dynamodb(subscription))]
+    cases += [("subscription as_dict()", lambda: subscription.as_dict())]
+
+    print("{:<32} {:>12}".format("case", "us per call"))
+    for case in cases:
+        name, func = case[0], case[1]
+        if len(case) == 3:
+            serialization.orjson = case[2]
+        seconds = min(timeit.repeat(func, number=args.iterations, repeat=3))
+        print("{:<32} {:>12.2f}".format(name, seconds / args.iterations * 1000000))
+    serialization.orjson = encoders[0][1]
+
+
+if __name__ == "__main__":
+    main()
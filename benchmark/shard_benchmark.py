@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Objects, bytes and write time of saving the same resources one json object per resource (OUTPUT_FORMAT=object) and
+as ndjson shards (OUTPUT_FORMAT=ndjson) compressed with gzip and zstd. Writes go to the stub S3 client in fakes.py,
+sleeping --put-latency seconds per put. Needs the lambda layer requirements installed.
+
+    python3 benchmark/shard_benchmark.py --subscriptions 10 --vms 1000 --put-latency 0.01
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+os.environ.update({'INVENTORY_BUCKET': "benchmark-inventory", 'METRICS_ENABLED': "False"})
+
+import common
+import shards
+from collectors import COLLECTORS
+from fakes import FakeEstate, FakeS3Client, estate_subscriptions
+
+
+def resource_items(subscriptions, vms):
+    """Virtual machine resource_items for every subscription, shaped like the ones the collectors build"""
+    estate = FakeEstate(tenants=1, subscriptions_per_tenant=subscriptions, vms_per_subscription=vms, nics_per_vm=2)
+    collector = COLLECTORS["microsoft.compute/virtualmachines"]
+    return [collector.build_resource_item(target_sub, row, {})
+            for target_sub in estate_subscriptions(estate) for row in estate.vm_rows(target_sub.subscription_id)]
+
+
+def write_all(writer, items):
+    """Returns the seconds taken to write and close"""
+    started = time.monotonic()
+    for item in items:
+        writer.write("vm/instance", item['resourceId'], item)
+    failures = writer.close()
+    if failures:
+        raise Exception("{} writes failed".format(len(failures)))
+    return time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark one object per resource against ndjson shards")
+    parser.add_argument("--subscriptions", type=int, default=10)
+    parser.add_argument("--vms", type=int, default=1000, help="Virtual machines per subscription")
+    parser.add_argument("--put-latency", type=float, default=0.01, help="Seconds per put for the stub S3 client")
+    args = parser.parse_args()
+
+    items = resource_items(args.subscriptions, args.vms)
+    writers = [
+        ("object", lambda: common.ResourceWriter()),
+        ("ndjson gzip", lambda: shards.ShardedResourceWriter(compression="gzip")),
+    ]
+    if shards.zstandard is not None:
+        writers.append(("ndjson zstd", lambda: shards.ShardedResourceWriter(compression="zstd")))
+    else:
+        print("zstandard is not installed, skipping zstd shards")
+
+    print("{} resources in {} subscriptions, {:.0f}ms per put\n".format(len(items), args.subscriptions, args.put_latency * 1000))
+    print("{:<12} {:>9} {:>11} {:>9} {:>11}".format("format", "objects", "MiB", "seconds", "resources/s"))
+    for name, make_writer in writers:
+        common._s3_client = FakeS3Client(args.put_latency)
+        seconds = write_all(make_writer(), items)
+        print("{:<12} {:>9} {:>11.2f} {:>9.2f} {:>11.0f}".format(name, common._s3_client.puts, common._s3_client.bytes / 1048576.0, seconds, len(items) / seconds))
+
+
+if __name__ == "__main__":
+    main()
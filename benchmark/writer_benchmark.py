@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Save 5,000 resource_items through common.ResourceWriter, one at a time (a single thread, how inventory-vm used to
+save them) and with the pooled writer (S3_WRITER_THREADS threads). Runs against a stub S3 client sleeping --put-latency
+seconds per put, then once against moto to check every object lands. Needs benchmark/requirements.txt installed.
+
+    python3 benchmark/writer_benchmark.py --objects 5000 --put-latency 0.01
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+os.environ.update({'AWS_DEFAULT_REGION': "us-east-1", 'AWS_ACCESS_KEY_ID': "benchmark", 'AWS_SECRET_ACCESS_KEY': "benchmark",
+                   'INVENTORY_BUCKET': "benchmark-inventory", 'METRICS_ENABLED': "False"})
+
+import boto3
+from moto import mock_aws
+
+import common
+from fakes import FakeEstate, FakeS3Client, estate_subscriptions
+
+
+def resource_items(count):
+    """count virtual machine resource_items, shaped like the ones the collectors build"""
+    estate = FakeEstate(tenants=1, subscriptions_per_tenant=1, vms_per_subscription=count)
+    target_sub = estate_subscriptions(estate)[0]
+    from collectors import COLLECTORS
+    collector = COLLECTORS["microsoft.compute/virtualmachines"]
+    return [collector.build_resource_item(target_sub, row, {}) for row in estate.vm_rows(target_sub.subscription_id)]
+
+
+def save_all(items, threads):
+    """Returns (seconds, failures) to save every item with a writer of the given number of threads"""
+    started = time.monotonic()
+    with common.ResourceWriter(max_workers=threads) as writer:
+        for item in items:
+            writer.write("vm/instance", item['resourceId'], item)
+        failures = writer.flush()
+    return time.monotonic() - started, len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark saving resources to S3 one at a time and through the pooled writer")
+    parser.add_argument("--objects", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=int(os.environ.get('S3_WRITER_THREADS', 16)))
+    parser.add_argument("--put-latency", type=float, default=0.01, help="Seconds per put for the stub S3 client")
+    args = parser.parse_args()
+
+    items = resource_items(args.objects)
+
+    print("{:<8} {:<12} {:>8} {:>9} {:>9} {:>10}".format("s3", "writer", "objects", "puts", "seconds", "objects/s"))
+    for name, threads in (("single", 1), ("pooled", args.threads)):
+        common._s3_client = FakeS3Client(args.put_latency)
+        seconds, failures = save_all(items, threads)
+        print("{:<8} {:<12} {:>8} {:>9} {:>9.2f} {:>10.1f}".format("stub", name, args.objects, common._s3_client.puts, seconds, args.objects / seconds))
+
+    with mock_aws():
+        common._s3_client = None
+        s3_client = boto3.client('s3')
+        s3_client.create_bucket(Bucket=os.environ['INVENTORY_BUCKET'])
+        for name, threads in (("single", 1), ("pooled", args.threads)):
+            seconds, failures = save_all(items, threads)
+            count = sum(page['KeyCount'] for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=os.environ['INVENTORY_BUCKET']))
+            print("{:<8} {:<12} {:>8} {:>9} {:>9.2f} {:>10.1f}".format("moto", name, args.objects, count, seconds, args.objects / seconds))
+            if failures:
+                print("  {} writes failed".format(failures))
+
+
+if __name__ == "__main__":
+    main()
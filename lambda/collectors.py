@@ -0,0 +1,333 @@
+import os
+import uuid
+import logging
+import datetime
+from collections import namedtuple
+from common import graph_resource_query_pages, split_rows_by_subscription, describe_subscriptions, divide_into_batches, ResourceWriteError
+from incremental import incremental_enabled, load_manifest, content_hash, delete_marker
+from metrics import metrics
+
+
+# Setup Logging
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+
+class ResourceCollector(object):
+    """
+    Describes how one Azure resource type is inventoried: the resource graph type its rows are found under,
+    the S3 prefix they are saved to, and how a row becomes a resource_item.
+    :param resource_id: function(row) returning the resourceId and S3 object id, defaults to the Azure resource id with / turned into -
+    :param creation_time: function(row) returning the resourceCreationTime, if the resource has one
+    :param enrich: function(target_subs, rows, management_client) returning {lower cased resource id: supplementaryConfiguration}
+                   for a batch of rows, for details that need another query
+    """
+    def __init__(self, resource_type, graph_type, prefix, resource_id=None, creation_time=None, enrich=None):
+        self.resource_type = resource_type
+        self.graph_type = graph_type.lower()
+        self.prefix = prefix
+        self.resource_id = resource_id or default_resource_id
+        self.creation_time = creation_time
+        self.enrich = enrich
+
+    def __repr__(self):
+        return("<Antiope.ResourceCollector {} >".format(self.resource_type))
+
+    def build_resource_item(self, target_sub, row, supplementary):
+        """Wrap a resource graph row in the Antiope resource_item envelope"""
+        resource_item = {}
+        resource_item['azureSubscriptionId']            = target_sub.subscription_id
+        resource_item['azureSubscriptionName']          = target_sub.display_name
+        resource_item['azureTenantId']                  = target_sub.tenant_id
+        resource_item['azureTenantName']                = target_sub.tenant_name
+        resource_item['resourceType']                   = self.resource_type
+        resource_item['source']                         = "Antiope"
+        resource_item['configurationItemCaptureTime']   = str(datetime.datetime.now())
+        resource_item['configuration']                  = row
+        resource_item['supplementaryConfiguration']     = supplementary
+        resource_item['azureRegion']                    = "unknown"
+        resource_item['resourceId']                     = self.resource_id(row)
+        resource_item['resourceCreationTime']           = "unknown"
+        resource_item['errors']                         = {}
+
+        # Work around for API, sometimes on some subscriptions/resources the location does not return a value.
+        if row.get('location'):
+            resource_item['azureRegion']                = row['location']
+
+        if self.creation_time and self.creation_time(row):
+            resource_item['resourceCreationTime']       = self.creation_time(row)
+
+        return resource_item
+
+
+def default_resource_id(row):
+    """Azure resource ids are full of slashes, turn them into - so they make a flat S3 object name"""
+    return row['id'].strip('/').replace('/', '-')
+
+
+#
+# Collector Registry
+#
+
+# Every known collector, keyed by lower cased resource graph type. Add new resource types with register_collector()
+COLLECTORS = {}
+
+
+def register_collector(collector):
+    COLLECTORS[collector.graph_type] = collector
+    return collector
+
+
+def enabled_collectors():
+    """Returns the registered collectors, limited to the comma separated resource types in COLLECTOR_TYPES if it is set"""
+    resource_types = os.environ.get('COLLECTOR_TYPES')
+    if not resource_types:
+        return list(COLLECTORS.values())
+
+    wanted = [r.strip() for r in resource_types.split(',') if r.strip()]
+    collectors = [c for c in COLLECTORS.values() if c.resource_type in wanted]
+    for resource_type in set(wanted) - set(c.resource_type for c in collectors):
+        logger.warning("No collector registered for {}, skipping".format(resource_type))
+    return collectors
+
+
+#
+# Collector Engine
+#
+
+# What run_collectors() got through. skip_token is where to carry on from when it stopped early, None once every page was read.
+# complete is only True once every page has been read, by this call or the ones whose resume_state it was handed,
+# so the counts cover the whole of each subscription. resume_state is what the call carrying on from skip_token needs.
+CollectionResult = namedtuple('CollectionResult', ['resource_counts', 'skip_token', 'complete', 'resume_state'])
+
+
+def run_collectors(target_subs, management_client, writer, collectors=None, skip_token=None, should_stop=None, resume_state=None):
+    """
+    Inventory every collector's resource type for a group of subscriptions from the same tenant in one pass.
+    All the types share a single paged resource graph query, the rows are then routed to their collector and split back out per subscription.
+    In incremental mode only new or changed resources are enriched and saved, and removed ones get a delete marker.
+    pipeline.run_collectors_async() does the same with the query, enrichment and writes overlapped.
+    :param skip_token: carry on from this page of an earlier, unfinished call
+    :param should_stop: function checked after each page, returning True stops before the next page is fetched
+    :param resume_state: the resume_state of the earlier call's CollectionResult, so the counts and deletions cover every page
+    :return: CollectionResult, with the number of resources found keyed by lower cased subscription_id
+    """
+    if collectors is None:
+        collectors = enabled_collectors()
+    if not collectors:
+        logger.warning("No collectors enabled for {}".format(describe_subscriptions(target_subs)))
+        return CollectionResult({}, None, True, None)
+
+    collection = Collection(target_subs, collectors, writer, skip_token=skip_token, resume_state=resume_state)
+
+    # Call Resource Graph API one page at a time, so large subscriptions are never truncated or held in memory at once
+    for page in graph_resource_query_pages(collection.query, target_subs, management_client, skip_token=skip_token):
+        for collector, batch in collection.route(page):
+            supplementary = collector.enrich(target_subs, batch, management_client) if collector.enrich else {}
+            collection.write_batch(collector, batch, supplementary)
+
+        if collection.skip_token and should_stop and should_stop():
+            logger.warning("Stopping {} before the next page of resources".format(describe_subscriptions(target_subs)))
+            break
+
+    return collection.finish()
+
+
+class Collection(object):
+    """
+    The state of one pass of the collectors over a group of subscriptions: per subscription counts, the incremental
+    manifests and where the query has got to. Shared by run_collectors() and pipeline.run_collectors_async().
+    """
+    def __init__(self, target_subs, collectors, writer, skip_token=None, resume_state=None):
+        self.target_subs = target_subs
+        self.writer = writer
+        self.collectors_by_type = {c.graph_type: c for c in collectors}
+        self.subs_by_id = {sub.subscription_id.lower(): sub for sub in target_subs}
+        self.counts = {(c.graph_type, sub_id): 0 for c in collectors for sub_id in self.subs_by_id}
+        # Resumed without the earlier calls' state, the counts and deletions can only cover the pages read here
+        self.resumed = skip_token is not None and resume_state is None
+        self.skip_token = skip_token
+        self.batch_size = int(os.environ.get('ENRICH_BATCH_SIZE', 100))
+
+        # Counts of the pages read by earlier calls, keyed "<graph type>|<subscription id>" so they fit in a json message
+        if resume_state:
+            for key, count in resume_state['counts'].items():
+                graph_type, sub_id = key.split('|')
+                if (graph_type, sub_id) in self.counts:
+                    self.counts[(graph_type, sub_id)] = count
+
+        self.manifests = {}
+        if incremental_enabled():
+            self.manifests = {(c.graph_type, sub_id): load_manifest(c.prefix, sub_id) for c in collectors for sub_id in self.subs_by_id}
+            # The resources earlier calls saw were saved with their manifests, see finish()
+            if resume_state:
+                for manifest in self.manifests.values():
+                    manifest.restore_seen(resume_state['state_id'])
+
+        graph_types = ", ".join("'{}'".format(c.graph_type) for c in collectors)
+        self.query = f"""Resources
+               | where type in~ ({graph_types})
+               | project id, name, type, location, resourceGroup, subscriptionId, tags, properties
+            """
+
+    def route(self, page):
+        """Count a page's rows and return them as a list of (collector, batch of rows) to enrich and write"""
+        self.skip_token = page.skip_token
+        rows_by_type = {}
+        for row in page.rows:
+            key = (row['type'].lower(), row['subscriptionId'].lower())
+            self.counts[key] += 1
+
+            # Skip resources whose configuration has not changed since they were last written
+            if self.manifests and not self.manifests[key].changed(row['id'], content_hash(row)):
+                continue
+            rows_by_type.setdefault(row['type'].lower(), []).append(row)
+
+        return [(self.collectors_by_type[graph_type], batch)
+                for graph_type, rows in rows_by_type.items()
+                for batch in divide_into_batches(rows, self.batch_size)]
+
+    def write_batch(self, collector, batch, supplementary):
+        """Save each row of an enriched batch as a resource_item under its subscription"""
+        for sub_id, sub_rows in split_rows_by_subscription(batch).items():
+            target_sub = self.subs_by_id[sub_id]
+
+            for row in sub_rows:
+                resource_item = collector.build_resource_item(target_sub, row, supplementary.get(row['id'].lower(), {}))
+                self.writer.write(collector.prefix, resource_item['resourceId'], resource_item)
+
+                if self.manifests:
+                    self.manifests[(collector.graph_type, sub_id)].record(row['id'], content_hash(row), resource_item['resourceId'])
+
+    def finish(self):
+        """Log the counts, save the manifests and return the CollectionResult"""
+        # A resource that was not seen has only been deleted if every page was read, here or by the calls before
+        complete = not self.resumed and not self.skip_token
+
+        # Stopped part way, the call that carries on needs the counts so far and which resources have been seen
+        resume_state = None
+        if self.skip_token:
+            resume_state = {'counts': {"{}|{}".format(graph_type, sub_id): count for (graph_type, sub_id), count in self.counts.items()},
+                            'state_id': uuid.uuid4().hex}
+
+        for (graph_type, sub_id), count in self.counts.items():
+            collector = self.collectors_by_type[graph_type]
+            target_sub = self.subs_by_id[sub_id]
+            logger.info("Subscription {}({}) has {} {} resources".format(target_sub.display_name, target_sub.subscription_id, count, collector.resource_type))
+
+            if (graph_type, sub_id) in self.manifests:
+                save_manifest(collector, target_sub, self.manifests[(graph_type, sub_id)], self.writer, detect_deletions=complete,
+                              state_id=resume_state['state_id'] if resume_state else None)
+
+        totals = {sub_id: 0 for sub_id in self.subs_by_id}
+        for (graph_type, sub_id), count in self.counts.items():
+            totals[sub_id] += count
+
+        # Only count the resources once, when the whole of each subscription has been read
+        if complete:
+            for sub_id, count in totals.items():
+                metrics.count("Resources", count, Tenant=self.subs_by_id[sub_id].tenant_id, Subscription=self.subs_by_id[sub_id].subscription_id)
+        return CollectionResult(totals, self.skip_token, complete, resume_state)
+
+
+def save_manifest(collector, target_sub, manifest, writer, detect_deletions=True, state_id=None):
+    """
+    Write delete markers for the resources that have gone away, then save the subscription's manifest.
+    detect_deletions is False when only some of the pages were read, the manifest is then saved without looking for deletions.
+    state_id saves the resources seen so far with the manifest, for the call that carries on to restore.
+    """
+    if detect_deletions:
+        for azure_resource_id, resource_id in manifest.removed().items():
+            logger.info("{} {} in subscription {}({}) no longer exists".format(collector.resource_type, azure_resource_id, target_sub.display_name, target_sub.subscription_id))
+            writer.write(collector.prefix, resource_id, delete_marker(target_sub, collector.resource_type, resource_id, azure_resource_id))
+
+    # Only save the manifest once the writes it describes have made it to S3
+    failures = writer.flush()
+    if failures:
+        raise ResourceWriteError("{} of the objects for subscription {}({}) could not be saved to S3, first error: {}".format(len(failures), target_sub.display_name, target_sub.subscription_id, failures[0][1]))
+    manifest.save(state_id=state_id)
+
+
+#
+# Virtual Machines
+#
+
+def get_vm_network_interfaces(target_subs, vm_batch, management_client):
+    """
+    Run the network interface / public ip join for a batch of virtual machines in one resource graph query
+    :param target_subs: list of AntiopeAzureSubscription the virtual machines belong to
+    :param vm_batch: list of virtual machine rows returned by the resource graph
+    :param management_client: ResourceGraphClient
+    :return: dict of lower cased virtual machine resource id to its supplementaryConfiguration
+    """
+    vm_ids = ", ".join("'{}'".format(vm['id']) for vm in vm_batch)
+
+    # Network Interface Details
+    query = f"""Resources
+                | where type == 'microsoft.compute/virtualmachines'
+                | where id in~ ({vm_ids})
+                | extend vmResourceId = tolower(id)
+                | mvexpand nic = properties.networkProfile.networkInterfaces
+                | extend nicId = tostring(nic.id)
+                | project vmResourceId, resourceGroup, properties, nicId
+                  | join kind=leftouter (Resources
+                    | where type == 'microsoft.network/networkinterfaces'
+                    | mvexpand ipconfig=properties.ipConfigurations
+                    | extend publicIpId = tostring(ipconfig.properties.publicIPAddress.id)
+                    | project nicId = id, resourceGroup, privateNetworkInterfaceName = name, privateNetworkProperties = properties, publicIpId
+                    ) on nicId
+                  | join kind=leftouter (Resources
+                    | where type =~ 'microsoft.network/publicipaddresses'
+                    | project publicIpId = id, publicNetworkInterfaceName = name, publicNetworkProperties = properties, resourceGroup
+                    ) on publicIpId
+                | project-away publicIpId1
+                | project-away nicId1
+                | project vmResourceId, nicId, resourceGroup, privateNetworkInterfaceName, privateNetworkProperties, publicIpId, publicNetworkInterfaceName, publicNetworkProperties
+            """
+
+    # Call API
+    logger.info("Processing network interfaces for {} virtual machines in {}".format(len(vm_batch), describe_subscriptions(target_subs)))
+
+    # Group the rows by the virtual machine they belong to
+    vm_networks = {}
+    for page in graph_resource_query_pages(query, target_subs, management_client):
+        for row in page.rows:
+            vm_resource_id = row.pop('vmResourceId')
+            vm_networks.setdefault(vm_resource_id, {'NetworkInterfaces': []})['NetworkInterfaces'].append(row)
+
+    return vm_networks
+
+
+register_collector(ResourceCollector(
+    resource_type="Azure::Compute::VM",
+    graph_type="microsoft.compute/virtualmachines",
+    prefix="vm/instance",
+    resource_id=lambda row: row['properties']['vmId'],
+    enrich=get_vm_network_interfaces
+))
+
+
+#
+# Other Resource Types
+#
+
+register_collector(ResourceCollector(
+    resource_type="Azure::Storage::Account",
+    graph_type="microsoft.storage/storageaccounts",
+    prefix="storage/account",
+    creation_time=lambda row: (row.get('properties') or {}).get('creationTime')
+))
+
+register_collector(ResourceCollector(
+    resource_type="Azure::Network::NSG",
+    graph_type="microsoft.network/networksecuritygroups",
+    prefix="network/nsg"
+))
+
+register_collector(ResourceCollector(
+    resource_type="Azure::KeyVault::Vault",
+    graph_type="microsoft.keyvault/vaults",
+    prefix="keyvault/vault"
+))
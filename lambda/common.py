@@ -1,15 +1,20 @@
 import json
 import os
+import re
 import logging
 import boto3
 import time
 import urllib3
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import namedtuple
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from msrestazure.azure_active_directory import ServicePrincipalCredentials
-from subscription import AntiopeAzureSubscription
-from azure.mgmt.subscription import SubscriptionClient
-from azure.mgmt.consumption import ConsumptionManagementClient
-from azure.mgmt.resourcegraph.models import *
+from subscription import AntiopeAzureSubscription, SubscriptionLookupError, load_sdk_class
+from retry_policy import RetryPolicy, get_tenant_bucket
+from metrics import metrics
+from serialization import dumps_bytes, to_json_native
+from cost import get_subscription_cost
 
 
 # Setup Logging
@@ -19,98 +24,319 @@ logging.getLogger('botocore').setLevel(logging.WARNING)
 logging.getLogger('boto3').setLevel(logging.WARNING)
 logging.getLogger('msrest').setLevel(logging.INFO)
 
+# Reused by every S3 write in this container, see get_s3_client()
+_s3_client = None
+S3_MAX_POOL_CONNECTIONS = 50
+
 
 #
 # Common Functions
 #
 
+# A single page of resource graph results. skip_token is the token for the page after this one, None on the last page.
+GraphQueryPage = namedtuple('GraphQueryPage', ['rows', 'skip_token'])
+
+
 def graph_resource_query(gr_query, target_sub, management_client):
+    """
+    Run a resource graph query and return every row, following skip tokens until the last page
+    :param target_sub: an AntiopeAzureSubscription, or a list of them from the same tenant
+    :return: count, status and the list of rows
+    """
+    data = []
+    try:
+        for page in graph_resource_query_pages(gr_query, target_sub, management_client):
+            data.extend(page.rows)
+    except ResourceGraphQueryError:
+        return 0, '503', []
 
-    # Retry Parameters
-    retries = 3
-    attempt = 1
-    
-    # Setup Query Request
-    q = QueryRequest(
-        query=gr_query,
-        subscriptions=[target_sub.subscription_id],
-        options=QueryRequestOptions(
-            result_format=ResultFormat.object_array
+    return len(data), '200', data
+
+
+def graph_resource_query_pages(gr_query, target_sub, management_client, page_size=None, skip_token=None):
+    """
+    Generator that runs a resource graph query and yields a GraphQueryPage for each page of results
+    :param gr_query: the resource graph query
+    :param target_sub: the AntiopeAzureSubscription to query, or a list of them from the same tenant to query in one request
+    :param management_client: ResourceGraphClient
+    :param page_size: rows requested per page, defaults to the GRAPH_QUERY_PAGE_SIZE environment variable
+    :param skip_token: resume the query from this page rather than the first one
+    :raises ResourceGraphQueryError: if a page cannot be retrieved
+    """
+    if page_size is None:
+        page_size = int(os.environ.get('GRAPH_QUERY_PAGE_SIZE', 1000))
+
+    target_subs = target_sub if isinstance(target_sub, list) else [target_sub]
+
+    # Only the handlers that query the resource graph pay for importing its models
+    from azure.mgmt.resourcegraph.models import QueryRequest, QueryRequestOptions, ResultFormat
+
+    while True:
+        # Setup Query Request
+        q = QueryRequest(
+            query=gr_query,
+            subscriptions=[sub.subscription_id for sub in target_subs],
+            options=QueryRequestOptions(
+                top=page_size,
+                skip_token=skip_token,
+                result_format=ResultFormat.object_array
+                )
             )
-        )
 
-    count = 0
-    data = {}
-    status = ''
-    
-    while attempt <= retries:
-        
-        logger.info("Sending resource graph query for subscription {}({}), attempt: {} of {}".format(target_sub.display_name, target_sub.subscription_id, str(attempt), str(retries)))
-        
-        try:
-            response = management_client.resources(q)
-            data = response.data
-            count = response.count
-            status = '200'
+        response = send_graph_query(q, describe_subscriptions(target_subs), management_client, tenant=target_subs[0].tenant_id)
+        skip_token = response.skip_token
+        yield GraphQueryPage(response.data, skip_token)
+
+        if not skip_token:
             break
-        
-        except:
-            attempt +=1
-            time.sleep(10)
-            
-            if attempt > retries:
-                logger.error("API Call failed for subscription {}({}) after {} retries".format(target_sub.display_name, target_sub.subscription_id, str(retries)))
-                status = '503'
-            
-            continue
-    
-    return count, status, data
-
-def save_resource_to_s3(prefix, resource_id, resource):
+
+
+def send_graph_query(q, description, management_client, tenant=None):
+    """Send a single resource graph QueryRequest, retrying throttled and transient failures. Returns the QueryResponse
+    :param description: the subscription(s) being queried, used in log messages
+    :param tenant: queries against the same tenant share a rate limit, see retry_policy.get_tenant_bucket()
     """
-    This function saves a json file to s3
+    logger.info("Sending resource graph query for {}".format(description))
+
+    policy = RetryPolicy()
+    bucket = get_tenant_bucket(tenant) if tenant else None
+
+    try:
+        # raw=True so the quota headers can be fed back into the tenant's token bucket
+        with metrics.span("GraphQuery", Tenant=tenant):
+            raw_response = policy.call(lambda: management_client.resources(q, raw=True), bucket=bucket, description=description,
+                                       metric="GraphQuery", dimensions={'Tenant': tenant})
+    except Exception as e:
+        logger.error("API Call failed for {}: {}".format(description, e))
+        raise ResourceGraphQueryError("Resource graph query failed for {}: {}".format(description, e))
+
+    metrics.count("GraphQueryRows", len(raw_response.output.data or []), Tenant=tenant)
+    return raw_response.output
+
+
+def split_rows_by_subscription(rows):
+    """
+    Split the rows of a multi-subscription resource graph query back out per subscription
+    :param rows: rows that include the subscriptionId column
+    :return: dict of lower cased subscription id to the list of rows for that subscription
+    """
+    split_rows = {}
+    for row in rows:
+        split_rows.setdefault(row['subscriptionId'].lower(), []).append(row)
+    return split_rows
+
+
+def divide_into_batches(items, size):
+    """Yield successive lists of at most size items"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def describe_subscriptions(target_subs):
+    """Returns a name(id) string for a list of subscriptions, for use in log and error messages"""
+    return ", ".join("subscription {}({})".format(sub.display_name, sub.subscription_id) for sub in target_subs)
+
+
+def tenant_slug(tenant_name):
+    """The tenant name lower cased, with anything other than letters and digits turned into a single -, for S3 keys and links"""
+    return re.sub(r"[^a-z0-9]+", "-", tenant_name.lower()).strip("-") or "tenant"
+
+
+def get_s3_client():
+    """Returns the module level S3 client, creating it on first use so its connection pool is reused across calls and warm invocations"""
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3', config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+    return _s3_client
+
+
+def put_resource_to_s3(prefix, resource_id, body):
+    """
+    Writes an already serialized resource to s3, raising ClientError on failure
     :param prefix: like VM, APP-SERVICE
-    :param resource_id: the id of the resource often Azure uses slashes \ but we turn them into -
-    :param resource: the json of the resources
-    :return: Nothing
+    :param resource_id: the id of the resource often Azure uses slashes but we turn them into -
+    :param body: the serialized json of the resource, as bytes
+    :return: the object key written
     """
-    s3client = boto3.client('s3')
     object_key = "Azure-Resources/{}/{}.json".format(prefix, resource_id)
 
-    try:
-        s3client.put_object(
-            Body=json.dumps(resource, sort_keys=False, default=str, indent=2),
+    with metrics.span("S3Put"):
+        get_s3_client().put_object(
+            Body=body,
             Bucket=os.environ['INVENTORY_BUCKET'],
             ContentType='application/json',
             Key=object_key,
         )
+    return object_key
+
+
+def save_resource_to_s3(prefix, resource_id, resource, indent=None):
+    """
+    This function saves a json file to s3
+    :param prefix: like VM, APP-SERVICE
+    :param resource_id: the id of the resource often Azure uses slashes but we turn them into -
+    :param resource: the json of the resources
+    :param indent: pretty print the json with this indent, compact by default
+    :return: Nothing
+    """
+    try:
+        put_resource_to_s3(prefix, resource_id, dump_resource_json(resource, indent))
     except ClientError as e:
-        logger.error("Unable to save object {}: {}".format(object_key, e))
+        logger.error("Unable to save object Azure-Resources/{}/{}.json: {}".format(prefix, resource_id, e))
+
+
+def dump_resource_json(resource, indent=None):
+    """Serialize a resource for S3 as UTF-8 JSON, compact unless an indent is requested. See serialization.dumps_bytes()"""
+    return dumps_bytes(resource, indent=indent)
+
+
+class ResourceWriter(object):
+    """
+    Saves resources to S3 from a bounded pool of threads sharing the module level S3 client.
+    write() blocks once max_pending writes are outstanding, flush() waits for every write and returns the failures.
+    """
+    def __init__(self, max_workers=None, max_pending=None, indent=None):
+        if max_workers is None:
+            max_workers = int(os.environ.get('S3_WRITER_THREADS', 16))
+        if max_pending is None:
+            max_pending = max_workers * 4
+
+        self.indent = indent
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.failures = []
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, prefix, resource_id, resource):
+        """Queue a resource to be saved to Azure-Resources/<prefix>/<resource_id>.json"""
+        dimensions = {'Tenant': resource.get('azureTenantId'), 'Subscription': resource.get('azureSubscriptionId')}
+        with metrics.span("Serialize", **dimensions):
+            body = dump_resource_json(resource, self.indent)
+        metrics.count("BytesWritten", len(body), unit="Bytes", **dimensions)
+
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(put_resource_to_s3, prefix, resource_id, body)
+        except Exception:
+            self.slots.release()
+            raise
+
+        future.object_name = "Azure-Resources/{}/{}.json".format(prefix, resource_id)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._write_done)
+
+    def _write_done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+            error = future.exception()
+            if error is not None:
+                logger.error("Unable to save object {}: {}".format(future.object_name, error))
+                self.failures.append((future.object_name, error))
+            else:
+                self.written += 1
+        self.slots.release()
+
+    def flush(self):
+        """Wait for all queued writes to finish. Returns a list of (object_key, error) for the writes that failed since the last flush"""
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+
+        with self.lock:
+            failures = self.failures
+            self.failures = []
+        return failures
+
+    def close(self):
+        """Flush any queued writes and stop the worker threads. Returns the failures like flush()"""
+        failures = self.flush()
+        self.executor.shutdown(wait=True)
+        return failures
 
 
 def safe_dump_json(obj)->dict:
     """
-    Converts an object to a json in a shallow way
+    Converts an object, an Azure SDK model for example, to a dict that can be dumped as json.
+    Nested models, enums, dates and Decimals are converted too, see serialization.to_json_native()
     :param obj:
     :return:
     """
-    # TODO needs to be able to parse json of json
-    json_obj = {}
-    for key in obj.__dict__.keys():
-        json_obj[key] = str(obj.__dict__[key])
-
-    return json_obj
+    return to_json_native(vars(obj))
 
 
 def get_active_subscriptions(table_name=None):
-    """Returns an array of all active azure subscriptions as AntiopeAzureSubscription objects"""
-    sub_ids = get_subscription_ids(status="Enabled", table_name=table_name)
+    """Returns an array of all active azure subscriptions as AntiopeAzureSubscription objects, built from a single paginated scan"""
+    dynamodb = boto3.resource('dynamodb')
     output = []
-    for sub_id in sub_ids:
-        output.append(AntiopeAzureSubscription(sub_id))
+    for record in scan_subscription_records(dynamodb, table_name=table_name):
+        if record.get('subscription_state') == "Enabled":
+            output.append(AntiopeAzureSubscription(record['subscription_id'], db_record=record, dynamodb=dynamodb))
     return(output)
 
 
+def load_subscriptions(subscription_ids, table_name=None):
+    """
+    Returns AntiopeAzureSubscription objects for the subscription_ids, loaded with BatchGetItem rather than a query per subscription.
+    Subscriptions missing from the table are logged and left out, the rest keep the order they were asked for in.
+    """
+    dynamodb = boto3.resource('dynamodb')
+    if not table_name:
+        table_name = os.environ['SUBSCRIPTION_TABLE']
+
+    records = {}
+    # BatchGetItem accepts at most 100 keys per request
+    for i in range(0, len(subscription_ids), 100):
+        request = {table_name: {'Keys': [{'subscription_id': sub_id} for sub_id in subscription_ids[i:i + 100]]}}
+        attempt = 0
+
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for record in response['Responses'].get(table_name, []):
+                records[record['subscription_id']] = record
+
+            # DynamoDB may hand back keys it did not get to when throttled or over the response size limit
+            request = response.get('UnprocessedKeys')
+            if request:
+                attempt += 1
+                if attempt > 8:
+                    raise SubscriptionLookupError("Unable to load {} subscription(s) from {} after {} retries".format(len(request[table_name]['Keys']), table_name, attempt - 1))
+                time.sleep(min(0.05 * (2 ** attempt), 5))
+
+    output = []
+    for sub_id in subscription_ids:
+        if sub_id in records:
+            output.append(AntiopeAzureSubscription(sub_id, db_record=records[sub_id], dynamodb=dynamodb))
+        else:
+            logger.error("Subscription {} not found in {}".format(sub_id, table_name))
+    return(output)
+
+
+def scan_subscription_records(dynamodb, table_name=None):
+    """Generator that yields every record in the Subscriptions table, following LastEvaluatedKey"""
+    if table_name:
+        subscription_table = dynamodb.Table(table_name)
+    else:
+        subscription_table = dynamodb.Table(os.environ['SUBSCRIPTION_TABLE'])
+
+    response = subscription_table.scan()
+    while True:
+        for record in response['Items']:
+            yield record
+        if 'LastEvaluatedKey' not in response:
+            break
+        # Means that dynamoDB didn't return the full set, so ask for more.
+        response = subscription_table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
+
+
 def get_subscription_ids(status=None, table_name=None):
     """return an array of subscription_ids from the Subscriptions table. Optionally, filter by status"""
     dynamodb = boto3.resource('dynamodb')
@@ -142,22 +368,27 @@ def get_subscription_ids(status=None, table_name=None):
 
 
 def get_subcriptions(azure_creds):
+    ServicePrincipalCredentials = load_sdk_class("msrestazure.azure_active_directory", "ServicePrincipalCredentials")
+    SubscriptionClient = load_sdk_class("azure.mgmt.subscription", "SubscriptionClient")
 
-    creds = return_azure_creds(azure_creds["application_id"], azure_creds["key"], azure_creds["tenant_id"])
+    creds = ServicePrincipalCredentials(
+        client_id=azure_creds["application_id"],
+        secret=azure_creds["key"],
+        tenant=azure_creds["tenant_id"]
+    )
 
     resource_client = SubscriptionClient(creds)
+    subscriptions = list(resource_client.subscriptions.list())
 
-    collected_subs = []
-    for subscription in resource_client.subscriptions.list():
+    # Month to date costs are summed server side, one request per subscription run concurrently
+    with ThreadPoolExecutor(max_workers=int(os.environ.get('COST_QUERY_THREADS', 8))) as executor:
+        costs = list(executor.map(lambda subscription: get_subscription_cost(creds, subscription.subscription_id), subscriptions))
 
-        consumption_client = ConsumptionManagementClient(creds, subscription.subscription_id, base_url=None)
-        sum = 0
-        for uu in consumption_client.usage_details.list():
-            sum += uu.pretax_cost
+    collected_subs = []
+    for subscription, cost in zip(subscriptions, costs):
 
         subscription_dict = {"subscription_id": subscription.subscription_id, "display_name": subscription.display_name,
-                             "cost": int(sum), "state": str(subscription.state)}
-
+                             "cost": int(cost), "state": str(subscription.state)}
 
         collected_subs.append(subscription_dict)
 
@@ -212,3 +443,13 @@ def capture_error(event, context, error, message):
     logger.info(f"Sending Lambda Exception Message: {body}")
     response = sqs_client.send_message(QueueUrl=queue_url, MessageBody=json.dumps(body))
     return(body)
+
+
+class ResourceGraphQueryError(Exception):
+    # Raised when a resource graph query fails after all retries
+    pass
+
+
+class ResourceWriteError(Exception):
+    # Raised when resources could not be saved to S3
+    pass
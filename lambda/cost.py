@@ -0,0 +1,118 @@
+import os
+import time
+import logging
+import datetime
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from subscription import ServicePrincipalError, SubscriptionUpdateError
+from retry_policy import RetryPolicy
+from metrics import metrics
+
+
+# Setup Logging
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+
+#
+# Cost Functions
+#
+
+def get_subscription_cost(credentials, subscription_id):
+    """
+    Returns the month to date pretax cost of a subscription. The sum is done by the Cost Management query API,
+    so this is one request no matter how many usage records the subscription has.
+    """
+    # Imported here so loading this module does not load the Cost Management SDK
+    from azure.mgmt.costmanagement import CostManagementClient
+    from azure.mgmt.costmanagement.models import QueryDefinition, QueryDataset, QueryAggregation
+
+    client = CostManagementClient(credentials, subscription_id, base_url=None)
+
+    query = QueryDefinition(
+        type="Usage",
+        timeframe="BillingMonthToDate",
+        dataset=QueryDataset(
+            aggregation={"totalCost": QueryAggregation(name="PreTaxCost", function="Sum")}
+        )
+    )
+    # Cost Management throttles hard (429 with a Retry-After), so retry those and transient failures like the graph queries
+    scope = "/subscriptions/{}".format(subscription_id)
+    with metrics.span("CostQuery"):
+        result = RetryPolicy().call(lambda: client.query.usage(scope, query), description="cost of {}".format(subscription_id), metric="CostQuery")
+
+    if not result.rows:
+        return(0.0)
+
+    # The row holds the aggregated cost and its currency, find the cost by column name
+    column_names = [column.name for column in result.columns]
+    index = column_names.index("totalCost") if "totalCost" in column_names else 0
+    return(float(result.rows[0][index]))
+
+
+def collect_subscription_costs(subscriptions, secret_name):
+    """
+    Returns a dict of subscription_id to month to date cost for the AntiopeAzureSubscription objects.
+    Costs already fetched for this billing period within COST_CACHE_TTL hours are taken from the subscription record,
+    the rest are fetched concurrently and saved back to the subscriptions table.
+    """
+    billing_period = current_billing_period()
+    max_age = int(os.environ.get('COST_CACHE_TTL', 12)) * 3600
+    now = int(time.time())
+
+    costs = {}
+    stale = []
+    for subscription in subscriptions:
+        record = subscription.db_record
+        if record.get('cost_billing_period') == billing_period and now - int(record.get('cost_updated', 0)) < max_age and 'cost' in record:
+            costs[subscription.subscription_id] = float(record['cost'])
+        else:
+            stale.append(subscription)
+
+    logger.info("Fetching cost for {} subscriptions, {} cached for billing period {}".format(len(stale), len(costs), billing_period))
+
+    # Authenticate here rather than in the pool, so each tenant's secret and token are fetched once by this thread
+    # and the workers only run the queries. Subscriptions after the first in a tenant come from the credential cache.
+    authenticated = []
+    for subscription in stale:
+        try:
+            subscription.authenticate(secret_name)
+            authenticated.append(subscription)
+        except ServicePrincipalError as e:
+            logger.error("Unable to authenticate for the cost of subscription {}({}): {}".format(subscription.display_name, subscription.subscription_id, e))
+    stale = authenticated
+
+    def fetch(subscription):
+        try:
+            return(get_subscription_cost(subscription.credentials, subscription.subscription_id))
+        except Exception as e:
+            logger.error("Unable to get cost for subscription {}({}): {}".format(subscription.display_name, subscription.subscription_id, e))
+            return(None)
+
+    with ThreadPoolExecutor(max_workers=int(os.environ.get('COST_QUERY_THREADS', 8))) as executor:
+        fetched = list(executor.map(fetch, stale))
+
+    # Save the results back from this thread, the subscriptions share a DynamoDB resource that is not thread safe
+    table_name = os.environ['SUBSCRIPTION_TABLE']
+    for subscription, cost in zip(stale, fetched):
+        if cost is None:
+            continue
+        costs[subscription.subscription_id] = cost
+        try:
+            # One write, so the cached cost is never paired with another billing period's timestamp
+            subscription.update_attributes(table_name, {
+                'cost': Decimal(str(round(cost, 2))),
+                'cost_billing_period': billing_period,
+                'cost_updated': now,
+            })
+        except SubscriptionUpdateError as e:
+            logger.error("Unable to cache cost for subscription {}: {}".format(subscription.subscription_id, e))
+
+    return(costs)
+
+
+def current_billing_period():
+    """Returns the billing period costs are cached under, the current month in UTC as YYYY-MM"""
+    return(datetime.datetime.utcnow().strftime("%Y-%m"))
@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import logging
+import boto3
+
+
+# Setup Logging
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+
+# SQS will not delay a message for longer than 15 minutes, and both SQS and SNS take at most 10 entries per batch call
+MAX_DELAY_SECONDS = 900
+MAX_BATCH_SIZE = 10
+
+
+def build_dispatch_schedule(messages, interval):
+    """
+    Spread the messages over time so the inventory lambdas do not all hit Azure at once.
+    Message i is delivered interval * i seconds from now. Delays past the MAX_DELAY_SECONDS SQS allows are sent in
+    waves, see send_to_queue()
+    :return: list of (delay_seconds, message)
+    """
+    return [(interval * i, message) for i, message in enumerate(messages)]
+
+
+def last_dispatch_delay(count, interval):
+    """Returns the delivery delay of the last of count messages, see build_dispatch_schedule()"""
+    if count < 1:
+        return 0
+    return interval * (count - 1)
+
+
+def dispatch_messages(messages, interval=None):
+    """
+    Send inventory messages to the subscription inventory lambdas without sleeping between them.
+    Everything is sent up front to the DISPATCH_QUEUE_URL queue, with the spacing done by each message's DelaySeconds.
+    They are also published to the TRIGGER_ACCOUNT_INVENTORY_ARN topic as they are sent, which nothing in this stack
+    subscribes to any more. It is kept for custom subscribers, see the InventoryTriggerTopic output.
+    """
+    if interval is None:
+        interval = int(os.environ.get('SNS_DELAY', 0))
+
+    if os.environ.get('DISPATCH_QUEUE_URL'):
+        send_to_queue(build_dispatch_schedule(messages, interval), os.environ['DISPATCH_QUEUE_URL'])
+
+    if os.environ.get('TRIGGER_ACCOUNT_INVENTORY_ARN'):
+        publish_to_topic(messages, os.environ['TRIGGER_ACCOUNT_INVENTORY_ARN'])
+
+
+def send_to_queue(schedule, queue_url):
+    """
+    Send a (delay_seconds, message) schedule to SQS, ten messages per call.
+    A message due later than SQS can delay it is sent with the longest delay and a not_before time, and is put back
+    on the queue for the rest of its delay when it arrives early, see requeue_if_early()
+    """
+    sqs_client = boto3.client('sqs')
+    now = int(time.time())
+    for i in range(0, len(schedule), MAX_BATCH_SIZE):
+        entries = []
+        for n, (delay, message) in enumerate(schedule[i:i + MAX_BATCH_SIZE]):
+            delay = int(delay)
+            if delay > MAX_DELAY_SECONDS:
+                message = dict(message, not_before=now + delay)
+            entries.append({'Id': str(i + n), 'MessageBody': json.dumps(message), 'DelaySeconds': min(delay, MAX_DELAY_SECONDS)})
+        send_batch(lambda e: sqs_client.send_message_batch(QueueUrl=queue_url, Entries=e), entries, queue_url)
+
+
+def requeue_if_early(message, queue_url, now=None):
+    """
+    Put a message that arrived before its not_before time back on the queue, for as much of the rest of its delay as
+    SQS allows. Returns True if it was put back and is not to be handled yet.
+    """
+    now = now or time.time()
+    remaining = int(message.get('not_before', 0) - now)
+    if remaining <= 0:
+        return False
+
+    logger.info("Message is not due for another {} seconds, putting it back on the queue".format(remaining))
+    send_to_queue([(remaining, message)], queue_url)
+    return True
+
+
+def publish_to_topic(messages, topic_arn):
+    """Publish messages to SNS, ten per call"""
+    sns_client = boto3.client('sns')
+    for i in range(0, len(messages), MAX_BATCH_SIZE):
+        entries = [{'Id': str(i + n), 'Message': json.dumps(message)} for n, message in enumerate(messages[i:i + MAX_BATCH_SIZE])]
+        send_batch(lambda e: sns_client.publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=e), entries, topic_arn)
+
+
+def send_batch(send, entries, destination):
+    """Send a batch of entries, retrying the entries that failed once before giving up"""
+    for attempt in range(2):
+        response = send(entries)
+        failed_ids = set(f['Id'] for f in response.get('Failed', []))
+        if not failed_ids:
+            return
+        logger.warning("{} of {} messages to {} failed: {}".format(len(failed_ids), len(entries), destination, response['Failed']))
+        entries = [e for e in entries if e['Id'] in failed_ids]
+
+    raise DispatchError("Unable to send {} message(s) to {}".format(len(entries), destination))
+
+
+class DispatchError(Exception):
+    # Raised when messages could not be sent to the inventory lambdas
+    pass
@@ -0,0 +1,336 @@
+import io
+import os
+import json
+import gzip
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+from common import *
+from collectors import COLLECTORS
+from incremental import incremental_enabled
+from reports import S3StreamWriter
+from serialization import dumps
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Setup Logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+
+MANIFEST_PREFIX = "Azure-Resources/manifests/"
+
+# Columns pulled out of the resource_item envelope. Nested configuration is kept as a json string column.
+SCHEMA = pyarrow.schema([
+    ('azureTenantId', pyarrow.string()),
+    ('azureTenantName', pyarrow.string()),
+    ('azureSubscriptionId', pyarrow.string()),
+    ('azureSubscriptionName', pyarrow.string()),
+    ('azureRegion', pyarrow.string()),
+    ('resourceType', pyarrow.string()),
+    ('resourceId', pyarrow.string()),
+    ('azureResourceId', pyarrow.string()),
+    ('name', pyarrow.string()),
+    ('resourceGroup', pyarrow.string()),
+    ('resourceCreationTime', pyarrow.string()),
+    ('configurationItemCaptureTime', pyarrow.timestamp('us')),
+    ('configurationItemStatus', pyarrow.string()),
+    ('tags', pyarrow.string()),
+    ('configuration', pyarrow.string()),
+    ('supplementaryConfiguration', pyarrow.string()),
+])
+
+
+def handler(event, context):
+    """
+    Consolidate a run's resource records into Parquet, partitioned by tenant and resource type:
+    Azure-Parquet/<yyyy-mm-dd>/tenant=<tenant slug>/resource_type=<type>/part-0000.parquet
+    When OUTPUT_FORMAT is ndjson it reads the shards listed in the manifests of the event's run_id (every manifest of
+    the day without one), otherwise the current objects under Azure-Resources/, see read_object_records()
+    """
+    logger.info("Received event: " + json.dumps(event, sort_keys=True))
+
+    run_date = event.get('run_date') or datetime.datetime.utcnow().strftime("%Y-%m-%d")
+    if os.environ.get('OUTPUT_FORMAT', "object") == "ndjson":
+        # Incremental runs leave unchanged resources out of the shards, an export of them would be missing most of the estate
+        if incremental_enabled():
+            raise ExportError("INCREMENTAL_INVENTORY is not supported with OUTPUT_FORMAT ndjson, the shards only hold changed resources")
+        records = read_shard_records(run_date, event.get('run_id'))
+    else:
+        records = read_object_records(event.get('run_started'))
+
+    writer = PartitionedParquetWriter("Azure-Parquet/{}".format(run_date))
+    try:
+        for record in records:
+            writer.add(record)
+    except Exception:
+        # Leave no half written partitions behind in S3
+        writer.abort()
+        raise
+    objects = writer.close()
+
+    logger.info("Wrote {} rows to {} parquet objects".format(writer.rows, len(objects)))
+    event['parquet_objects'] = len(objects)
+    return(event)
+
+
+#
+# Readers
+#
+
+def read_object_records(run_started=None):
+    """
+    Generator of the current resource_items saved one object per resource, fetched concurrently a listing page at a time.
+    With INCREMENTAL_INVENTORY the resource manifests say which objects are current, unchanged resources are not
+    rewritten every run. Otherwise only objects written since run_started (epoch seconds) are read, so resources
+    that have since gone away are left out. Delete markers are never exported.
+    """
+    s3_client = get_s3_client()
+
+    def fetch(key):
+        return json.loads(s3_client.get_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=key)['Body'].read())
+
+    if incremental_enabled():
+        key_pages = current_object_keys()
+    else:
+        key_pages = run_object_keys(run_started)
+
+    with ThreadPoolExecutor(max_workers=int(os.environ.get('S3_READER_THREADS', 32))) as executor:
+        for keys in key_pages:
+            for record in executor.map(fetch, keys):
+                if record.get('configurationItemStatus') == "ResourceDeleted":
+                    continue
+                yield record
+
+
+def run_object_keys(run_started=None):
+    """Generator of lists of the resource object keys written since run_started, a listing page at a time"""
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=os.environ['INVENTORY_BUCKET'], Prefix="Azure-Resources/"):
+        yield [o['Key'] for o in page.get('Contents', [])
+               if o['Key'].endswith('.json') and not o['Key'].startswith(MANIFEST_PREFIX)
+               and (run_started is None or o['LastModified'].timestamp() >= int(run_started))]
+
+
+def current_object_keys():
+    """Generator of lists of the resource object keys in each resource manifest, see incremental.ResourceManifest"""
+    s3_client = get_s3_client()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=os.environ['INVENTORY_BUCKET'], Prefix=MANIFEST_PREFIX):
+        for o in page.get('Contents', []):
+            # Azure-Resources/manifests/<prefix>/<subscription_id>.json
+            prefix = o['Key'][len(MANIFEST_PREFIX):].rsplit('/', 1)[0]
+            manifest = json.loads(s3_client.get_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=o['Key'])['Body'].read())
+            yield ["Azure-Resources/{}/{}.json".format(prefix, entry[1]) for entry in manifest['resources'].values()]
+
+
+def read_shard_manifests(run_date, run_id=None):
+    """
+    Generator of the shard manifests written on run_date, only listing the dates under each collector's prefix.
+    With a run_id only the manifests of that inventory run are returned.
+    """
+    s3_client = get_s3_client()
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    for prefix in sorted(set(c.prefix for c in COLLECTORS.values())):
+        for page in paginator.paginate(Bucket=os.environ['INVENTORY_BUCKET'], Prefix="Azure-Resources-Shards/{}/{}/".format(prefix, run_date)):
+            for o in page.get('Contents', []):
+                if not o['Key'].rsplit('/', 1)[-1].startswith("manifest-"):
+                    continue
+                manifest = json.loads(s3_client.get_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=o['Key'])['Body'].read())
+                if run_id and manifest.get('run_id') != run_id:
+                    continue
+                yield manifest
+
+
+def read_shard_records(run_date, run_id=None):
+    """Generator of the resource_items in the ndjson shards listed by the run's manifests, streamed a line at a time"""
+    s3_client = get_s3_client()
+
+    for manifest in read_shard_manifests(run_date, run_id):
+        for shard in manifest['shards']:
+            body = s3_client.get_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=shard['key'])['Body']
+            for line in open_shard(body, manifest.get('compression', "gzip")):
+                yield json.loads(line)
+
+
+def open_shard(body, compression):
+    """Returns a binary file object of a shard's uncompressed ndjson, read from its streaming S3 body"""
+    if compression == "zstd":
+        if zstandard is None:
+            raise ExportError("zstandard is needed to read zstd shards")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(body))
+    return gzip.GzipFile(fileobj=body)
+
+
+#
+# Parquet Writer
+#
+
+def flatten_record(record):
+    """Flatten a resource_item into a row matching SCHEMA"""
+    configuration = record.get('configuration') or {}
+    return {
+        'azureTenantId':                record.get('azureTenantId'),
+        'azureTenantName':              record.get('azureTenantName'),
+        'azureSubscriptionId':          record.get('azureSubscriptionId'),
+        'azureSubscriptionName':        record.get('azureSubscriptionName'),
+        'azureRegion':                  record.get('azureRegion'),
+        'resourceType':                 record.get('resourceType'),
+        'resourceId':                   str(record.get('resourceId')),
+        'azureResourceId':              configuration.get('id') or record.get('azureResourceId'),
+        'name':                         configuration.get('name'),
+        'resourceGroup':                configuration.get('resourceGroup'),
+        'resourceCreationTime':         record.get('resourceCreationTime'),
+        'configurationItemCaptureTime': parse_capture_time(record.get('configurationItemCaptureTime')),
+        'configurationItemStatus':      record.get('configurationItemStatus', "OK"),
+        'tags':                         dumps(configuration.get('tags')),
+        'configuration':                dumps(configuration),
+        'supplementaryConfiguration':   dumps(record.get('supplementaryConfiguration')),
+    }
+
+
+def parse_capture_time(value):
+    """configurationItemCaptureTime is written as str(datetime.datetime.now())"""
+    if not value:
+        return None
+    for fmt in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+class PartitionedParquetWriter(object):
+    """
+    Buffers flattened rows per tenant and resource type partition and writes them out as row groups of
+    PARQUET_ROW_GROUP_SIZE rows, large enough that a scan reads few groups per file. Each partition's file is streamed
+    to S3 as it is written, so an open partition holds at most a part (PARQUET_PART_SIZE_MB) of encoded Parquet
+    alongside its buffered rows rather than the whole file.
+    What every partition holds together is kept under PARQUET_BUFFER_MB. Over that the partition with the most rows
+    buffered writes them out as a row group early, and if the unsent parts alone are still over it the partition with
+    the biggest one is finished, its later rows going to the next part-NNNN.parquet file of the partition.
+    """
+    def __init__(self, prefix, row_group_size=None, part_size=None, buffer_size=None):
+        self.prefix = prefix
+        self.row_group_size = row_group_size or int(os.environ.get('PARQUET_ROW_GROUP_SIZE', 50000))
+        self.part_size = part_size or int(os.environ.get('PARQUET_PART_SIZE_MB', 8)) * 1024 * 1024
+        self.buffer_size = buffer_size or int(os.environ.get('PARQUET_BUFFER_MB', 256)) * 1024 * 1024
+        self.partitions = {}
+        self.file_numbers = {}
+        self.objects = []
+        self.rows = 0
+        # Estimated bytes of the rows buffered in every partition, and the bytes of encoded Parquet not yet sent
+        self.buffered_rows = 0
+        self.buffered_parts = 0
+
+    def add(self, record):
+        key = (tenant_slug(record.get('azureTenantName') or "unknown"), (record.get('resourceType') or "unknown").replace("::", "_"))
+        partition = self.partitions.get(key)
+        if partition is None:
+            partition = self.partitions[key] = self._open(key)
+
+        row = flatten_record(record)
+        size = row_size(row)
+        partition['rows'].append(row)
+        partition['bytes'] += size
+        self.buffered_rows += size
+        self.rows += 1
+        if len(partition['rows']) >= self.row_group_size:
+            self._write_row_group(partition)
+        if self.buffered() > self.buffer_size:
+            self._spill()
+
+    def buffered(self):
+        """Estimated bytes held across every partition"""
+        return self.buffered_rows + self.buffered_parts
+
+    def _open(self, key):
+        number = self.file_numbers.get(key, 0)
+        self.file_numbers[key] = number + 1
+        object_key = "{}/tenant={}/resource_type={}/part-{:04d}.parquet".format(self.prefix, key[0], key[1], number)
+        stream = S3StreamWriter(os.environ['INVENTORY_BUCKET'], object_key, "application/octet-stream", s3_client=get_s3_client(),
+                                part_size=self.part_size, binary=True, metric="Parquet")
+        writer = pq.ParquetWriter(stream, SCHEMA, compression='snappy')
+        # The writer starts the file as soon as it is opened
+        self.buffered_parts += stream.buffered
+        return {'key': object_key, 'stream': stream, 'rows': [], 'bytes': 0, 'writer': writer}
+
+    def _write_row_group(self, partition):
+        columns = {name: [row[name] for row in partition['rows']] for name in SCHEMA.names}
+        before = partition['stream'].buffered
+        partition['writer'].write_table(pyarrow.Table.from_pydict(columns, schema=SCHEMA))
+        self.buffered_parts += partition['stream'].buffered - before
+        self.buffered_rows -= partition['bytes']
+        partition['rows'] = []
+        partition['bytes'] = 0
+
+    def _spill(self):
+        """Bring what is buffered back under buffer_size"""
+        largest = max(self.partitions.values(), key=lambda p: p['bytes'])
+        if largest['rows']:
+            logger.debug("Writing {} rows of {} early, {} bytes are buffered".format(len(largest['rows']), largest['key'], self.buffered()))
+            self._write_row_group(largest)
+        if self.buffered() > self.buffer_size:
+            fullest = max(self.partitions, key=lambda key: self.partitions[key]['stream'].buffered)
+            logger.debug("Finishing {} early, {} bytes are buffered".format(self.partitions[fullest]['key'], self.buffered()))
+            self._finish(self.partitions[fullest])
+            del self.partitions[fullest]
+
+    def _finish(self, partition):
+        if partition['rows']:
+            self._write_row_group(partition)
+        # Closing the writer adds the footer to what is buffered, and closing the stream sends all of it
+        self.buffered_parts -= partition['stream'].buffered
+        partition['writer'].close()
+        partition['stream'].close()
+        self.objects.append(partition['key'])
+
+    def close(self):
+        """Write the remaining rows and finish every partition's upload. Returns the object keys written"""
+        try:
+            for key in list(self.partitions):
+                self._finish(self.partitions[key])
+                del self.partitions[key]
+        except Exception:
+            self.abort()
+            raise
+        return self.objects
+
+    def abort(self):
+        """Abandon the uploads still in progress and delete the files already finished"""
+        for partition in self.partitions.values():
+            if not partition['stream'].closed:
+                # Closed here, or garbage collection closes it later and writes the footer into the aborted upload
+                try:
+                    partition['writer'].close()
+                except Exception as e:
+                    logger.debug("Ignoring an error closing the parquet writer of {} being aborted: {}".format(partition['key'], e))
+                partition['stream'].abort()
+        self.partitions = {}
+
+        for object_key in self.objects:
+            try:
+                get_s3_client().delete_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=object_key)
+            except ClientError as e:
+                logger.error("Unable to delete s3://{}/{} of the aborted export: {}".format(os.environ['INVENTORY_BUCKET'], object_key, e))
+        self.objects = []
+
+
+def row_size(row):
+    """Rough bytes held by a flattened row, its strings plus a little for everything else"""
+    return sum(len(value) for value in row.values() if isinstance(value, str)) + 100
+
+
+class ExportError(Exception):
+    # Raised when the inventory cannot be exported as configured
+    pass
@@ -0,0 +1,132 @@
+import json
+import os
+import time
+import hashlib
+import datetime
+import logging
+from botocore.exceptions import ClientError
+from common import get_s3_client
+from serialization import canonical_dumps
+
+
+# Setup Logging
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+
+# Keys that change on every run without the resource changing, left out of the content hash
+IGNORED_KEYS = ['configurationItemCaptureTime']
+
+
+def incremental_enabled():
+    """Incremental inventory is switched on with INCREMENTAL_INVENTORY=True"""
+    return os.environ.get('INCREMENTAL_INVENTORY', "False") == "True"
+
+
+def content_hash(resource, ignore=IGNORED_KEYS):
+    """Returns a stable hash of a resource's content, ignoring the top level keys in ignore"""
+    if isinstance(resource, dict):
+        resource = {k: v for k, v in resource.items() if k not in ignore}
+    body = canonical_dumps(resource)
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+
+class ResourceManifest(object):
+    """
+    Compact record of what was last written for one subscription and resource prefix, saved to
+    Azure-Resources/manifests/<prefix>/<subscription_id>.json as {resource id: [content hash, object id, written at]}
+    An inventory that stops part way through also saves the ids it has seen so far under a state id, which can run
+    past the size of a queue message, so the invocation that carries on can still tell what has been removed.
+    """
+    def __init__(self, prefix, subscription_id, entries=None, pending=None):
+        self.prefix = prefix
+        self.subscription_id = subscription_id
+        self.entries = entries or {}
+        self.pending = pending
+        self.seen = set()
+        self.max_age = int(os.environ.get('INCREMENTAL_MAX_AGE_HOURS', 168)) * 3600
+
+    def __repr__(self):
+        return("<Antiope.ResourceManifest {} {} ({} resources)>".format(self.prefix, self.subscription_id, len(self.entries)))
+
+    @property
+    def object_key(self):
+        return("Azure-Resources/manifests/{}/{}.json".format(self.prefix, self.subscription_id))
+
+    def changed(self, resource_id, digest, now=None):
+        """
+        Marks the resource as seen and returns True if it is new, its hash differs from the last write, or it has not
+        been written for INCREMENTAL_MAX_AGE_HOURS (so changes the hash cannot see are still picked up eventually)
+        """
+        now = now or int(time.time())
+        resource_id = resource_id.lower()
+        self.seen.add(resource_id)
+
+        entry = self.entries.get(resource_id)
+        if entry is None or entry[0] != digest:
+            return True
+        return now - entry[2] >= self.max_age
+
+    def record(self, resource_id, digest, object_id, now=None):
+        """Remember that the resource was written with this hash"""
+        self.entries[resource_id.lower()] = [digest, object_id, now or int(time.time())]
+
+    def removed(self):
+        """Returns {resource id: object id} for resources in the manifest that were not seen on this run, and forgets them"""
+        removed = {}
+        for resource_id in [r for r in self.entries if r not in self.seen]:
+            removed[resource_id] = self.entries.pop(resource_id)[1]
+        return removed
+
+    def restore_seen(self, state_id):
+        """Carry on from the resources seen by the earlier invocation that saved the manifest under state_id"""
+        if self.pending and self.pending.get('state_id') == state_id:
+            self.seen.update(self.pending['seen'])
+        else:
+            logger.warning("No seen resources saved under {} for {} {}, deletions will not be detected".format(state_id, self.prefix, self.subscription_id))
+            self.pending = {'state_id': None, 'seen': []}
+
+    def save(self, state_id=None):
+        """Write the manifest back to S3, with the resources seen so far when state_id is given"""
+        body = {'resources': self.entries}
+        if state_id:
+            body['pending'] = {'state_id': state_id, 'seen': sorted(self.seen)}
+        get_s3_client().put_object(
+            Body=json.dumps(body, separators=(',', ':')),
+            Bucket=os.environ['INVENTORY_BUCKET'],
+            ContentType='application/json',
+            Key=self.object_key,
+        )
+
+
+def load_manifest(prefix, subscription_id):
+    """Returns the ResourceManifest for the subscription, empty if there is none yet"""
+    manifest = ResourceManifest(prefix, subscription_id)
+    try:
+        response = get_s3_client().get_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=manifest.object_key)
+        body = json.loads(response['Body'].read())
+        manifest.entries = body['resources']
+        manifest.pending = body.get('pending')
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        logger.info("No manifest for {} {} yet, everything will be written".format(prefix, subscription_id))
+    return manifest
+
+
+def delete_marker(target_sub, resource_type, resource_id, azure_resource_id):
+    """Returns the record written in place of a resource that no longer exists"""
+    resource_item = {}
+    resource_item['azureSubscriptionId']            = target_sub.subscription_id
+    resource_item['azureSubscriptionName']          = target_sub.display_name
+    resource_item['azureTenantId']                  = target_sub.tenant_id
+    resource_item['azureTenantName']                = target_sub.tenant_name
+    resource_item['resourceType']                   = resource_type
+    resource_item['source']                         = "Antiope"
+    resource_item['configurationItemCaptureTime']   = str(datetime.datetime.now())
+    resource_item['configurationItemStatus']        = "ResourceDeleted"
+    resource_item['resourceId']                     = resource_id
+    resource_item['azureResourceId']                = azure_resource_id
+    return resource_item
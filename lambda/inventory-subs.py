@@ -2,11 +2,14 @@ import json
 import os
 import time
 import logging
+import threading
 import boto3
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from botocore.exceptions import ClientError
 from common import *
 from subscription import *
-from azure.mgmt.subscription import SubscriptionClient
+from metrics import metrics
+from serialization import to_json_native, to_dynamodb
 
 
 # Setup Logging
@@ -19,57 +22,98 @@ logging.getLogger('boto3').setLevel(logging.WARNING)
 
 def handler(event, context):
     logger.info("Received event: " + json.dumps(event, sort_keys=True))
+    try:
+        dynamodb = boto3.resource('dynamodb')
+        subscription_table = dynamodb.Table(os.environ['SUBSCRIPTION_TABLE'])
+
+        azure_secrets = get_azure_creds(os.environ['AZURE_SECRET_NAME'])
+
+        if azure_secrets is None:
+            raise Exception("Unable to extract Azure Credentials. Aborting...")
+
+        # Discover each tenant's subscriptions concurrently. A failing tenant is reported and skipped rather than aborting the run.
+        tenant_results = {}
+        with ThreadPoolExecutor(max_workers=int(os.environ.get('TENANT_DISCOVERY_THREADS', 8))) as executor:
+            futures = {executor.submit(timed_discovery, tenant, credential_info): tenant for tenant, credential_info in azure_secrets.items()}
+
+            for future in as_completed(futures):
+                tenant = futures[future]
+                try:
+                    tenant_results[tenant] = future.result()
+                except Exception as e:
+                    logger.error("Unable to discover subscriptions for tenant {}: {}".format(tenant, e))
+                    capture_error(event, context, e, "Unable to discover subscriptions for tenant {}".format(tenant))
+
+        # Merge in tenant name order so the output does not depend on which tenant answered first
+        collected_subs = []
+        subscription_dicts = []
+        for tenant in sorted(tenant_results):
+            for subscription_dict in tenant_results[tenant]:
+                subscription_dicts.append(subscription_dict)
 
-    dynamodb = boto3.resource('dynamodb')
-    subscription_table = dynamodb.Table(os.environ['SUBSCRIPTION_TABLE'])
+                # Keep track of all valid subscriptions
+                if subscription_dict["queryable"] == 'true':
+                    collected_subs.append(subscription_dict["subscription_id"])
 
-    azure_secrets = get_azure_creds(os.environ['AZURE_SECRET_NAME'])
-    
-    if azure_secrets is None:
-        raise Exception("Unable to extract Azure Credentials. Aborting...")
+        if not collected_subs:
+            raise Exception("No Subscriptions found. Aborting...")
 
-    collected_subs = []
-    for tenant, credential_info in azure_secrets.items():
+        # Add new and changed subscriptions to DynamoDB subscriptions table.
+        with metrics.span("SubscriptionTableUpdate"):
+            bulk_update_subscriptions(subscription_dicts, subscription_table)
+        metrics.count("Subscriptions", len(subscription_dicts))
 
-        azure_creds = ServicePrincipalCredentials(
-            client_id=credential_info["application_id"],
-            secret=credential_info["key"],
-            tenant=credential_info["tenant_id"]
-        )
+        # Return only valid subscription ID's to be sent via SNS by inventory trigger function
+        event['subscription_list'] = collected_subs
+        return(event)
+    finally:
+        # Written out whether the handler returns or raises
+        metrics.flush()
 
-        resource_client = SubscriptionClient(azure_creds)
-        
-        for subscription in resource_client.subscriptions.list():
 
-            # Some subscrption ID's retured by the API are not queryable, this seems like a bug with MS API.
-            # There may also be a better way of determining this...
-            queryable = 'false'
+def timed_discovery(tenant, credential_info):
+    """discover_tenant_subscriptions(), recorded as the tenant's TenantDiscovery metric"""
+    with metrics.span("TenantDiscovery", Tenant=credential_info.get("tenant_id")):
+        return(discover_tenant_subscriptions(tenant, credential_info))
+
+
+def discover_tenant_subscriptions(tenant, credential_info):
+    """Returns a subscription_dict for each subscription the tenant's service principal can see"""
+    ServicePrincipalCredentials = load_sdk_class("msrestazure.azure_active_directory", "ServicePrincipalCredentials")
+    SubscriptionClient = load_sdk_class("azure.mgmt.subscription", "SubscriptionClient")
+
+    azure_creds = ServicePrincipalCredentials(
+        client_id=credential_info["application_id"],
+        secret=credential_info["key"],
+        tenant=credential_info["tenant_id"]
+    )
+
+    resource_client = SubscriptionClient(azure_creds)
+
+    subscription_dicts = []
+    for subscription in resource_client.subscriptions.list():
+
+        # Some subscrption ID's retured by the API are not queryable, this seems like a bug with MS API.
+        # There may also be a better way of determining this...
+        queryable = 'false'
+        
+        if 'Access to Azure Active Directory' not in subscription.display_name:
+            queryable = 'true'
             
-            if 'Access to Azure Active Directory' not in subscription.display_name:
-                
-                # Keep track of all valid subscriptions
-                collected_subs.append(subscription.subscription_id)
-                queryable = 'true'
-                
-            subscription_dict = {
-                "subscription_id": subscription.subscription_id,
-                "display_name": subscription.display_name,
-                "state": subscription.state,
-                "SubscriptionClass": json.loads(json.dumps(subscription, default=str)),
-                "tenant_id": credential_info["tenant_id"],
-                "tenant_name": tenant,
-                "queryable": queryable
-            }
+        subscription_dict = {
+            "subscription_id": subscription.subscription_id,
+            "display_name": subscription.display_name,
+            "state": subscription.state,
+            "SubscriptionClass": to_dynamodb(subscription),
+            "tenant_id": credential_info["tenant_id"],
+            "tenant_name": tenant,
+            "queryable": queryable
+        }
 
-            # Add subscriptions to DynamoDB subscriptions table.
-            create_or_update_subscription(subscription_dict, subscription_table)
+        subscription_dicts.append(subscription_dict)
 
-        if collected_subs is None:
-            raise Exception("No Subscriptions found. Aborting...")
-    
-    # Return only valid subscription ID's to be sent via SNS by inventory trigger function
-    event['subscription_list'] = collected_subs
-    return(event)
+    logger.info("Found {} subscriptions in tenant {}".format(len(subscription_dicts), tenant))
+    return(subscription_dicts)
 
 
 def create_or_update_subscription(subscription, subscription_table):
@@ -95,5 +139,55 @@ def create_or_update_subscription(subscription, subscription_table):
         logger.critical(f"Subscription {subscription} is missing a key: {e}")
 
 
+
+# Map of subscription_dict keys to the attribute they are stored as in the subscriptions table
+SUBSCRIPTION_ATTRIBUTES = {
+    "display_name":         "display_name",
+    "state":                "subscription_state",
+    "SubscriptionClass":    "SubscriptionClass",
+    "tenant_id":            "tenant_id",
+    "tenant_name":          "tenant_name",
+    "queryable":            "queryable"
+}
+
+
+def bulk_update_subscriptions(subscriptions, subscription_table):
+    """
+    Write only the subscriptions that are new or changed since the last run. The table is read once with a scan and
+    the writes run concurrently. Unchanged records are left alone, which also keeps them off the DynamoDB stream.
+    """
+    dynamodb = boto3.resource('dynamodb')
+    existing = {}
+    for record in scan_subscription_records(dynamodb, table_name=subscription_table.name):
+        existing[record['subscription_id']] = record
+
+    changed = [s for s in subscriptions if subscription_changed(s, existing.get(s["subscription_id"]))]
+    logger.info("{} of {} subscriptions are new or changed".format(len(changed), len(subscriptions)))
+    if not changed:
+        return
+
+    # boto3 resources are not thread safe, so each worker gets its own Table
+    local = threading.local()
+
+    def update(subscription):
+        if not hasattr(local, 'table'):
+            local.table = boto3.resource('dynamodb').Table(subscription_table.name)
+        create_or_update_subscription(subscription, local.table)
+
+    with ThreadPoolExecutor(max_workers=int(os.environ.get('DDB_WRITE_THREADS', 10))) as executor:
+        # list() so the first failed write is raised here
+        list(executor.map(update, changed))
+
+
+def subscription_changed(subscription, record):
+    """Returns True if the subscription_dict differs from the record already in the table, or there is no record"""
+    if record is None:
+        return True
+    for key, attribute in SUBSCRIPTION_ATTRIBUTES.items():
+        if to_json_native(subscription.get(key)) != to_json_native(record.get(attribute)):
+            return True
+    return False
+
+
 class AccountUpdateError(Exception):
     '''raised when an update to DynamoDB Fails'''
@@ -7,6 +7,12 @@ import logging
 import datetime
 from common import *
 from subscription import *
+from collectors import run_collectors
+from pipeline import run_collectors_async, pipeline_enabled
+from shards import get_resource_writer
+from run_tracker import get_run_table, mark_group_done, extend_deadline
+from dispatch import send_to_queue, requeue_if_early
+from metrics import metrics
 
 # Setup Logging
 logger = logging.getLogger()
@@ -16,123 +22,176 @@ logging.getLogger('boto3').setLevel(logging.WARNING)
 
 def lambda_handler(event, context):
     logger.info("Received event: " + json.dumps(event, sort_keys=True))
-    message = json.loads(event['Records'][0]['Sns']['Message'])
-    logger.info("Received message: " + json.dumps(message, sort_keys=True))
+    try:
+        message = parse_message(event['Records'][0])
+        logger.info("Received message: " + json.dumps(message, sort_keys=True))
 
-    for sub in message['subscription_id']:
-        
+        # A group scheduled further out than SQS can delay a message goes round the queue again until it is due
+        if requeue_if_early(message, os.environ['DISPATCH_QUEUE_URL']):
+            return
+
+        # Subscriptions in the same tenant share a service principal, so they can be covered by one resource graph query
+        tenant_groups = {}
+
+        # A continuation of an earlier invocation that ran out of time carries on its unfinished query from the skip token
+        resume = message.get('resume')
+        resume_subs = []
+
+        # Load every subscription in the group from DynamoDB at once
         try:
-            # Create an antiope instance for this subscription
-            target_sub = AntiopeAzureSubscription(sub)
-        
-            # Fetch the service principal info from Secrets Manager and authenticate
-            target_sub.authenticate(os.environ['AZURE_SECRET_NAME'])
-        
-            # Management Client
-            management_client = target_sub.get_client("ResourceGraphClient")
-    
-            # Query
-            query = """Resources
-                       | where type == 'microsoft.compute/virtualmachines'
-                       | project id, properties
-                    """
-        
-            # Call Resource Graph API
-            vm_count, status, vm_list = graph_resource_query(query, target_sub, management_client)
-    
-            # Cycle through the list of virtual machines, extract information, and save as a json file to S3
-            if status == '200' and vm_count > 0:
-                logger.info("Subscription {} has {} virtual machines".format(target_sub.subscription_id, vm_count))
-            
-                for vm in vm_list:
-                    process_instances(target_sub, vm, management_client)
-            
-            elif status=='200' and vm_count == 0:
-                logger.info("No virtual machines found for subscription {}({}), skipping".format(target_sub.display_name,target_sub.subscription_id))
-                
-            else:
-                logger.error("Error getting virtual machine information for subscription {}({}), exiting".format(target_sub.display_name, target_sub.subscription_id))
-                raise ClientError(f"Error getting virtual machine information for subscription {target_sub.display_name}({target_sub.subscription_id})")
-            
-        except ServicePrincipalError as e:
-            logger.error("Event: ServicePrincipalError, Context: {}, Error: {}, Subscription {}({})".format(vars(context), e, target_sub.display_name, target_sub.subscription_id))
-            capture_error("ServicePrincipalError", context, e, "Subscription: {}({})".format(target_sub.display_name, target_sub.subscription_id))
-    
-        except ClientError as e:
-            logger.error("Event: ClientError, Context: {}, Error: {}, Message: Subscription: {}({})".format(vars(context), e, target_sub.display_name, target_sub.subscription_id))
-            capture_error("ClientError", context, e, "Subscription: {}({})".format(target_sub.display_name, target_sub.subscription_id))
-    
-        except NotImplementedError as e:
-            logger.error("Event: NotImplementedError, Context: {}, Error: {}, Message: Subscription: {}({})".format(vars(context), e, target_sub.display_name, target_sub.subscription_id))
-            capture_error("ClientError", context, e, "Subscription: {}({})".format(target_sub.display_name, target_sub.subscription_id))
-    
+            subscriptions = load_subscriptions(message['subscription_id'])
         except Exception as e:
-            logger.error("Event: General Exception, Context: {}, Error: {}, Message: Subscription: {}".format(vars(context), e, sub))
-            capture_error("General Exception", context, e, "Subscription: {}".format(sub))
-
-
-def process_instances(target_sub, vm, management_client):
-
-    # Virtual Machine Resource and Machine ID
-    id = vm['id']
-    vmid = vm['properties']['vmId']
-                    
-    # Network Interface Details
-    query = f"""Resources 
-                | where type == 'microsoft.compute/virtualmachines' 
-                | where id == '{id}' 
-                | mvexpand nic = properties.networkProfile.networkInterfaces 
-                | extend nicId = tostring(nic.id) 
-                | project resourceGroup, properties, nicId 
-                  | join kind=leftouter (Resources 
-                    | where type == 'microsoft.network/networkinterfaces' 
-                    | mvexpand ipconfig=properties.ipConfigurations 
-                    | extend publicIpId = tostring(ipconfig.properties.publicIPAddress.id) 
-                    | project nicId = id, resourceGroup, privateNetworkInterfaceName = name, privateNetworkProperties = properties, publicIpId
-                    ) on nicId 
-                  | join kind=leftouter (Resources 
-                    | where type =~ 'microsoft.network/publicipaddresses' 
-                    | project publicIpId = id, publicNetworkInterfaceName = name, publicNetworkProperties = properties, resourceGroup
-                    ) on publicIpId 
-                | project-away publicIpId1
-                | project-away nicId1
-                | project nicId, resourceGroup, privateNetworkInterfaceName, privateNetworkProperties, publicIpId, publicNetworkInterfaceName, publicNetworkProperties
-            """
-    
-    # Call API
-    logger.info("Processing subscription {}({}), virtual machine {}".format(target_sub.subscription_id, target_sub.display_name, vmid))
-    count, status, vm_network = graph_resource_query(query, target_sub, management_client)
-    
-    if status == '200':
-        # Build JSON Object
-        resource_item = {}
-        resource_item['azureSubscriptionId']            = target_sub.subscription_id
-        resource_item['azureSubscriptionName']          = target_sub.display_name
-        resource_item['azureTenantId']                  = target_sub.tenant_id
-        resource_item['azureTenantName']                = target_sub.tenant_name
-        resource_item['resourceType']                   = "Azure::Compute::VM"
-        resource_item['source']                         = "Antiope"
-        resource_item['configurationItemCaptureTime']   = str(datetime.datetime.now())
-        resource_item['configuration']                  = vm
-        resource_item['supplementaryConfiguration']     = {}
-        resource_item['azureRegion']                    = "unknown"
-        resource_item['resourceId']                     = vmid
-        resource_item['resourceCreationTime']           = "unknown"
-        resource_item['errors']                         = {}
-        
-        # Work around for API, sometimes on some subscriptions/virtual machines the location does not return a value.        
-        if 'location' in vm: 
-            resource_item['azureRegion']                = vm['location']
-        
-        # Set network info   
-        if vm_network:
-            resource_item['supplementaryConfiguration']['NetworkInterfaces'] = vm_network
-                    
-        # Save to S3
-        logger.info("Writing virtual machine info for subscription {}({}) to S3".format(target_sub.display_name,target_sub.subscription_id))
-        save_resource_to_s3("vm/instance", vmid, resource_item)
-
-    else:
-        logger.error("Unable to complete virtual machine processing {}({})".format(target_sub.display_name, target_sub.subscription_id))
-        raise ClientError(f"Error getting virtual machine information for subscription {target_sub.display_name}({target_sub.subscription_id})")
+            logger.error("Event: General Exception, Context: {}, Error: {}, Message: Subscriptions: {}".format(vars(context), e, message['subscription_id']))
+            capture_error("General Exception", context, e, "Subscriptions: {}".format(message['subscription_id']))
+            raise
+
+        for target_sub in subscriptions:
+            sub = target_sub.subscription_id
+
+            try:
+                # Fetch the service principal info from Secrets Manager and authenticate
+                target_sub.authenticate(os.environ['AZURE_SECRET_NAME'])
+
+                if resume and sub in resume['subscription_id']:
+                    resume_subs.append(target_sub)
+                else:
+                    tenant_groups.setdefault(target_sub.tenant_name, []).append(target_sub)
+
+            except ServicePrincipalError as e:
+                logger.error("Event: ServicePrincipalError, Context: {}, Error: {}, Subscription {}({})".format(vars(context), e, target_sub.display_name, target_sub.subscription_id))
+                capture_error("ServicePrincipalError", context, e, "Subscription: {}({})".format(target_sub.display_name, target_sub.subscription_id))
+
+            except Exception as e:
+                logger.error("Event: General Exception, Context: {}, Error: {}, Message: Subscription: {}".format(vars(context), e, sub))
+                capture_error("General Exception", context, e, "Subscription: {}".format(sub))
+
+        # Save resources to S3 concurrently, sharing one pooled client across the whole invocation.
+        # OUTPUT_FORMAT picks one object per resource or compressed ndjson shards per subscription.
+        writer = get_resource_writer(run_id=message.get('run_id'), run_date=message.get('run_date'))
+
+        # Each piece of work is (subscriptions, skip token to start from, state carried from the earlier invocation)
+        work = [(target_subs, None, None) for target_subs in tenant_groups.values()]
+        if resume_subs:
+            work.insert(0, (resume_subs, resume['skip_token'], resume.get('state')))
+
+        out_of_time = time_budget(context)
+
+        # PIPELINE_MODE=async overlaps the resource graph queries with enrichment and the S3 writes
+        collect = run_collectors_async if pipeline_enabled() else run_collectors
+        continuation = None
+
+        for i, (target_subs, skip_token, resume_state) in enumerate(work):
+            description = describe_subscriptions(target_subs)
+
+            # Always get through at least one piece of work, so every continuation makes progress
+            if i > 0 and out_of_time():
+                continuation = build_continuation(message, work[i:])
+                break
+
+            try:
+                # Management Client
+                management_client = target_subs[0].get_client("ResourceGraphClient")
+
+                # Run every enabled collector (virtual machines, storage accounts, ...) over the group in one pass
+                with metrics.span("Collect", Tenant=target_subs[0].tenant_id):
+                    result = collect(target_subs, management_client, writer, skip_token=skip_token, should_stop=out_of_time, resume_state=resume_state)
+
+                # Wait for this group's writes so failures are reported against the right subscriptions
+                failures = writer.flush()
+                if failures:
+                    raise ResourceWriteError("{} of the objects for {} could not be saved to S3, first error: {}".format(len(failures), description, failures[0][1]))
+
+                if result.skip_token:
+                    continuation = build_continuation(message, work[i + 1:], resume=(target_subs, result.skip_token, result.resume_state))
+                    break
+
+                # Keep how big each subscription is so the next run can plan its groups, see planner.plan_groups().
+                # A resumed query is complete once its last page is read, the earlier pages' counts are carried in its state.
+                if result.complete:
+                    save_resource_counts(target_subs, result.resource_counts)
+
+            except ResourceWriteError as e:
+                logger.error("Event: ResourceWriteError, Context: {}, Error: {}, Message: {}".format(vars(context), e, description))
+                capture_error("ResourceWriteError", context, e, description)
+
+            except ResourceGraphQueryError as e:
+                logger.error("Event: ResourceGraphQueryError, Context: {}, Error: {}, Message: {}".format(vars(context), e, description))
+                capture_error("ResourceGraphQueryError", context, e, description)
+
+            except ServicePrincipalError as e:
+                logger.error("Event: ServicePrincipalError, Context: {}, Error: {}, Message: {}".format(vars(context), e, description))
+                capture_error("ServicePrincipalError", context, e, description)
+
+            except ClientError as e:
+                logger.error("Event: ClientError, Context: {}, Error: {}, Message: {}".format(vars(context), e, description))
+                capture_error("ClientError", context, e, description)
+
+            except NotImplementedError as e:
+                logger.error("Event: NotImplementedError, Context: {}, Error: {}, Message: {}".format(vars(context), e, description))
+                capture_error("ClientError", context, e, description)
+
+            except Exception as e:
+                logger.error("Event: General Exception, Context: {}, Error: {}, Message: {}".format(vars(context), e, description))
+                capture_error("General Exception", context, e, description)
+
+        failures = writer.close()
+        if failures:
+            logger.error("{} objects could not be saved to S3 when closing the writer, first error: {}".format(len(failures), failures[0][1]))
+
+        # Hand what is left to another invocation, the group is not finished until that one is
+        if continuation:
+            logger.warning("Running out of time, continuing {} subscription(s) in another invocation".format(len(continuation['subscription_id'])))
+            # Keep the step function waiting for the continuation rather than reporting without it
+            if 'run_id' in message:
+                extend_deadline(get_run_table(), message['run_id'])
+            send_to_queue([(0, continuation)], os.environ['DISPATCH_QUEUE_URL'])
+            metrics.count("Continuations")
+            return
+
+        # Let the step function know this group is finished, errors above have already been captured
+        if 'run_id' in message:
+            mark_group_done(get_run_table(), message['run_id'], message['group_id'])
+    finally:
+        # Written out whether the handler returns or raises
+        metrics.flush()
+
+
+def parse_message(record):
+    """Subscription groups arrive from the dispatch queue, or straight from the SNS topic"""
+    if 'Sns' in record:
+        return json.loads(record['Sns']['Message'])
+    return json.loads(record['body'])
+
+
+def time_budget(context):
+    """Returns a function that is True once there is less than CHECKPOINT_RESERVE_SECONDS left of this invocation"""
+    reserve = int(os.environ.get('CHECKPOINT_RESERVE_SECONDS', 120)) * 1000
+    return lambda: context.get_remaining_time_in_millis() < reserve
+
+
+def save_resource_counts(target_subs, resource_counts):
+    """Save each subscription's resource count, skipping the write when the record already has it"""
+    for target_sub in target_subs:
+        count = resource_counts.get(target_sub.subscription_id.lower(), 0)
+        if target_sub.db_record.get('resource_count') != count:
+            target_sub.update_attribute(os.environ['SUBSCRIPTION_TABLE'], "resource_count", count)
+
+
+def build_continuation(message, remaining, resume=None):
+    """
+    The message for another invocation to finish this one's work
+    :param remaining: list of (subscriptions, skip token, resume state) not started yet
+    :param resume: (subscriptions, skip token, resume state) of the query that was stopped part way through
+    """
+    continuation = dict(message)
+    continuation['subscription_id'] = [sub.subscription_id for target_subs, skip_token, resume_state in remaining for sub in target_subs]
+    continuation['continuation'] = message.get('continuation', 0) + 1
+    continuation.pop('resume', None)
+
+    if resume:
+        resume_subs, skip_token, resume_state = resume
+        continuation['subscription_id'] = [sub.subscription_id for sub in resume_subs] + continuation['subscription_id']
+        continuation['resume'] = {'subscription_id': [sub.subscription_id for sub in resume_subs], 'skip_token': skip_token, 'state': resume_state}
 
+    logger.info("Continuation message: " + json.dumps(continuation, sort_keys=True))
+    return continuation
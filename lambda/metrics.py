@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+
+# Setup Logging
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+
+# CloudWatch allows at most 100 metrics in one Embedded Metric Format directive
+EMF_MAX_METRICS = 100
+
+
+class MetricsLogger(object):
+    """
+    Collects timings and counters in memory during an invocation and writes them out as CloudWatch Embedded Metric
+    Format log lines on flush(), one line per set of dimensions. Values with the same name and dimensions are summed,
+    so recording costs a dict update and logging costs one line per tenant or subscription, not one per call.
+    Switched off with METRICS_ENABLED=False.
+    """
+    def __init__(self, namespace=None, emit=print, clock=time.monotonic):
+        self.namespace = namespace or os.environ.get('METRICS_NAMESPACE', "Antiope/Azure")
+        self.enabled = os.environ.get('METRICS_ENABLED', "True") == "True"
+        self.emit = emit
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.values = {}
+        self.units = {}
+
+    def count(self, name, value=1, unit="Count", **dimensions):
+        """Add value to the named metric for these dimensions, Tenant= and Subscription= for example"""
+        if not self.enabled:
+            return
+        key = tuple(sorted((k, str(v)) for k, v in dimensions.items() if v is not None))
+        with self.lock:
+            metrics = self.values.setdefault(key, {})
+            metrics[name] = metrics.get(name, 0) + value
+            self.units[name] = unit
+
+    @contextmanager
+    def span(self, name, **dimensions):
+        """Time the block, adding its milliseconds to <name>Time and one to <name>Count"""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.count(name + "Time", (self.clock() - start) * 1000, unit="Milliseconds", **dimensions)
+            self.count(name + "Count", 1, **dimensions)
+
+    def payloads(self, timestamp=None, reset=False):
+        """Returns the EMF documents for everything recorded since the last flush, starting afresh if reset is True"""
+        timestamp = timestamp or int(time.time() * 1000)
+        function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', "local")
+        with self.lock:
+            values = self.values
+            units = dict(self.units)
+            if reset:
+                self.values = {}
+
+        documents = []
+        for key, metrics in sorted(values.items()):
+            names = sorted(metrics)
+            for i in range(0, len(names), EMF_MAX_METRICS):
+                document = {
+                    '_aws': {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [{
+                            'Namespace': self.namespace,
+                            'Dimensions': [["Function"] + [k for k, v in key]],
+                            'Metrics': [{'Name': name, 'Unit': units[name]} for name in names[i:i + EMF_MAX_METRICS]]
+                        }]
+                    },
+                    'Function': function_name
+                }
+                document.update(dict(key))
+                document.update({name: metrics[name] for name in names[i:i + EMF_MAX_METRICS]})
+                documents.append(document)
+        return documents
+
+    def flush(self):
+        """Write out and reset everything recorded so far. Called at the end of each handler."""
+        if not self.enabled:
+            return
+        try:
+            for document in self.payloads(reset=True):
+                self.emit(json.dumps(document, separators=(',', ':')))
+        except Exception as e:
+            logger.error("Unable to write metrics: {}".format(e))
+
+
+# Shared by every module in this container, flushed by the handlers
+metrics = MetricsLogger()
@@ -0,0 +1,145 @@
+import os
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from common import graph_resource_query_pages, describe_subscriptions
+from collectors import enabled_collectors, Collection, CollectionResult
+
+
+# Setup Logging
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+
+# Put on a queue to tell the next stage there is nothing more coming
+_DONE = object()
+
+
+def pipeline_enabled():
+    """The async pipeline is switched on with PIPELINE_MODE=async"""
+    return os.environ.get('PIPELINE_MODE', "sync") == "async"
+
+
+def run_collectors_async(target_subs, management_client, writer, collectors=None, skip_token=None, should_stop=None, resume_state=None):
+    """
+    Same as collectors.run_collectors(), but with the resource graph paging, enrichment queries and writes overlapped
+    in a CollectorPipeline, so the next page is being fetched while the last one is enriched and saved.
+    Runs its own event loop and returns once everything is done, so it can be called from a normal lambda handler.
+    """
+    if collectors is None:
+        collectors = enabled_collectors()
+    if not collectors:
+        logger.warning("No collectors enabled for {}".format(describe_subscriptions(target_subs)))
+        return CollectionResult({}, None, True, None)
+
+    collection = Collection(target_subs, collectors, writer, skip_token=skip_token, resume_state=resume_state)
+    pipeline = CollectorPipeline(collection, management_client, should_stop=should_stop)
+
+    # python3.6 has no asyncio.run()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(pipeline.run(loop))
+    finally:
+        loop.close()
+
+    return collection.finish()
+
+
+class CollectorPipeline(object):
+    """
+    Three stages joined by bounded queues:
+      fetch   - pages through the resource graph query and routes each page's rows into batches, one page at a time
+                since each page needs the skip token of the one before
+      enrich  - PIPELINE_ENRICH_WORKERS workers running the collectors' enrichment queries
+      write   - builds the resource_items and hands them to the writer, whose own threads serialize and upload them.
+    A full queue holds up the stage feeding it, so no more than PIPELINE_QUEUE_SIZE batches wait between two stages.
+    The Azure and S3 clients are synchronous, so every call to them is run on the pipeline's thread pool.
+    The shard writer and the Collection's counts and manifests are not thread safe, so routing pages and writing
+    batches both run on a single collection thread of their own, one call at a time.
+    """
+    def __init__(self, collection, management_client, should_stop=None, enrich_workers=None, queue_size=None):
+        self.collection = collection
+        self.management_client = management_client
+        self.should_stop = should_stop
+        self.enrich_workers = enrich_workers or int(os.environ.get('PIPELINE_ENRICH_WORKERS', 4))
+        self.queue_size = queue_size or int(os.environ.get('PIPELINE_QUEUE_SIZE', 8))
+
+    async def run(self, loop):
+        self.loop = loop
+        # One thread per enrich worker plus the fetch stage, and one for everything that touches the Collection
+        self.executor = ThreadPoolExecutor(max_workers=self.enrich_workers + 1)
+        self.collection_executor = ThreadPoolExecutor(max_workers=1)
+
+        # Created here rather than in __init__ so they belong to the running loop
+        batches = asyncio.Queue(maxsize=self.queue_size)
+        enriched = asyncio.Queue(maxsize=self.queue_size)
+
+        tasks = [loop.create_task(self.fetch(batches))]
+        tasks += [loop.create_task(self.enrich(batches, enriched)) for i in range(self.enrich_workers)]
+        tasks.append(loop.create_task(self.write(enriched)))
+
+        try:
+            await asyncio.gather(*tasks)
+        except Exception:
+            # One stage failing would leave the others waiting on their queues forever
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            self.executor.shutdown(wait=True)
+            self.collection_executor.shutdown(wait=True)
+
+    async def offload(self, func, *args):
+        """Run a blocking call on the pipeline's thread pool"""
+        return await self.loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def offload_collection(self, func, *args):
+        """Run a call that reads or updates the Collection on its thread, after any earlier one has finished"""
+        return await self.loop.run_in_executor(self.collection_executor, functools.partial(func, *args))
+
+    async def fetch(self, batches):
+        collection = self.collection
+        pages = graph_resource_query_pages(collection.query, collection.target_subs, self.management_client, skip_token=collection.skip_token)
+
+        while True:
+            page = await self.offload(next, pages, None)
+            if page is None:
+                break
+
+            for batch in await self.offload_collection(collection.route, page):
+                await batches.put(batch)
+
+            if collection.skip_token and self.should_stop and self.should_stop():
+                logger.warning("Stopping {} before the next page of resources".format(describe_subscriptions(collection.target_subs)))
+                break
+
+        for i in range(self.enrich_workers):
+            await batches.put(_DONE)
+
+    async def enrich(self, batches, enriched):
+        while True:
+            item = await batches.get()
+            if item is _DONE:
+                await enriched.put(_DONE)
+                return
+
+            collector, batch = item
+            supplementary = {}
+            if collector.enrich:
+                supplementary = await self.offload(collector.enrich, self.collection.target_subs, batch, self.management_client)
+            await enriched.put((collector, batch, supplementary))
+
+    async def write(self, enriched):
+        finished = 0
+        while finished < self.enrich_workers:
+            item = await enriched.get()
+            if item is _DONE:
+                finished += 1
+                continue
+
+            collector, batch, supplementary = item
+            await self.offload_collection(self.collection.write_batch, collector, batch, supplementary)
@@ -0,0 +1,106 @@
+import os
+import math
+import logging
+
+from retry_policy import TENANT_QUOTA, TENANT_QUOTA_WINDOW
+
+
+# Setup Logging
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+
+# Every subscription costs at least this much, for authentication, the queries themselves and the manifest
+SUBSCRIPTION_BASE_COST = 50
+
+
+def estimate_work(target_sub, default_count=None):
+    """
+    Estimated cost of inventorying a subscription, in resources. Uses the resource_count saved by the last run,
+    or DEFAULT_RESOURCE_ESTIMATE for subscriptions that have not been inventoried yet.
+    """
+    if default_count is None:
+        default_count = int(os.environ.get('DEFAULT_RESOURCE_ESTIMATE', 500))
+
+    count = getattr(target_sub, 'resource_count', None)
+    if count is None:
+        count = default_count
+    return SUBSCRIPTION_BASE_COST + int(count)
+
+
+def estimate_graph_calls(target_sub, default_count=None):
+    """
+    Estimated number of Resource Graph queries inventorying a subscription takes: one per page of the resource
+    query (GRAPH_QUERY_PAGE_SIZE rows) and one per enrichment batch (ENRICH_BATCH_SIZE rows).
+    """
+    count = estimate_work(target_sub, default_count) - SUBSCRIPTION_BASE_COST
+    page_size = int(os.environ.get('GRAPH_QUERY_PAGE_SIZE', 1000))
+    batch_size = int(os.environ.get('ENRICH_BATCH_SIZE', 100))
+    return max(1, int(math.ceil(count / page_size))) + int(math.ceil(count / batch_size))
+
+
+def tenant_call_budget():
+    """
+    Resource Graph queries one tenant's token bucket (retry_policy.TokenBucket) lets through in a single invocation,
+    the LAMBDA_TIMEOUT less the CHECKPOINT_RESERVE_SECONDS the inventory lambda keeps to hand off a continuation.
+    """
+    seconds = int(os.environ.get('LAMBDA_TIMEOUT', 900)) - int(os.environ.get('CHECKPOINT_RESERVE_SECONDS', 120))
+    return max(TENANT_QUOTA, int(TENANT_QUOTA * max(seconds, 0) / TENANT_QUOTA_WINDOW))
+
+
+def plan_groups(subscriptions, budget=None, max_subs=None, max_per_tenant=None, call_budget=None):
+    """
+    Pack subscriptions into the groups sent to the inventory lambdas, so each group is about the same amount of work.
+    First fit decreasing: the biggest subscriptions are placed first, each into the first group that still has room.
+    A group has room while it is under the resource budget and, for the subscription's tenant, under the number of
+    Resource Graph queries the tenant's rate limit allows in one invocation (see tenant_call_budget()). Work that
+    does not fit in one invocation anyway is picked up by a continuation.
+    :param subscriptions: list of AntiopeAzureSubscription
+    :param budget: estimated resources a single lambda can get through, GROUP_RESOURCE_BUDGET
+    :param max_subs: most subscriptions in one group, NUM_SUBS_IN_GROUP
+    :param max_per_tenant: most subscriptions from one tenant in a group, so one group does not use up a tenant's
+                           resource graph quota, MAX_SUBS_PER_TENANT_IN_GROUP
+    :param call_budget: most Resource Graph queries against one tenant in a group, defaults to tenant_call_budget()
+    :return: list of lists of subscription_ids
+    """
+    if budget is None:
+        budget = int(os.environ.get('GROUP_RESOURCE_BUDGET', 20000))
+    if max_subs is None:
+        max_subs = int(os.environ['NUM_SUBS_IN_GROUP'])
+    if max_per_tenant is None:
+        max_per_tenant = int(os.environ.get('MAX_SUBS_PER_TENANT_IN_GROUP', max_subs))
+    if call_budget is None:
+        call_budget = tenant_call_budget()
+
+    work = {sub.subscription_id: estimate_work(sub) for sub in subscriptions}
+    calls = {sub.subscription_id: estimate_graph_calls(sub) for sub in subscriptions}
+    groups = []
+
+    # Sort on the subscription_id too so the plan is the same from run to run
+    for target_sub in sorted(subscriptions, key=lambda s: (-work[s.subscription_id], s.subscription_id)):
+        sub_work = work[target_sub.subscription_id]
+        sub_calls = calls[target_sub.subscription_id]
+        tenant = getattr(target_sub, 'tenant_name', None)
+
+        for group in groups:
+            if (group['work'] + sub_work <= budget and len(group['subscription_ids']) < max_subs
+                    and group['tenants'].get(tenant, 0) < max_per_tenant
+                    and group['calls'].get(tenant, 0) + sub_calls <= call_budget):
+                break
+        else:
+            if sub_work > budget:
+                logger.warning("Subscription {} is estimated at {} resources, more than the group budget of {}".format(target_sub.subscription_id, sub_work, budget))
+            group = {'work': 0, 'subscription_ids': [], 'tenants': {}, 'calls': {}}
+            groups.append(group)
+
+        group['work'] += sub_work
+        group['subscription_ids'].append(target_sub.subscription_id)
+        group['tenants'][tenant] = group['tenants'].get(tenant, 0) + 1
+        group['calls'][tenant] = group['calls'].get(tenant, 0) + sub_calls
+
+    for group_id, group in enumerate(groups):
+        logger.debug("Group {} has {} subscription(s) estimated at {} resources".format(group_id, len(group['subscription_ids']), group['work']))
+
+    return [group['subscription_ids'] for group in groups]
@@ -5,9 +5,12 @@ import datetime
 import logging
 import boto3
 from botocore.exceptions import ClientError
-from mako.template import Template
 from subscription import *
 from common import *
+from cost import collect_subscription_costs
+from metrics import metrics
+from serialization import dumps_bytes
+from reports import render_to_s3
 
 # Setup Logging
 logger = logging.getLogger()
@@ -27,59 +30,106 @@ logging.getLogger('boto3').setLevel(logging.WARNING)
 
 table_format = ["display_name", "subscription_id", "tenant_name", "cost", "subscription_state" ]
 
+REPORT_KEY = "Reports/azure_subscription_inventory"
+
+
 # Lambda main routine
 def handler(event, context):
     logger.info("Received event: " + json.dumps(event, sort_keys=True))
-
-    dynamodb = boto3.resource('dynamodb')
-    account_table = dynamodb.Table(os.environ['SUBSCRIPTION_TABLE'])
-
-
-    # We will make a HTML Table and a Json file with this data
-    table_data = ""
-    json_data = {'subscriptions': [] }
-
-    # Get and then sort the list of subscriptions by name, case insensitive.
-    subscription_list = get_active_subscriptions()
-    subscription_list.sort(key=lambda x: x.display_name.lower())
-
-    for subscription in subscription_list:
-        logger.info(f"{subscription.subscription_id}")
-        j = subscription.db_record.copy()
-        j['cost'] = "NotImplemented"
-        json_data['subscriptions'].append(j)
-
-
-    json_data['timestamp'] = datetime.datetime.now()
-    json_data['subscription_count'] = len(subscription_list)
-    json_data['bucket'] = os.environ['INVENTORY_BUCKET']
-
-    fh = open("html_templates/subscription_inventory.html", "r")
-    mako_body = fh.read()
-    result = Template(mako_body).render(**json_data)
-
-    s3_client = boto3.client('s3')
     try:
-        response = s3_client.put_object(
-            # ACL='public-read',
-            Body=result,
-            Bucket=os.environ['INVENTORY_BUCKET'],
-            ContentType='text/html',
-            Key='Reports/azure_subscription_inventory.html',
-        )
-
-        # Save the JSON to S3
-        response = s3_client.put_object(
-            # ACL='public-read',
-            Body=json.dumps(json_data, sort_keys=True, indent=2, default=str),
-            Bucket=os.environ['INVENTORY_BUCKET'],
-            ContentType='application/json',
-            Key='Reports/azure_subscription_inventory.json',
-        )
-    except ClientError as e:
-        logger.error("ClientError saving report: {}".format(e))
-        raise
-
-    return(event)
-
-
+        dynamodb = boto3.resource('dynamodb')
+        account_table = dynamodb.Table(os.environ['SUBSCRIPTION_TABLE'])
+
+
+        # We will make a HTML Table and a Json file with this data
+        table_data = ""
+        json_data = {'subscriptions': [] }
+
+        # Get and then sort the list of subscriptions by name, case insensitive.
+        subscription_list = get_active_subscriptions()
+        subscription_list.sort(key=lambda x: x.display_name.lower())
+
+        # Month to date cost of each subscription, cached per billing period on the subscription record
+        costs = collect_subscription_costs(subscription_list, os.environ['AZURE_SECRET_NAME'])
+
+        for subscription in subscription_list:
+            logger.info(f"{subscription.subscription_id}")
+            j = subscription.db_record.copy()
+            if subscription.subscription_id in costs:
+                j['cost'] = round(costs[subscription.subscription_id], 2)
+            else:
+                j['cost'] = "Unknown"
+            json_data['subscriptions'].append(j)
+
+
+        json_data['timestamp'] = datetime.datetime.now()
+        json_data['subscription_count'] = len(subscription_list)
+        json_data['bucket'] = os.environ['INVENTORY_BUCKET']
+
+        s3_client = boto3.client('s3')
+        try:
+            # The HTML is streamed to S3 as it renders, see reports.S3StreamWriter
+            if per_tenant_reports_enabled():
+                write_tenant_reports(json_data, s3_client)
+            else:
+                render_to_s3("subscription_inventory.html", REPORT_KEY + ".html", s3_client=s3_client, **json_data)
+
+            # Save the JSON to S3
+            response = s3_client.put_object(
+                # ACL='public-read',
+                Body=dumps_bytes(json_data, indent=2, sort_keys=True),
+                Bucket=os.environ['INVENTORY_BUCKET'],
+                ContentType='application/json',
+                Key=REPORT_KEY + ".json",
+            )
+        except ClientError as e:
+            logger.error("ClientError saving report: {}".format(e))
+            raise
+
+        return(event)
+    finally:
+        # Written out whether the handler returns or raises
+        metrics.flush()
+
+
+def per_tenant_reports_enabled():
+    """One report per tenant and an index page instead of a single page, switched on with REPORT_PER_TENANT=True"""
+    return os.environ.get('REPORT_PER_TENANT', "False") == "True"
+
+
+def write_tenant_reports(json_data, s3_client):
+    """
+    Write Reports/azure_subscription_inventory/<tenant slug>.html for each tenant and an index of the tenants,
+    with their subscription count and total cost, to Reports/azure_subscription_inventory.html
+    """
+    by_tenant = {}
+    for subscription in json_data['subscriptions']:
+        by_tenant.setdefault(subscription.get('tenant_name', "Unknown"), []).append(subscription)
+
+    # Relative links, so the pages work wherever the bucket is served from
+    index_name = REPORT_KEY.split("/")[-1]
+    tenants = []
+    pages = set()
+    for tenant_name in sorted(by_tenant, key=str.lower):
+        subscriptions = by_tenant[tenant_name]
+        # The slug is used for both the key and the link, so the link needs no escaping to find the object
+        slug = tenant_slug(tenant_name)
+        page = "{}/{}.html".format(index_name, slug)
+        n = 1
+        while page in pages:
+            n += 1
+            page = "{}/{}-{}.html".format(index_name, slug, n)
+        pages.add(page)
+        render_to_s3("subscription_inventory.html", "Reports/" + page, s3_client=s3_client,
+                     title="Azure Subscription Inventory - {}".format(tenant_name), index_href="../{}.html".format(index_name),
+                     subscriptions=subscriptions, subscription_count=len(subscriptions), timestamp=json_data['timestamp'])
+        tenants.append({
+            'tenant_name': tenant_name,
+            'href': page,
+            'subscription_count': len(subscriptions),
+            'cost': round(sum(s['cost'] for s in subscriptions if s['cost'] != "Unknown"), 2),
+        })
+
+    render_to_s3("subscription_index.html", REPORT_KEY + ".html", s3_client=s3_client,
+                 tenants=tenants, subscription_count=json_data['subscription_count'], timestamp=json_data['timestamp'])
+    logger.info("Wrote reports for {} tenants".format(len(tenants)))
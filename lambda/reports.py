@@ -0,0 +1,126 @@
+import os
+import logging
+import boto3
+from botocore.exceptions import ClientError
+from mako.lookup import TemplateLookup
+from mako.runtime import Context
+from metrics import metrics
+
+
+# Setup Logging
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+
+TEMPLATE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "html_templates")
+
+# S3 will not take a multipart upload part under 5 MiB, other than the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Templates are compiled once per container and kept by the lookup. The compiled Python is also written to
+# module_directory, so a template that drops out of the lookup's cache is loaded from there rather than compiled again.
+template_lookup = TemplateLookup(
+    directories=[TEMPLATE_DIRECTORY],
+    module_directory=os.environ.get('MAKO_MODULE_DIRECTORY', "/tmp/mako_modules"),
+)
+
+
+def get_template(name):
+    """Returns the compiled template html_templates/<name>"""
+    return template_lookup.get_template(name)
+
+
+class S3StreamWriter(object):
+    """
+    A file like object for streaming a report to S3. Text written to it is buffered until there is a part's worth,
+    which is sent with upload_part(). Anything that fits in a single part is sent with one put_object() instead.
+    The upload is aborted if the block it is used in raises.
+    With binary=True it takes bytes instead of text, for writers like pyarrow's. Uploads are recorded as the
+    <metric>PartUpload span and <metric>Bytes count.
+    """
+    def __init__(self, bucket, key, content_type, s3_client=None, part_size=None, binary=False, metric="Report"):
+        if part_size is None:
+            part_size = int(os.environ.get('REPORT_PART_SIZE_MB', 8)) * 1024 * 1024
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.s3_client = s3_client or boto3.client('s3')
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.binary = binary
+        self.metric = metric
+        self.chunks = []
+        self.buffered = 0
+        self.upload_id = None
+        self.parts = []
+        self.bytes_written = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        # A character is at least one byte, so buffered never overstates the size of the encoded part
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.part_size:
+            self._upload_part(self._take_buffer())
+
+    def _take_buffer(self):
+        body = b"".join(self.chunks) if self.binary else "".join(self.chunks).encode('utf-8')
+        self.chunks = []
+        self.buffered = 0
+        return body
+
+    def _upload_part(self, body):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key, ContentType=self.content_type)
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        with metrics.span(self.metric + "PartUpload"):
+            response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.bytes_written += len(body)
+
+    def close(self):
+        """Send whatever is buffered and finish the upload"""
+        body = self._take_buffer()
+        self.closed = True
+        if self.upload_id is None:
+            with metrics.span(self.metric + "PartUpload"):
+                self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=body, ContentType=self.content_type)
+            self.bytes_written += len(body)
+        else:
+            if body:
+                self._upload_part(body)
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+        metrics.count(self.metric + "Bytes", self.bytes_written, unit="Bytes")
+        logger.debug("Wrote {} bytes to s3://{}/{} in {} part(s)".format(self.bytes_written, self.bucket, self.key, max(len(self.parts), 1)))
+
+    def abort(self):
+        """Abandon the upload, so S3 does not keep the parts already sent"""
+        self.chunks = []
+        self.buffered = 0
+        self.closed = True
+        if self.upload_id is not None:
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except ClientError as e:
+                logger.error("Unable to abort the upload of s3://{}/{}: {}".format(self.bucket, self.key, e))
+
+
+def render_to_s3(template_name, key, s3_client=None, bucket=None, **data):
+    """Render html_templates/<template_name> with data straight into s3://<bucket>/<key>, returning the bytes written"""
+    bucket = bucket or os.environ['INVENTORY_BUCKET']
+    with S3StreamWriter(bucket, key, "text/html", s3_client=s3_client) as writer:
+        with metrics.span("ReportRender"):
+            # The data goes in as keyword arguments as well, render_context() only fills in <%page args> from those
+            get_template(template_name).render_context(Context(writer, **data), **data)
+    return writer.bytes_written
@@ -0,0 +1,246 @@
+import os
+import time
+import random
+import logging
+import threading
+import datetime
+from email.utils import parsedate_to_datetime
+from metrics import metrics
+
+
+# Setup Logging
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+
+# HTTP status codes worth retrying, everything else (bad query, auth failure, missing subscription) will never succeed
+RETRYABLE_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+
+# Resource Graph allows 15 queries per 5 second window per user and tenant
+TENANT_QUOTA = 15
+TENANT_QUOTA_WINDOW = 5
+
+# Token buckets shared by every query against the same tenant in this container
+tenant_buckets = {}
+tenant_buckets_lock = threading.Lock()
+
+
+class RetryPolicy(object):
+    """
+    Retries a call with jittered exponential backoff. Honors the Retry-After header and gives up immediately on fatal errors.
+    clock, sleep and rand can be replaced to drive the policy from a fake clock.
+    """
+    def __init__(self, max_attempts=None, base_delay=None, max_delay=None, max_elapsed=None,
+                 clock=time.monotonic, sleep=time.sleep, rand=random.random):
+        self.max_attempts = max_attempts or int(os.environ.get('GRAPH_QUERY_MAX_ATTEMPTS', 5))
+        self.base_delay = base_delay or float(os.environ.get('GRAPH_QUERY_BASE_DELAY', 1))
+        self.max_delay = max_delay or float(os.environ.get('GRAPH_QUERY_MAX_DELAY', 30))
+        self.max_elapsed = max_elapsed or float(os.environ.get('GRAPH_QUERY_MAX_ELAPSED', 120))
+        self.clock = clock
+        self.sleep = sleep
+        self.rand = rand
+
+    def backoff(self, attempt, retry_after=None):
+        """Seconds to wait after the given failed attempt, full jitter capped at max_delay but never less than Retry-After"""
+        delay = self.rand() * min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, func, bucket=None, description="request", metric=None, dimensions=None):
+        """
+        Call func until it succeeds, the error is fatal, or the attempts or time budget are used up
+        :param func: callable taking no arguments
+        :param bucket: optional TokenBucket shared with other callers against the same tenant
+        :param description: used in log messages
+        :param metric: count retries and throttles as <metric>Retries and <metric>Throttles with these dimensions
+        :return: whatever func returns
+        :raises: the last error raised by func
+        """
+        start = self.clock()
+        attempt = 1
+
+        while True:
+            if bucket is not None:
+                bucket.acquire(self.sleep)
+
+            try:
+                result = func()
+
+            except Exception as e:
+                retryable, retry_after = classify_error(e)
+                headers = error_headers(e)
+                if metric and error_status_code(e) == 429:
+                    metrics.count(metric + "Throttles", **(dimensions or {}))
+                if bucket is not None:
+                    bucket.observe(headers, retry_after)
+
+                if not retryable:
+                    logger.error("Fatal error for {}, not retrying: {}".format(description, e))
+                    raise
+
+                # A shared bucket already holds every caller back for Retry-After, so only add the jitter on top of it
+                delay = self.backoff(attempt, None if bucket is not None else retry_after)
+                if attempt >= self.max_attempts or self.clock() - start + max(delay, retry_after or 0) > self.max_elapsed:
+                    logger.error("Giving up on {} after {} attempt(s): {}".format(description, attempt, e))
+                    raise
+
+                logger.warning("Retryable error for {} on attempt {} of {}, retrying in {:.1f} second(s): {}".format(description, attempt, self.max_attempts, delay, e))
+                if metric:
+                    metrics.count(metric + "Retries", **(dimensions or {}))
+                self.sleep(delay)
+                attempt += 1
+                continue
+
+            if bucket is not None:
+                bucket.observe(response_headers(result))
+            return result
+
+
+class TokenBucket(object):
+    """
+    Rate limiter shared by concurrent queries against one tenant. When Resource Graph reports the quota is running out,
+    or asks us to back off, every caller using the bucket slows down together.
+    """
+    def __init__(self, capacity=TENANT_QUOTA, window=TENANT_QUOTA_WINDOW, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = float(capacity) / window
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated = clock()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, sleep=time.sleep):
+        """Take a token, sleeping until one is available"""
+        while True:
+            with self.lock:
+                now = self.clock()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1 - 1e-9:
+                    # Allow for float rounding in the refill so a waiting caller cannot spin on a sliver of a token
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for the given number of seconds"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+    def observe(self, headers, retry_after=None):
+        """Adjust the bucket from the quota headers of a response"""
+        if retry_after is not None:
+            self.pause(retry_after)
+
+        remaining, resets_after = parse_quota_headers(headers)
+        if remaining is None:
+            return
+
+        with self.lock:
+            self._refill(self.clock())
+            # The server knows better than us how many queries are left in this window
+            self.tokens = min(self.tokens, remaining)
+
+        if remaining <= 0 and resets_after is not None:
+            self.pause(resets_after)
+
+
+def get_tenant_bucket(tenant):
+    """Returns the TokenBucket shared by every query against this tenant"""
+    with tenant_buckets_lock:
+        if tenant not in tenant_buckets:
+            tenant_buckets[tenant] = TokenBucket()
+        return tenant_buckets[tenant]
+
+
+#
+# Error and Header Parsing Functions
+#
+
+def classify_error(error):
+    """
+    Decide whether an error is worth retrying
+    :return: retryable (bool), retry_after (seconds or None)
+    """
+    status_code = error_status_code(error)
+    if status_code is not None:
+        retry_after = parse_retry_after(error_headers(error))
+        return status_code in RETRYABLE_STATUS_CODES, retry_after
+
+    # No HTTP response at all, so look at what the SDK wrapped. Connection resets and timeouts are worth another try.
+    inner = getattr(error, 'inner_exception', None) or error
+    return isinstance(inner, (OSError, TimeoutError)), None
+
+
+def error_status_code(error):
+    """Returns the HTTP status code of an SDK error, or None if there was no response"""
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status_code
+
+
+def error_headers(error):
+    """Returns the HTTP headers of an SDK error, or an empty dict"""
+    return getattr(getattr(error, 'response', None), 'headers', None) or {}
+
+
+def response_headers(result):
+    """Returns the HTTP headers of a raw SDK response, or an empty dict"""
+    return getattr(getattr(result, 'response', None), 'headers', None) or {}
+
+
+def parse_retry_after(headers, now=None):
+    """
+    Returns the Retry-After header in seconds, it may be either a number of seconds or an HTTP date
+    :param now: aware datetime an HTTP date is measured from, defaults to the current time
+    """
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - (now or datetime.datetime.now(datetime.timezone.utc))).total_seconds())
+    except (TypeError, ValueError):
+        logger.warning("Unable to parse Retry-After header: {}".format(value))
+        return None
+
+
+def parse_quota_headers(headers):
+    """
+    Returns the remaining Resource Graph quota and seconds until it resets from the
+    x-ms-user-quota-remaining and x-ms-user-quota-resets-after (hh:mm:ss) headers
+    """
+    remaining = headers.get('x-ms-user-quota-remaining')
+    if remaining is None:
+        return None, None
+
+    resets_after = None
+    value = headers.get('x-ms-user-quota-resets-after')
+    if value:
+        try:
+            hours, minutes, seconds = value.split(':')
+            resets_after = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        except ValueError:
+            logger.warning("Unable to parse x-ms-user-quota-resets-after header: {}".format(value))
+
+    try:
+        return int(remaining), resets_after
+    except ValueError:
+        logger.warning("Unable to parse x-ms-user-quota-remaining header: {}".format(remaining))
+        return None, None
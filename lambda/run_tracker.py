@@ -0,0 +1,116 @@
+import os
+import time
+import uuid
+import logging
+import boto3
+from botocore.exceptions import ClientError
+
+
+# Setup Logging
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+
+# How long run records are kept before DynamoDB's TTL removes them
+RUN_RECORD_TTL = 7 * 24 * 3600
+
+
+def get_run_table():
+    """Returns the DynamoDB Table that tracks inventory runs"""
+    return boto3.resource('dynamodb').Table(os.environ['RUN_TABLE'])
+
+
+def run_deadline_seconds(last_delay=0):
+    """
+    Seconds from the start of a run until the report runs anyway. The last group is not even delivered until
+    last_delay seconds in, then it has up to the Lambda timeout (LAMBDA_TIMEOUT) to finish, plus
+    RUN_DEADLINE_MARGIN_SECONDS for queue delivery. Each continuation pushes the deadline out again, see extend_deadline().
+    """
+    return last_delay + int(os.environ.get('LAMBDA_TIMEOUT', 900)) + int(os.environ.get('RUN_DEADLINE_MARGIN_SECONDS', 300))
+
+
+def start_run(run_table, expected_groups, deadline_seconds=None, run_id=None):
+    """
+    Record a new inventory run that fans out to expected_groups subscription groups
+    :param deadline_seconds: how long the run may take, run_deadline_seconds() with no dispatch delay by default
+    :return: the run record
+    """
+    if deadline_seconds is None:
+        deadline_seconds = run_deadline_seconds()
+
+    now = int(time.time())
+    run = {
+        'run_id': run_id or uuid.uuid4().hex,
+        'expected_groups': expected_groups,
+        'started': now,
+        # Everything the run writes by date goes under the day it started, even if it runs past midnight
+        'run_date': time.strftime("%Y-%m-%d", time.gmtime(now)),
+        'deadline': now + deadline_seconds,
+        'expires_at': now + RUN_RECORD_TTL
+    }
+    run_table.put_item(Item=run)
+    logger.info("Started run {} with {} subscription groups".format(run['run_id'], expected_groups))
+    return run
+
+
+def mark_group_done(run_table, run_id, group_id):
+    """Mark one subscription group of the run as finished. Safe to call more than once for the same group."""
+    try:
+        run_table.update_item(
+            Key={'run_id': run_id},
+            UpdateExpression="ADD completed_groups :g",
+            ConditionExpression="attribute_exists(run_id)",
+            ExpressionAttributeValues={':g': set([str(group_id)])}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.error("Run {} not found, unable to mark group {} done".format(run_id, group_id))
+        else:
+            raise
+
+
+def extend_deadline(run_table, run_id, now=None):
+    """
+    Give the run at least another run_deadline_seconds() from now, for a continuation that has just been queued.
+    The deadline only ever moves later, so an earlier deadline from the dispatch schedule is kept if it is further out.
+    """
+    now = now or int(time.time())
+    deadline = now + run_deadline_seconds()
+    try:
+        run_table.update_item(
+            Key={'run_id': run_id},
+            UpdateExpression="SET deadline = :d",
+            ConditionExpression="attribute_exists(run_id) AND deadline < :d",
+            ExpressionAttributeValues={':d': deadline}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.debug("Run {} already has a deadline of {} or later".format(run_id, deadline))
+        else:
+            raise
+
+
+def get_run_status(run_table, run_id, now=None):
+    """
+    Returns a dict with the run's progress. complete is True once every group has finished or the deadline has passed.
+    """
+    now = now or int(time.time())
+    response = run_table.get_item(Key={'run_id': run_id}, ConsistentRead=True)
+    if 'Item' not in response:
+        logger.error("Run {} not found, treating it as complete".format(run_id))
+        return {'run_id': run_id, 'complete': True, 'timed_out': False, 'expected_groups': 0, 'completed_groups': 0}
+
+    run = response['Item']
+    expected = int(run['expected_groups'])
+    completed = len(run.get('completed_groups', []))
+    timed_out = completed < expected and now >= int(run['deadline'])
+
+    return {
+        'run_id': run_id,
+        'complete': completed >= expected or timed_out,
+        'timed_out': timed_out,
+        'expected_groups': expected,
+        'completed_groups': completed
+    }
@@ -0,0 +1,121 @@
+import json
+import math
+import datetime
+import logging
+from enum import Enum
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Setup Logging
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+
+def json_default(obj):
+    """
+    The default= hook for the JSON encoders, turning one value they cannot encode into one they can:
+    msrest models become a dict of their attributes, enums their value, dates ISO 8601 strings and Decimals numbers.
+    Nested values are left for the encoder, so a document is converted in the same pass that encodes it.
+    Anything else is encoded as str(obj), like the json.dumps(..., default=str) calls this replaced.
+    """
+    # msrest models describe their attributes in _attribute_map, this is what Model.as_dict() walks
+    attribute_map = getattr(obj, '_attribute_map', None)
+    if isinstance(attribute_map, dict):
+        output = {}
+        for attribute in attribute_map:
+            value = getattr(obj, attribute, None)
+            if value is not None and attribute != 'additional_properties':
+                output[attribute] = value
+        output.update(getattr(obj, 'additional_properties', None) or {})
+        return output
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return int(obj) if obj.is_finite() and obj == obj.to_integral_value() else float(obj)
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    return str(obj)
+
+
+# The stdlib encoders, built once. Used when orjson is not installed or cannot encode a value, and like orjson
+# they leave non-ASCII characters as they are rather than escaping them
+_compact_encoder = json.JSONEncoder(default=json_default, separators=(',', ':'), ensure_ascii=False)
+_sorted_encoder = json.JSONEncoder(default=json_default, separators=(',', ':'), sort_keys=True, ensure_ascii=False)
+# Kept escaping non-ASCII characters, so the content hashes of manifests saved before stay the same
+_canonical_encoder = json.JSONEncoder(default=json_default, separators=(',', ':'), sort_keys=True)
+
+
+def dumps(obj, indent=None, sort_keys=False):
+    """Serialize obj to a JSON string, compact unless an indent is requested"""
+    return dumps_bytes(obj, indent=indent, sort_keys=sort_keys).decode('utf-8')
+
+
+def dumps_bytes(obj, indent=None, sort_keys=False):
+    """
+    Serialize obj to UTF-8 JSON, with orjson when it is installed and the stdlib encoder otherwise.
+    orjson only indents by 2, any other indent uses the stdlib encoder.
+    """
+    if orjson is not None and indent in (None, 2):
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, default=json_default, option=option)
+        except TypeError as e:
+            # Integers over 64 bits and the like, which the stdlib encoder handles
+            logger.debug("orjson could not encode a value, using json: {}".format(e))
+
+    if indent is not None:
+        return json.dumps(obj, default=json_default, indent=indent, sort_keys=sort_keys, ensure_ascii=False).encode('utf-8')
+    encoder = _sorted_encoder if sort_keys else _compact_encoder
+    return encoder.encode(obj).encode('utf-8')
+
+
+def canonical_dumps(obj):
+    """
+    Compact, key sorted JSON from the stdlib encoder. It is the same whether or not orjson is installed,
+    so use it for anything that is hashed or compared between runs.
+    """
+    return _canonical_encoder.encode(obj)
+
+
+def to_json_native(obj):
+    """Returns a deep copy of obj made only of dicts, lists, strings, numbers, booleans and None"""
+    if obj is None or type(obj) in (str, int, float, bool):
+        return obj
+    if isinstance(obj, dict):
+        return {k if isinstance(k, str) else str(json_default(k)): to_json_native(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [to_json_native(v) for v in obj]
+    return to_json_native(json_default(obj))
+
+
+def to_dynamodb(obj):
+    """
+    Like to_json_native(), but with every number a Decimal, which is what boto3 requires for DynamoDB.
+    NaN and Infinity cannot be stored as numbers so they are stored as strings.
+    """
+    if obj is None or type(obj) in (str, bool):
+        return obj
+    if type(obj) is int:
+        return Decimal(obj)
+    if type(obj) is float:
+        return Decimal(repr(obj)) if math.isfinite(obj) else repr(obj)
+    if isinstance(obj, Decimal):
+        return obj
+    if isinstance(obj, dict):
+        return {k if isinstance(k, str) else str(json_default(k)): to_dynamodb(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [to_dynamodb(v) for v in obj]
+    return to_dynamodb(json_default(obj))
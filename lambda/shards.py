@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import uuid
+import zlib
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from common import get_s3_client, dump_resource_json, ResourceWriter
+from incremental import incremental_enabled
+from metrics import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Setup Logging
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+
+def get_resource_writer(run_id=None, run_date=None):
+    """
+    Returns the writer for the OUTPUT_FORMAT environment variable.
+    "object" (the default) saves one json object per resource, "ndjson" saves compressed newline delimited shards
+    tagged with the inventory run they belong to, so export-parquet can read back just that run's shards.
+    """
+    output_format = os.environ.get('OUTPUT_FORMAT', "object")
+    if output_format == "ndjson":
+        if incremental_enabled():
+            # Unchanged resources are skipped, so a run's shards would only hold what changed. export-parquet refuses this.
+            logger.warning("INCREMENTAL_INVENTORY with OUTPUT_FORMAT ndjson only saves changed resources, the shards are not a full inventory")
+        return ShardedResourceWriter(run_id=run_id, run_date=run_date)
+    if output_format != "object":
+        logger.warning("Unknown OUTPUT_FORMAT {}, saving one object per resource".format(output_format))
+    return ResourceWriter()
+
+
+class Shard(object):
+    """One compressed newline delimited json file being built in memory"""
+    def __init__(self, compression):
+        self.records = 0
+        self.raw_bytes = 0
+        self.chunks = []
+        self.size = 0
+        if compression == "zstd":
+            self.compressor = zstandard.ZstdCompressor().compressobj()
+        else:
+            # wbits 31 writes a gzip header and trailer
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def add(self, line):
+        data = self.compressor.compress(line)
+        self.records += 1
+        self.raw_bytes += len(line)
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+
+    def finish(self):
+        """Returns the complete compressed body"""
+        self.chunks.append(self.compressor.flush())
+        body = b"".join(self.chunks)
+        self.chunks = []
+        return body
+
+
+class ShardedResourceWriter(object):
+    """
+    Saves resources as compressed newline delimited json shards, one series per subscription and resource prefix:
+    Azure-Resources-Shards/<prefix>/<yyyy-mm-dd>/<subscription_id>/part-<writer>-<n>.ndjson.gz
+    A shard is uploaded once it reaches roughly SHARD_MAX_BYTES compressed (the compressor holds back its current block), and close() writes a manifest of every shard next to them.
+    run_id and run_date are those of the inventory run, every invocation of the run writes under the same date and
+    records the run in its manifests. Same interface as common.ResourceWriter.
+    """
+    def __init__(self, max_bytes=None, compression=None, max_workers=4, run_id=None, run_date=None):
+        self.max_bytes = max_bytes or int(os.environ.get('SHARD_MAX_BYTES', 8 * 1024 * 1024))
+        self.compression = compression or os.environ.get('SHARD_COMPRESSION', "gzip")
+        if self.compression == "zstd" and zstandard is None:
+            logger.warning("zstandard is not installed, falling back to gzip shards")
+            self.compression = "gzip"
+        self.extension = "ndjson.zst" if self.compression == "zstd" else "ndjson.gz"
+
+        # Several invocations write shards for the same run, each under its own writer id
+        self.writer_id = "{}-{}".format(time.strftime("%H%M%S"), uuid.uuid4().hex[:8])
+        self.run_id = run_id
+        self.run_date = run_date or datetime.datetime.utcnow().strftime("%Y-%m-%d")
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.open_shards = {}
+        self.manifests = {}
+        self.pending = []
+        self.failures = []
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, prefix, resource_id, resource):
+        """Add a resource to the open shard for its subscription and prefix"""
+        key = (prefix, resource['azureSubscriptionId'].lower())
+        with metrics.span("Serialize", Tenant=resource.get('azureTenantId'), Subscription=resource['azureSubscriptionId']):
+            line = dump_resource_json(resource) + b"\n"
+
+        shard = self.open_shards.get(key)
+        if shard is None:
+            shard = self.open_shards[key] = Shard(self.compression)
+        shard.add(line)
+        self.written += 1
+
+        if shard.size >= self.max_bytes:
+            self._upload(key, self.open_shards.pop(key))
+
+    def _upload(self, key, shard):
+        prefix, subscription_id = key
+        entries = self.manifests.setdefault(key, [])
+        object_key = "Azure-Resources-Shards/{}/{}/{}/part-{}-{:05d}.{}".format(prefix, self.run_date, subscription_id, self.writer_id, len(entries), self.extension)
+        body = shard.finish()
+        entries.append({'key': object_key, 'records': shard.records, 'bytes': len(body), 'uncompressed_bytes': shard.raw_bytes})
+        metrics.count("BytesWritten", len(body), unit="Bytes", Subscription=subscription_id)
+        self.pending.append(self.executor.submit(self._put, object_key, body))
+
+    def _put(self, object_key, body):
+        try:
+            with metrics.span("S3Put"):
+                get_s3_client().put_object(
+                    Body=body,
+                    Bucket=os.environ['INVENTORY_BUCKET'],
+                    ContentType='application/x-ndjson',
+                    Key=object_key,
+                )
+        except Exception as e:
+            logger.error("Unable to save shard {}: {}".format(object_key, e))
+            with self.lock:
+                self.failures.append((object_key, e))
+
+    def flush(self):
+        """Upload every open shard and wait for all uploads. Returns a list of (object_key, error) for the uploads that failed since the last flush"""
+        for key in list(self.open_shards):
+            self._upload(key, self.open_shards.pop(key))
+        wait(self.pending)
+        self.pending = []
+
+        with self.lock:
+            failures = self.failures
+            self.failures = []
+        return failures
+
+    def close(self):
+        """Flush, then write a manifest of this run's shards for each subscription and prefix. Returns the failures like flush()"""
+        failures = self.flush()
+        for (prefix, subscription_id), entries in self.manifests.items():
+            manifest = {
+                'format': "ndjson",
+                'compression': self.compression,
+                'run_id': self.run_id,
+                'writer_id': self.writer_id,
+                'records': sum(e['records'] for e in entries),
+                'shards': entries
+            }
+            object_key = "Azure-Resources-Shards/{}/{}/{}/manifest-{}.json".format(prefix, self.run_date, subscription_id, self.writer_id)
+            try:
+                get_s3_client().put_object(
+                    Body=json.dumps(manifest, separators=(',', ':')),
+                    Bucket=os.environ['INVENTORY_BUCKET'],
+                    ContentType='application/json',
+                    Key=object_key,
+                )
+            except Exception as e:
+                logger.error("Unable to save shard manifest {}: {}".format(object_key, e))
+                failures.append((object_key, e))
+
+        self.manifests = {}
+        self.executor.shutdown(wait=True)
+        return failures
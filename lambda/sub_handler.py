@@ -8,6 +8,7 @@ import boto3
 from botocore.exceptions import ClientError
 from boto3.dynamodb.types import TypeDeserializer
 from common import *
+from serialization import dumps
 
 
 # Setup Logging
@@ -21,14 +22,27 @@ logging.getLogger('boto3').setLevel(logging.WARNING)
 # DyanmoDB Streams send a very DDB specific format to the stream target. While we typically thing of a DDB record as json, it is not.
 # It's a funky format. The deseralize() function call will convert the DDB format into json which is then sent along to the final SNS topic
 # that is the SNS topic that other tools can subscribe to.
+#
+# The messages are published ten at a time. Records that could not be published are returned as batchItemFailures,
+# so the stream (with ReportBatchItemFailures on the event source mapping) retries from the first of them instead of
+# retrying the whole batch.
+
+# SNS takes at most ten messages in one publish_batch call
+MAX_BATCH_SIZE = 10
+
+# Reused for every record in this container, see get_sns_client()
+_sns_client = None
+deserializer = TypeDeserializer()
+
 
 def lambda_handler(event, context):
     logger.debug("Received event: " + json.dumps(event, sort_keys=True))
 
     try:
+        new_subscriptions = []
         for record in event['Records']:
             if record['eventSource'] != "aws:dynamodb":
-                next
+                continue
 
             # since this is only about newly discovered subscriptions, we only care about INSERT
             if record['eventName'] == "INSERT":
@@ -36,8 +50,10 @@ def lambda_handler(event, context):
                 if 'SubscriptionClass' in ddb_record:
                     del ddb_record['SubscriptionClass']
                 logger.debug(ddb_record)
-                json_record = deseralize(ddb_record)
-                send_message(json_record, os.environ['ACTIVE_TOPIC'])
+                new_subscriptions.append((record['dynamodb']['SequenceNumber'], deseralize(ddb_record)))
+
+        failed = send_messages(new_subscriptions, os.environ['ACTIVE_TOPIC'])
+        return({'batchItemFailures': [{'itemIdentifier': sequence_number} for sequence_number in failed]})
 
     except ClientError as e:
         logger.critical(f"ClientError - {e}")
@@ -49,24 +65,52 @@ def lambda_handler(event, context):
         raise
 
 
-def send_message(record, topic):
-    print("Sending Message: {}".format(record))
-    sns_client = boto3.client('sns')
-    try:
-        sns_client.publish(
-            TopicArn=topic,
-            Subject="New Azure Subscription",
-            Message=json.dumps(record, sort_keys=True, default=str),
-        )
-    except ClientError as e:
-        logger.error('Error publishing message: {}'.format(e))
+def get_sns_client():
+    """Returns the module level SNS client, creating it on first use"""
+    global _sns_client
+    if _sns_client is None:
+        _sns_client = boto3.client('sns')
+    return _sns_client
+
+
+def send_messages(records, topic):
+    """
+    Publish (sequence number, record) pairs to the topic, ten per publish_batch call, and return the sequence numbers
+    of the records that were not published. The stream retries everything from the first failure, so once a batch
+    fails the rest are not sent, which would only publish them twice. Within a batch every record from the first
+    failed one on is returned, as the stream will send them all again.
+    """
+    failed = []
+    for i in range(0, len(records), MAX_BATCH_SIZE):
+        batch = records[i:i + MAX_BATCH_SIZE]
+        if failed:
+            failed.extend(sequence_number for sequence_number, record in batch)
+            continue
+
+        entries = []
+        for n, (sequence_number, record) in enumerate(batch):
+            logger.info("Sending Message: {}".format(record))
+            entries.append({'Id': str(n), 'Subject': "New Azure Subscription", 'Message': dumps(record, sort_keys=True)})
+
+        try:
+            response = get_sns_client().publish_batch(TopicArn=topic, PublishBatchRequestEntries=entries)
+            failed_ids = set(f['Id'] for f in response.get('Failed', []))
+            if failed_ids:
+                logger.error('{} of {} messages were not published: {}'.format(len(failed_ids), len(entries), response['Failed']))
+        except ClientError as e:
+            logger.error('Error publishing messages: {}'.format(e))
+            failed_ids = set(entry['Id'] for entry in entries)
+
+        if failed_ids:
+            first_failed = min(int(n) for n in failed_ids)
+            resent = len(batch) - first_failed - len(failed_ids)
+            if resent:
+                logger.warning('{} published messages after the first failure will be published again when the stream retries'.format(resent))
+            failed.extend(sequence_number for sequence_number, record in batch[first_failed:])
+    return(failed)
 
 
 def deseralize(ddb_record):
     # This is probablt a semi-dangerous hack.
     # https://github.com/boto/boto3/blob/e353ecc219497438b955781988ce7f5cf7efae25/boto3/dynamodb/types.py#L233
-    ds = TypeDeserializer()
-    output = {}
-    for k, v in ddb_record.items():
-        output[k] = ds.deserialize(v)
-    return(output)
+    return({k: deserializer.deserialize(v) for k, v in ddb_record.items()})
@@ -4,23 +4,14 @@ from boto3.dynamodb.conditions import Key
 import json
 import os
 import logging
+import time
 import datetime
+import threading
+import importlib
+from collections import namedtuple
 from dateutil import tz
 from pprint import pprint
-
-from msrestazure.azure_active_directory import ServicePrincipalCredentials
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.consumption import ConsumptionManagementClient
-from azure.mgmt.network import NetworkManagementClient
-from azure.mgmt.subscription import SubscriptionClient
-from azure.mgmt.storage import StorageManagementClient
-#from azure.mgmt.web import WebSiteManagementClient
-from azure.mgmt.sql import SqlManagementClient
-#from azure.mgmt.datafactory import DataFactoryManagementClient
-from azure.mgmt.keyvault import KeyVaultManagementClient
-#from azure.mgmt.logic import LogicManagementClient
-from azure.mgmt.resource import ResourceManagementClient
-from azure.mgmt.resourcegraph import ResourceGraphClient
+from metrics import metrics
 
 # Setup Logging
 logger = logging.getLogger()
@@ -28,12 +19,41 @@ logger.setLevel(logging.DEBUG)
 logging.getLogger('botocore').setLevel(logging.WARNING)
 logging.getLogger('boto3').setLevel(logging.WARNING)
 
+# Process level caches of secrets, credentials and clients. They live at module scope so they survive warm invocations.
+# Each entry is stored as (value, expires_at) and evicted once expired, see get_cached()
+secret_cache = {}
+credential_cache = {}
+client_cache = {}
+cache_lock = threading.Lock()
+
+# One lock per secret or tenant, held while it is fetched, so concurrent callers that miss the cache wait for the
+# first caller's fetch instead of each making their own, see fetch_lock()
+fetch_locks = {}
+
+
+# The Azure SDK packages are large and slow to import, so each client's package is only imported the first time it is asked for.
+# per_subscription clients are built with (credentials, subscription_id), the rest with just the credentials.
+ClientSpec = namedtuple('ClientSpec', ['module', 'class_name', 'per_subscription', 'kwargs'])
+
+CLIENT_REGISTRY = {
+    "ComputeManagementClient":      ClientSpec("azure.mgmt.compute", "ComputeManagementClient", True, {}),
+    "ConsumptionManagementClient":  ClientSpec("azure.mgmt.consumption", "ConsumptionManagementClient", True, {}),
+    "NetworkManagementClient":      ClientSpec("azure.mgmt.network", "NetworkManagementClient", True, {}),
+    "StorageManagementClient":      ClientSpec("azure.mgmt.storage", "StorageManagementClient", True, {}),
+    "SqlManagementClient":          ClientSpec("azure.mgmt.sql", "SqlManagementClient", True, {}),
+    "KeyVaultManagementClient":     ClientSpec("azure.mgmt.keyvault", "KeyVaultManagementClient", True, {}),
+    "ResourceManagementClient":     ClientSpec("azure.mgmt.resource", "ResourceManagementClient", True, {}),
+    "SubscriptionClient":           ClientSpec("azure.mgmt.subscription", "SubscriptionClient", False, {}),
+    "ResourceGraphClient":          ClientSpec("azure.mgmt.resourcegraph", "ResourceGraphClient", False, {'base_url': None}),
+}
+
 
 class AntiopeAzureSubscription(object):
     """Class to represent a Azure Subscription """
-    def __init__(self, subscription_id):
+    def __init__(self, subscription_id, db_record=None, dynamodb=None):
         '''
-            Takes a subsription as the lookup attribute
+            Takes a subsription as the lookup attribute.
+            db_record and dynamodb can be passed in when the record was already loaded in bulk, see common.load_subscriptions()
         '''
         # Execute any parent class init()
 
@@ -41,19 +61,23 @@ class AntiopeAzureSubscription(object):
         
         # Save these as attributes
         self.credentials = ""
-        self.dynamodb = boto3.resource('dynamodb')
+        self.dynamodb = dynamodb or boto3.resource('dynamodb')
         self.subscription_table = self.dynamodb.Table(os.environ['SUBSCRIPTION_TABLE'])
 
-        response = self.subscription_table.query(
-            KeyConditionExpression=Key('subscription_id').eq(self.subscription_id),
-            Select='ALL_ATTRIBUTES'
-        )
+        if db_record is None:
+            response = self.subscription_table.query(
+                KeyConditionExpression=Key('subscription_id').eq(self.subscription_id),
+                Select='ALL_ATTRIBUTES'
+            )
+            try:
+                db_record = response['Items'][0]
+            except IndexError as e:
+                raise SubscriptionLookupError("ID {} not found".format(self.subscription_id))
+
         try:
-            self.db_record = response['Items'][0]
+            self.db_record = db_record
             # Convert the response into instance attributes
             self.__dict__.update(self.db_record)
-        except IndexError as e:
-            raise SubscriptionLookupError("ID {} not found".format(self.subscription_id))
         except Exception as e:
             logger.error("Got Other error: {}".format(e))
 
@@ -92,6 +116,25 @@ class AntiopeAzureSubscription(object):
         except ClientError as e:
             raise SubscriptionUpdateError("Failed to update {} to {} in {}: {}".format(key, value, table_name, e))
 
+    def update_attributes(self, table_name, values):
+        '''    update several attributes of this subscription with a single SET expression
+            table_name should be a valid DynDB table, values is a dict of column to new value
+        '''
+        logger.info(u"Setting {} on subscription {}".format(values, self))
+        table = self.dynamodb.Table(table_name)
+        names = {'#k{}'.format(i): key for i, key in enumerate(values)}
+        try:
+            response = table.update_item(
+                Key= {
+                    'subscription_id': self.subscription_id
+                },
+                UpdateExpression="set " + ", ".join("#k{0} = :v{0}".format(i) for i in range(len(values))),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues={':v{}'.format(i): value for i, value in enumerate(values.values())}
+            )
+        except ClientError as e:
+            raise SubscriptionUpdateError("Failed to update {} in {}: {}".format(", ".join(values), table_name, e))
+
     def get_attribute(self, table_name, key):
         '''
         Pulls a attribute from the specificed table for the subscription
@@ -143,11 +186,77 @@ class AntiopeAzureSubscription(object):
     def authenticate(self, secret_name):
         """
         Get the azure service account key stored in AWS secrets manager.
+        The secret and the credentials built from it are cached per tenant for the life of the container.
+        """
+        self.credentials = get_tenant_credentials(secret_name, self.tenant_name)
+
+
+    def get_client(self, client_type):
+        """
+        Return resource management client type based on what's requested.
+        Clients are cached alongside the credentials they were built with.
         """
+        
+        try:
+            # Check to see if credentials exist before returning an azure client object
+            if self.credentials:
+                spec = CLIENT_REGISTRY.get(client_type)
+                if spec is None:
+                    raise NotImplementedError("No such client type {} supported".format(client_type))
+
+                # Resource graph and subscription clients are per tenant, everything else is per subscription
+                if spec.per_subscription:
+                    cache_key = (id(self.credentials), client_type, self.subscription_id)
+                else:
+                    cache_key = (id(self.credentials), client_type)
+
+                client = get_cached(client_cache, cache_key)
+                if client is not None:
+                    return(client)
+
+                client_class = load_sdk_class(spec.module, spec.class_name)
+                if spec.per_subscription:
+                    client = client_class(self.credentials, self.subscription_id, **spec.kwargs)
+                else:
+                    client = client_class(self.credentials, **spec.kwargs)
+
+                # A client can only be used for as long as its credentials
+                put_cached(client_cache, cache_key, client, credential_expiry(self.credentials))
+                return(client)
+            else:
+                raise ServicePrincipalError("Missing or bad credentials for tenant {}".format(self.tenant_name))
+        
+        except ServicePrincipalError as e:
+            raise(e)
+        except NotImplementedError as e:
+            raise(e)
+        except Exception as e:
+            raise(e)
+
+
+#
+# Credential Cache Functions
+#
+
+def get_azure_secret(secret_name):
+    """
+    Get the azure service account keys stored in AWS secrets manager, as a dict of tenant name to keys.
+    Cached for AZURE_SECRET_CACHE_TTL seconds so warm invocations skip secrets manager.
+    """
+    secret_dict = get_cached(secret_cache, secret_name)
+    if secret_dict is not None:
+        return(secret_dict)
+
+    with fetch_lock("secret", secret_name):
+        # Another thread may have fetched it while this one waited for the lock
+        secret_dict = get_cached(secret_cache, secret_name)
+        if secret_dict is not None:
+            return(secret_dict)
 
         client = boto3.client('secretsmanager')
         try:
-            get_secret_value_response = client.get_secret_value(SecretId=secret_name)
+            with metrics.span("SecretsManager"):
+                get_secret_value_response = client.get_secret_value(SecretId=secret_name)
         except ClientError as e:
             logger.error("Unable to get secret value for {}: {}".format(secret_name, e))
             raise ServicePrincipalError(e)
@@ -159,47 +268,89 @@ class AntiopeAzureSubscription(object):
 
         try:
             secret_dict = json.loads(secret_value)
-            if self.tenant_name in secret_dict:
-                creds = secret_dict[self.tenant_name]
         except Exception as e:
             logger.error("Error during Credential and Service extraction: {}".format(e))
             raise ServicePrincipalError(e)
 
+        put_cached(secret_cache, secret_name, secret_dict, time.time() + int(os.environ.get('AZURE_SECRET_CACHE_TTL', 900)))
+        return(secret_dict)
+
+
+def get_tenant_credentials(secret_name, tenant_name):
+    """
+    Returns ServicePrincipalCredentials for the tenant, only requesting a new AAD token when the cached one is close to expiring
+    """
+    cache_key = (secret_name, tenant_name)
+    credentials = get_cached(credential_cache, cache_key)
+    if credentials is not None:
+        return(credentials)
+
+    with fetch_lock("credentials", cache_key):
+        # Another thread may have requested the token while this one waited for the lock
+        credentials = get_cached(credential_cache, cache_key)
+        if credentials is not None:
+            return(credentials)
+
+        secret_dict = get_azure_secret(secret_name)
+        if tenant_name not in secret_dict:
+            logger.error("Error during Credential and Service extraction: no credentials for tenant {}".format(tenant_name))
+            raise ServicePrincipalError("No credentials for tenant {} in {}".format(tenant_name, secret_name))
+        creds = secret_dict[tenant_name]
+
         try:
-            self.credentials = ServicePrincipalCredentials(
-                client_id=creds['application_id'],
-                secret=creds['key'],
-                tenant=creds['tenant_id']
-            )
+            ServicePrincipalCredentials = load_sdk_class("msrestazure.azure_active_directory", "ServicePrincipalCredentials")
+
+            # Creating the credentials requests the AAD token
+            with metrics.span("TokenAcquisition", Tenant=creds['tenant_id']):
+                credentials = ServicePrincipalCredentials(
+                    client_id=creds['application_id'],
+                    secret=creds['key'],
+                    tenant=creds['tenant_id']
+                )
         except Exception as e:
             raise ServicePrincipalError(e)
 
+        put_cached(credential_cache, cache_key, credentials, credential_expiry(credentials))
+        return(credentials)
+
+
+def load_sdk_class(module_name, class_name):
+    """Import an Azure SDK module the first time it is needed and return one of its classes"""
+    return(getattr(importlib.import_module(module_name), class_name))
+
+
+def credential_expiry(credentials):
+    """Returns when the credentials (and anything built from them) should be evicted, a little before the AAD token expires"""
+    token = getattr(credentials, 'token', None) or {}
+    margin = int(os.environ.get('AZURE_TOKEN_EXPIRY_MARGIN', 300))
+    try:
+        return(float(token['expires_on']) - margin)
+    except (KeyError, TypeError, ValueError):
+        # AAD tokens last at least an hour, so without an expiry be conservative
+        return(time.time() + 3600 - margin)
+
+
+def get_cached(cache, key):
+    """Returns the cached value for key, or None if it is missing or expired. Expired entries are evicted."""
+    now = time.time()
+    with cache_lock:
+        for k in [k for k, (value, expires_at) in cache.items() if expires_at <= now]:
+            del cache[k]
+        entry = cache.get(key)
+    return(entry[0] if entry else None)
+
+
+def put_cached(cache, key, value, expires_at):
+    """Caches value under key until expires_at (epoch seconds)"""
+    with cache_lock:
+        cache[key] = (value, expires_at)
+
+
+def fetch_lock(kind, key):
+    """Returns the lock to hold while fetching the kind ("secret" or "credentials") of value cached under key"""
+    with cache_lock:
+        return(fetch_locks.setdefault((kind, key), threading.Lock()))
 
-    def get_client(self, client_type):
-        """
-        Return resource management client type based on what's requested
-        """
-        
-        try:
-            # Check to see if credentials exist before returning an azure client object
-            if self.credentials:
-                # there is probably a better whay than a big case statement
-                if client_type == "ComputeManagementClient":
-                    return(ComputeManagementClient(self.credentials, self.subscription_id))
-                elif client_type == "ResourceGraphClient":
-                    return(ResourceGraphClient(self.credentials, base_url=None))
-                else:
-                    raise NotImplementedError("No such client type {} supported".format(client_type))
-            else:
-                raise ServicePrincipalError("Missing or bad credentials for tenant {}".format(self.tenant_name))
-        
-        except ServicePrincipalError as e:
-            raise(e)
-        except NotImplementedError as e:
-            raise(e)
-        except Exception as e:
-            raise(e)
-  
 
 class ServicePrincipalError(Exception):
     # Raised when the AssumeRole Fails
@@ -2,7 +2,10 @@ import boto3
 import json
 import os
 import logging
-import time
+from common import load_subscriptions
+from dispatch import dispatch_messages, last_dispatch_delay
+from planner import plan_groups
+from run_tracker import get_run_table, start_run, get_run_status, run_deadline_seconds
 
 
 # Setup Logging
@@ -21,42 +24,46 @@ def handler(event, context):
 
     logger.info("Received event: " + json.dumps(event, sort_keys=True))
 
-    # Setup client
-    client = boto3.client('sns')
-
     # In order to limit the number of lamba functions making API calls and exceeding the throttling limit
     # send a group of subscription ID's to SNS rather then each individual ID for each lamba function to process.
     subs = event['subscription_list']
     
-    # Divide the list of subs into chunks
-    sub_groups = list(divide_into_chunks(subs)) 
-    
-    # Cycle through each sub group and send to SNS
-    for subscription_id in sub_groups:
+    # Pack the subs into groups of about the same amount of work, going by how many resources each had last run
+    sub_groups = plan_groups(load_subscriptions(subs))
+    logger.info("Planned {} subscription(s) into {} group(s)".format(len(subs), len(sub_groups)))
+
+    # Record the run so the report can start as soon as every group has reported in, see check_run_status().
+    # The last group is held in the queue until its turn, so the run cannot be given up on before then.
+    interval = int(os.environ.get('SNS_DELAY', 0))
+    run = start_run(get_run_table(), len(sub_groups), deadline_seconds=run_deadline_seconds(last_dispatch_delay(len(sub_groups), interval)))
+    event['run_id'] = run['run_id']
+    event['run_date'] = run['run_date']
+    event['run_started'] = run['started']
     
-        sns_delay = int(os.environ['SNS_DELAY'])
+    messages = []
+    for group_id, subscription_id in enumerate(sub_groups):
         message = {}
         message['subscription_id'] = subscription_id
+        message['run_id'] = run['run_id']
+        message['run_date'] = run['run_date']
+        message['group_id'] = str(group_id)
+        messages.append(message)
 
         logger.info("Pushing Message: " + json.dumps(message, sort_keys=True))
-    
-        response = client.publish(
-            TopicArn=os.environ['TRIGGER_ACCOUNT_INVENTORY_ARN'],
-            Message=json.dumps(message)
-        )
-        
-        if sns_delay != 0:
-            logger.info("SNS delay is greater then zero, sleeping {} second(s)".format(str(sns_delay)))
-            time.sleep(sns_delay)
+
+    # Send every group now, SNS_DELAY seconds apart is handled by the queue's delivery delay rather than sleeping here
+    dispatch_messages(messages, interval)
 
     return event
 
-def divide_into_chunks(subs): 
-     
-    # Number of subscription ID's grouped and sent to SNS 
-    num = int(os.environ['NUM_SUBS_IN_GROUP'])
-    
-    # looping till length num
-    for i in range(0, len(subs), num):  
-        yield subs[i:i + num]
 
+def check_run_status(event, context):
+    """Step function task that reports whether every subscription group of the run has finished, or the run's deadline has passed"""
+    status = get_run_status(get_run_table(), event['run_id'])
+    logger.info("Run {} has {} of {} subscription groups complete".format(status['run_id'], status['completed_groups'], status['expected_groups']))
+
+    if status['timed_out']:
+        logger.warning("Run {} passed its deadline with {} subscription group(s) outstanding".format(status['run_id'], status['expected_groups'] - status['completed_groups']))
+
+    event['run_complete'] = status['complete']
+    return event
@@ -0,0 +1,117 @@
+"""
+Shared setup for the unit tests. The lambda modules are imported the way the Lambda runtime does, from the lambda
+directory, and the fakes in benchmark/fakes.py stand in for the Azure SDK clients. Nothing here talks to AWS or Azure.
+
+    pip install -r lambda-layer/azure-requirements.txt -r tests/requirements.txt
+    python3 -m pytest tests
+"""
+import os
+import sys
+import importlib.util
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+LAMBDA_DIR = os.path.join(ROOT, "lambda")
+sys.path.insert(0, LAMBDA_DIR)
+sys.path.insert(0, os.path.join(ROOT, "benchmark"))
+
+os.environ.update({
+    'AWS_DEFAULT_REGION': "us-east-1",
+    'AWS_ACCESS_KEY_ID': "testing",
+    'AWS_SECRET_ACCESS_KEY': "testing",
+    'METRICS_ENABLED': "False",
+})
+
+
+def load_handler(filename):
+    """Import a lambda module by file name, several have a - in their name"""
+    spec = importlib.util.spec_from_file_location(filename.replace('-', '_')[:-3], os.path.join(LAMBDA_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def unlimited_quota(monkeypatch):
+    """Take the Resource Graph tenant rate limit out of the way, so only the code under test is exercised"""
+    import retry_policy
+
+    def get_tenant_bucket(tenant):
+        return retry_policy.TokenBucket(capacity=10 ** 9, window=1)
+    monkeypatch.setattr("common.get_tenant_bucket", get_tenant_bucket)
+
+
+@pytest.fixture
+def estate(monkeypatch):
+    """
+    A small synthetic Azure estate, two tenants with three subscriptions of five virtual machines each, served by the
+    fakes in place of the Azure SDK classes. Returns (estate, ApiCounter of the Azure calls made).
+    """
+    import subscription
+    import retry_policy
+    from fakes import (FakeEstate, FakeLatency, ApiCounter, FakeServicePrincipalCredentials, FakeSubscriptionClient,
+                       FakeResourceGraphClient, FakeCostManagementClient, configure_fakes)
+
+    fake_estate = FakeEstate(tenants=2, subscriptions_per_tenant=3, vms_per_subscription=5)
+    counter = ApiCounter()
+    configure_fakes(fake_estate, FakeLatency(), counter)
+
+    replacements = {
+        ('msrestazure.azure_active_directory', 'ServicePrincipalCredentials'): FakeServicePrincipalCredentials,
+        ('azure.mgmt.subscription', 'SubscriptionClient'): FakeSubscriptionClient,
+        ('azure.mgmt.resourcegraph', 'ResourceGraphClient'): FakeResourceGraphClient,
+        ('azure.mgmt.costmanagement', 'CostManagementClient'): FakeCostManagementClient,
+    }
+    for (module_name, class_name), fake in replacements.items():
+        monkeypatch.setattr(importlib.import_module(module_name), class_name, fake)
+
+    # Nothing cached by an earlier test, and no waiting on the Resource Graph rate limit
+    for cache in ("secret_cache", "credential_cache", "client_cache"):
+        monkeypatch.setattr(subscription, cache, {})
+    monkeypatch.setattr(retry_policy, "tenant_buckets", {t['tenant_id']: retry_policy.TokenBucket(capacity=10 ** 9, window=1) for t in fake_estate.tenants.values()})
+    return fake_estate, counter
+
+
+@pytest.fixture
+def aws(monkeypatch, estate):
+    """
+    moto standing in for AWS, with the tables, bucket, queues, topic and secret the stack creates,
+    and a subscription table record for every subscription in the estate
+    """
+    import boto3
+    import common
+    from moto import mock_aws
+    from end_to_end import ENVIRONMENT, create_aws_resources
+
+    for name, value in ENVIRONMENT.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(common, "_s3_client", None)
+
+    fake_estate, counter = estate
+    with mock_aws():
+        # create_aws_resources() sets the queue and topic variables, put them back afterwards
+        for name in ('ERROR_QUEUE', 'DISPATCH_QUEUE_URL', 'TRIGGER_ACCOUNT_INVENTORY_ARN'):
+            monkeypatch.setenv(name, "")
+        create_aws_resources(fake_estate)
+
+        table = boto3.resource('dynamodb').Table(os.environ['SUBSCRIPTION_TABLE'])
+        for tenant_name, tenant in fake_estate.tenants.items():
+            for subscription_id in tenant['subscriptions']:
+                table.put_item(Item={'subscription_id': subscription_id, 'display_name': "test-" + subscription_id[-6:], 'subscription_state': "Enabled",
+                                     'tenant_id': tenant['tenant_id'], 'tenant_name': tenant_name, 'queryable': "true"})
+        yield fake_estate, counter
+
+
+class FakeContext(object):
+    """The parts of the lambda context the handlers use"""
+    function_name = "test"
+    aws_request_id = "test"
+    log_group_name = "/aws/lambda/test"
+    log_stream_name = "test"
+
+    def __init__(self, remaining_millis=900000):
+        self.remaining_millis = remaining_millis
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_millis
@@ -0,0 +1,146 @@
+import os
+import functools
+import importlib
+import threading
+
+import boto3
+import pytest
+
+import common
+import cost
+from retry_policy import RetryPolicy
+from cost import get_subscription_cost, collect_subscription_costs, current_billing_period
+from fakes import FakeServicePrincipalCredentials
+
+
+class Column(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class QueryResult(object):
+    def __init__(self, rows, columns):
+        self.rows = rows
+        self.columns = [Column(name) for name in columns]
+
+
+class HttpResponse(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class HttpError(Exception):
+    def __init__(self, status_code, headers=None):
+        super(HttpError, self).__init__("HTTP {}".format(status_code))
+        self.status_code = status_code
+        self.response = HttpResponse(headers or {})
+
+
+class RecordingCostClient(object):
+    """Keeps each Cost Management query it is sent, raising the errors in failures first and then answering with result"""
+    queries = []
+    failures = []
+    result = QueryResult([[42.5, "USD"]], ["totalCost", "Currency"])
+
+    def __init__(self, credentials, subscription_id, base_url=None):
+        self.query = self
+
+    def usage(self, scope, parameters):
+        self.queries.append((scope, parameters))
+        if self.failures:
+            raise self.failures.pop(0)
+        return self.result
+
+
+@pytest.fixture
+def cost_client(monkeypatch):
+    monkeypatch.setattr(RecordingCostClient, "queries", [])
+    monkeypatch.setattr(RecordingCostClient, "failures", [])
+    # No real waiting between retries
+    monkeypatch.setattr(cost, "RetryPolicy", functools.partial(RetryPolicy, sleep=lambda seconds: None))
+    monkeypatch.setattr(importlib.import_module("azure.mgmt.costmanagement"), "CostManagementClient", RecordingCostClient)
+    return RecordingCostClient
+
+
+def test_cost_query_is_a_usage_query(cost_client):
+    assert get_subscription_cost(None, "sub-1") == 42.5
+
+    scope, query = cost_client.queries[0]
+    assert scope == "/subscriptions/sub-1"
+    # The Cost Management API rejects a query without a type
+    assert query.type == "Usage"
+    assert query.timeframe == "BillingMonthToDate"
+    assert query.dataset.aggregation["totalCost"].function == "Sum"
+
+
+def test_cost_without_rows_is_zero(cost_client, monkeypatch):
+    monkeypatch.setattr(cost_client, "result", QueryResult([], ["totalCost", "Currency"]))
+    assert get_subscription_cost(None, "sub-1") == 0.0
+
+
+def test_throttled_cost_query_is_retried(cost_client):
+    cost_client.failures = [HttpError(429, {'Retry-After': "1"}), HttpError(503)]
+
+    assert get_subscription_cost(None, "sub-1") == 42.5
+    assert len(cost_client.queries) == 3
+
+
+def test_fatal_cost_query_error_is_not_retried(cost_client):
+    cost_client.failures = [HttpError(403)]
+
+    with pytest.raises(HttpError):
+        get_subscription_cost(None, "sub-1")
+    assert len(cost_client.queries) == 1
+
+
+def test_costs_are_saved_in_one_write_and_reused(aws):
+    fake_estate, counter = aws
+    ids = [s for t in fake_estate.tenants.values() for s in t['subscriptions']]
+    update_items = []
+
+    def count_update(params, **kwargs):
+        update_items.append(params)
+    boto3.DEFAULT_SESSION.events.register('before-call.dynamodb.UpdateItem', count_update)
+    counter.reset()
+
+    costs = collect_subscription_costs(common.load_subscriptions(ids), os.environ['AZURE_SECRET_NAME'])
+
+    assert costs == {sub_id: 123.45 for sub_id in ids}
+    assert counter.reset()['costmanagement.query'] == 6
+    # A single SET of all three attributes per subscription
+    assert len(update_items) == 6
+    record = boto3.resource('dynamodb').Table(os.environ['SUBSCRIPTION_TABLE']).get_item(Key={'subscription_id': ids[0]})['Item']
+    assert float(record['cost']) == 123.45
+    assert record['cost_billing_period'] == current_billing_period()
+    assert 'cost_updated' in record
+
+    # Reloaded, every cost is fresh enough to come from the table
+    assert collect_subscription_costs(common.load_subscriptions(ids), os.environ['AZURE_SECRET_NAME']) == costs
+    assert 'costmanagement.query' not in counter.reset()
+    assert len(update_items) == 6
+    boto3.DEFAULT_SESSION.events.unregister('before-call.dynamodb.UpdateItem', count_update)
+
+
+def test_tenants_are_authenticated_once_before_the_pool(aws, monkeypatch):
+    fake_estate, counter = aws
+    ids = [s for t in fake_estate.tenants.values() for s in t['subscriptions']]
+    monkeypatch.setenv('COST_QUERY_THREADS', "8")
+    monkeypatch.setattr(FakeServicePrincipalCredentials.latency, "token", 0.2)
+
+    token_threads = []
+    credentials_class = importlib.import_module("msrestazure.azure_active_directory").ServicePrincipalCredentials
+
+    def recording_credentials(*args, **kwargs):
+        token_threads.append(threading.current_thread())
+        return credentials_class(*args, **kwargs)
+    monkeypatch.setattr(importlib.import_module("msrestazure.azure_active_directory"), "ServicePrincipalCredentials", recording_credentials)
+    counter.reset()
+
+    costs = collect_subscription_costs(common.load_subscriptions(ids), os.environ['AZURE_SECRET_NAME'])
+
+    assert len(costs) == 6
+    calls = counter.reset()
+    assert calls['aad.token'] == 2
+    assert calls['costmanagement.query'] == 6
+    # Both tokens were requested by the calling thread, none by the query workers
+    assert token_threads == [threading.current_thread()] * 2
@@ -0,0 +1,121 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+from subscription import AntiopeAzureSubscription, get_cached, put_cached, credential_expiry
+from fakes import FakeServicePrincipalCredentials
+
+
+class FakeCredentials(object):
+    def __init__(self, token=None):
+        self.token = token
+
+
+def count_secret_fetches(monkeypatch):
+    """Wraps boto3.client so every secrets manager GetSecretValue is counted"""
+    fetches = []
+    real_client = boto3.client
+
+    def client(service_name, *args, **kwargs):
+        c = real_client(service_name, *args, **kwargs)
+        if service_name == 'secretsmanager':
+            get_secret_value = c.get_secret_value
+
+            def counted(**kw):
+                fetches.append(kw['SecretId'])
+                return get_secret_value(**kw)
+            c.get_secret_value = counted
+        return c
+    monkeypatch.setattr(boto3, "client", client)
+    return fetches
+
+
+def test_one_secret_fetch_and_token_per_tenant(aws, monkeypatch):
+    fake_estate, counter = aws
+    fetches = count_secret_fetches(monkeypatch)
+    counter.reset()
+
+    graph_clients = {}
+    # Twice over, as a second warm invocation would
+    for invocation in range(2):
+        for tenant_name, tenant in fake_estate.tenants.items():
+            for subscription_id in tenant['subscriptions']:
+                target_sub = AntiopeAzureSubscription(subscription_id)
+                target_sub.authenticate(os.environ['AZURE_SECRET_NAME'])
+                graph_clients.setdefault(tenant_name, set()).add(id(target_sub.get_client("ResourceGraphClient")))
+
+    assert fetches == [os.environ['AZURE_SECRET_NAME']]
+    assert counter.reset()['aad.token'] == 2
+    # Resource graph clients are per tenant, so every subscription in a tenant shares one
+    assert {tenant_name: len(ids) for tenant_name, ids in graph_clients.items()} == {"tenant0": 1, "tenant1": 1}
+
+
+def test_expired_credentials_request_a_new_token(aws, monkeypatch):
+    fake_estate, counter = aws
+    subscription_id = fake_estate.tenants["tenant0"]['subscriptions'][0]
+    counter.reset()
+
+    AntiopeAzureSubscription(subscription_id).authenticate(os.environ['AZURE_SECRET_NAME'])
+    # An hour later the token has expired, the secret (15 minutes) has too
+    now = time.time() + 3600
+    monkeypatch.setattr(time, "time", lambda: now)
+    AntiopeAzureSubscription(subscription_id).authenticate(os.environ['AZURE_SECRET_NAME'])
+
+    assert counter.reset()['aad.token'] == 2
+
+
+def test_get_cached_evicts_expired_entries(monkeypatch):
+    cache = {}
+    now = 1000.0
+    monkeypatch.setattr(time, "time", lambda: now)
+
+    put_cached(cache, "fresh", "a", now + 60)
+    put_cached(cache, "stale", "b", now - 1)
+    put_cached(cache, "edge", "c", now)
+
+    assert get_cached(cache, "fresh") == "a"
+    # Looking up any key sweeps every expired entry, not just the one asked for
+    assert list(cache) == ["fresh"]
+    assert get_cached(cache, "stale") is None
+    assert get_cached(cache, "missing") is None
+
+
+def test_credential_expiry(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, "time", lambda: now)
+    monkeypatch.setenv('AZURE_TOKEN_EXPIRY_MARGIN', "300")
+
+    assert credential_expiry(FakeCredentials({'expires_on': "5000"})) == 4700
+    assert credential_expiry(FakeCredentials({'expires_on': 5000.5})) == 4700.5
+    # No token, or one without a usable expiry, is assumed to last the shortest AAD token lifetime
+    assert credential_expiry(FakeCredentials()) == now + 3600 - 300
+    assert credential_expiry(FakeCredentials({'expires_on': "soon"})) == now + 3600 - 300
+    assert credential_expiry(object()) == now + 3600 - 300
+
+
+def test_concurrent_callers_share_one_fetch(aws, monkeypatch):
+    fake_estate, counter = aws
+    fetches = count_secret_fetches(monkeypatch)
+    # Slow enough that every thread misses the cache before the first token arrives
+    monkeypatch.setattr(FakeServicePrincipalCredentials.latency, "token", 0.2)
+    counter.reset()
+
+    subscription_ids = [s for tenant in fake_estate.tenants.values() for s in tenant['subscriptions']] * 2
+    barrier = threading.Barrier(len(subscription_ids))
+
+    def authenticate(subscription_id):
+        target_sub = AntiopeAzureSubscription(subscription_id)
+        barrier.wait()
+        target_sub.authenticate(os.environ['AZURE_SECRET_NAME'])
+        return target_sub.credentials
+
+    with ThreadPoolExecutor(max_workers=len(subscription_ids)) as executor:
+        credentials = list(executor.map(authenticate, subscription_ids))
+
+    assert fetches == [os.environ['AZURE_SECRET_NAME']]
+    assert counter.reset()['aad.token'] == 2
+    # Every subscription in a tenant got the same credentials
+    assert len(set(id(c) for c in credentials)) == 2
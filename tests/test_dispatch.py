@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import types
+
+import boto3
+
+import dispatch
+from dispatch import build_dispatch_schedule, last_dispatch_delay, MAX_DELAY_SECONDS
+from run_tracker import run_deadline_seconds
+from conftest import FakeContext, load_handler
+
+
+def test_schedule_for_1000_subscription_groups():
+    messages = [{'group_id': str(n)} for n in range(1000)]
+
+    schedule = build_dispatch_schedule(messages, 5)
+
+    # 5 seconds apart takes 83 minutes, longer than SQS can delay a message, and the spacing is kept regardless
+    assert [message for delay, message in schedule] == messages
+    assert [delay for delay, message in schedule] == [5 * n for n in range(1000)]
+    assert last_dispatch_delay(1000, 5) == 4995
+
+
+class StubSQS(object):
+    """Keeps the entries sent, SQS (and moto) would hold the delayed ones back"""
+    def __init__(self):
+        self.entries = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.entries.extend(Entries)
+        return {'Successful': [{'Id': e['Id']} for e in Entries]}
+
+
+def test_groups_past_the_longest_delay_go_out_in_waves(monkeypatch):
+    sqs = StubSQS()
+    monkeypatch.setattr(dispatch, "boto3", types.SimpleNamespace(client=lambda service_name: sqs))
+    now = 1000000
+    monkeypatch.setattr(time, "time", lambda: now)
+
+    dispatch.send_to_queue(build_dispatch_schedule([{'group_id': str(n)} for n in range(3)], 600), "test-dispatch")
+
+    assert [e['DelaySeconds'] for e in sqs.entries] == [0, 600, MAX_DELAY_SECONDS]
+    bodies = [json.loads(e['MessageBody']) for e in sqs.entries]
+    assert bodies == [{'group_id': "0"}, {'group_id': "1"}, {'group_id': "2", 'not_before': now + 1200}]
+
+    # The third group arrives after the 15 minute maximum, 5 minutes early, and goes back for the rest of its delay
+    del sqs.entries[:]
+    assert dispatch.requeue_if_early(bodies[2], "test-dispatch", now=now + MAX_DELAY_SECONDS) is True
+    assert [e['DelaySeconds'] for e in sqs.entries] == [300]
+    # Once it is due it is handled
+    assert dispatch.requeue_if_early(bodies[2], "test-dispatch", now=now + 1200) is False
+    assert dispatch.requeue_if_early(bodies[0], "test-dispatch", now=now) is False
+    assert len(sqs.entries) == 1
+
+
+def test_inventory_waits_for_a_group_that_is_not_due(aws, monkeypatch):
+    sqs = StubSQS()
+    monkeypatch.setattr(dispatch, "boto3", types.SimpleNamespace(client=lambda service_name: sqs))
+    monkeypatch.setenv('DISPATCH_QUEUE_URL', "test-dispatch")
+    inventory_vm = load_handler("inventory-vm.py")
+    calls = []
+    monkeypatch.setattr(inventory_vm, "load_subscriptions", lambda ids: calls.append(ids) or [])
+
+    message = {'subscription_id': ["sub-1"], 'not_before': int(time.time()) + 600}
+    inventory_vm.lambda_handler({'Records': [{'body': json.dumps(message)}]}, FakeContext())
+
+    # Nothing was inventoried, and the group is back on the queue
+    assert calls == []
+    assert json.loads(sqs.entries[0]['MessageBody'])['subscription_id'] == ["sub-1"]
+    assert 590 <= sqs.entries[0]['DelaySeconds'] <= 600
+
+
+def test_schedule_keeps_an_interval_that_fits():
+    schedule = build_dispatch_schedule(list(range(10)), 30)
+    assert [delay for delay, message in schedule] == [30 * n for n in range(10)]
+    assert last_dispatch_delay(10, 30) == 270
+
+    assert build_dispatch_schedule([], 30) == []
+    assert last_dispatch_delay(0, 30) == 0
+    assert build_dispatch_schedule(["only"], 30) == [(0, "only")]
+    assert last_dispatch_delay(1, 30) == 0
+
+
+def test_deadline_covers_the_last_group(monkeypatch):
+    monkeypatch.setenv('LAMBDA_TIMEOUT', "300")
+    monkeypatch.setenv('RUN_DEADLINE_MARGIN_SECONDS', "120")
+
+    assert run_deadline_seconds() == 420
+    assert run_deadline_seconds(last_dispatch_delay(1000, 5)) == 4995 + 300 + 120
+
+
+def test_trigger_sets_the_deadline_from_the_schedule(aws, monkeypatch):
+    fake_estate, counter = aws
+    monkeypatch.setenv('LAMBDA_TIMEOUT', "300")
+    monkeypatch.setenv('RUN_DEADLINE_MARGIN_SECONDS', "120")
+    monkeypatch.setenv('SNS_DELAY', "60")
+    # One subscription per group, so the six groups are dispatched 0 to 300 seconds apart
+    monkeypatch.setenv('NUM_SUBS_IN_GROUP', "1")
+    monkeypatch.setenv('GROUP_RESOURCE_BUDGET', "1")
+    subscription_ids = [s for t in fake_estate.tenants.values() for s in t['subscriptions']]
+
+    event = load_handler("trigger_sub_actions.py").handler({'subscription_list': subscription_ids}, None)
+
+    run = boto3.resource('dynamodb').Table(os.environ['RUN_TABLE']).get_item(Key={'run_id': event['run_id']})['Item']
+    assert run['expected_groups'] == 6
+    assert run['deadline'] - run['started'] == 5 * 60 + 300 + 120
@@ -0,0 +1,213 @@
+import gc
+import io
+import os
+import time
+
+import boto3
+import pytest
+import pyarrow.parquet as pq
+
+import common
+import reports
+from shards import ShardedResourceWriter
+from collectors import COLLECTORS, run_collectors
+from fakes import FakeResourceGraphClient, estate_subscriptions
+from conftest import load_handler
+
+
+@pytest.fixture
+def export_parquet(aws, monkeypatch):
+    """The export-parquet module, with S3's 5 MiB minimum part size lowered so small files still go up in several parts"""
+    import moto.s3.models
+    monkeypatch.setattr(moto.s3.models, "S3_UPLOAD_PART_MIN_SIZE", 1024)
+    monkeypatch.setattr(reports, "MIN_PART_SIZE", 1024)
+    return load_handler("export-parquet.py")
+
+
+def vm_records(fake_estate):
+    collector = COLLECTORS["microsoft.compute/virtualmachines"]
+    return [collector.build_resource_item(target_sub, row, {})
+            for target_sub in estate_subscriptions(fake_estate) for row in fake_estate.vm_rows(target_sub.subscription_id)]
+
+
+def read_parquet(key):
+    body = boto3.client('s3').get_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=key)['Body'].read()
+    return pq.ParquetFile(io.BytesIO(body))
+
+
+def test_partitions_stream_to_s3(aws, export_parquet):
+    fake_estate, counter = aws
+    records = vm_records(fake_estate)
+    writer = export_parquet.PartitionedParquetWriter("Azure-Parquet/2021-03-01", row_group_size=5, part_size=1024)
+    for record in records:
+        writer.add(record)
+    streams = [partition['stream'] for partition in writer.partitions.values()]
+
+    objects = writer.close()
+
+    assert sorted(objects) == ["Azure-Parquet/2021-03-01/tenant={}/resource_type=Azure_Compute_VM/part-0000.parquet".format(t) for t in ("tenant0", "tenant1")]
+    # Sent a part at a time as the row groups were written, not held until the end
+    assert all(len(stream.parts) > 1 for stream in streams)
+    for key in objects:
+        parquet = read_parquet(key)
+        assert parquet.metadata.num_rows == 15
+        assert parquet.metadata.num_row_groups == 3
+        assert parquet.schema_arrow == export_parquet.SCHEMA
+
+
+@pytest.mark.filterwarnings("error::pytest.PytestUnraisableExceptionWarning")
+def test_abort_leaves_nothing_behind(aws, export_parquet):
+    fake_estate, counter = aws
+    writer = export_parquet.PartitionedParquetWriter("Azure-Parquet/2021-03-01", row_group_size=5, part_size=1024)
+    for record in vm_records(fake_estate):
+        writer.add(record)
+
+    writer.abort()
+    # The parquet writers were closed by abort(), collecting them must not write into the aborted uploads
+    del writer
+    gc.collect()
+
+    s3_client = boto3.client('s3')
+    assert s3_client.list_objects_v2(Bucket=os.environ['INVENTORY_BUCKET'], Prefix="Azure-Parquet/")['KeyCount'] == 0
+    assert 'Uploads' not in s3_client.list_multipart_uploads(Bucket=os.environ['INVENTORY_BUCKET'])
+
+
+def write_shards(records, **kwargs):
+    writer = ShardedResourceWriter(**kwargs)
+    for record in records:
+        writer.write("vm/instance", record['resourceId'], record)
+    assert writer.close() == []
+
+
+def test_reads_only_the_runs_shards(aws, export_parquet):
+    fake_estate, counter = aws
+    records = vm_records(fake_estate)
+    write_shards(records[:20], run_id="run-a", run_date="2021-03-01", compression="gzip")
+    # A continuation of the same run, with zstd
+    write_shards(records[20:], run_id="run-a", run_date="2021-03-01", compression="zstd")
+    # Another run the same day, and the same run's id on another day, are both left out
+    write_shards(records[:5], run_id="run-b", run_date="2021-03-01")
+    write_shards(records[:5], run_id="run-a", run_date="2021-03-02")
+
+    read = list(export_parquet.read_shard_records("2021-03-01", "run-a"))
+    assert sorted(r['resourceId'] for r in read) == sorted(r['resourceId'] for r in records)
+
+    # Without a run every manifest of the day is read
+    assert len(list(export_parquet.read_shard_records("2021-03-01"))) == 35
+
+
+def test_handler_exports_the_runs_shards(aws, export_parquet, monkeypatch):
+    fake_estate, counter = aws
+    monkeypatch.setenv('OUTPUT_FORMAT', "ndjson")
+    write_shards(vm_records(fake_estate), run_id="run-a", run_date="2021-03-01", compression="zstd")
+
+    event = export_parquet.handler({'run_id': "run-a", 'run_date': "2021-03-01"}, None)
+
+    assert event['parquet_objects'] == 2
+    assert read_parquet("Azure-Parquet/2021-03-01/tenant=tenant0/resource_type=Azure_Compute_VM/part-0000.parquet").metadata.num_rows == 15
+
+
+def test_incremental_ndjson_is_rejected(aws, export_parquet, monkeypatch):
+    monkeypatch.setenv('OUTPUT_FORMAT', "ndjson")
+    monkeypatch.setenv('INCREMENTAL_INVENTORY', "True")
+
+    with pytest.raises(export_parquet.ExportError):
+        export_parquet.handler({'run_id': "run-a", 'run_date': "2021-03-01"}, None)
+
+
+def save_objects(records):
+    with common.ResourceWriter() as writer:
+        for record in records:
+            writer.write("vm/instance", record['resourceId'], record)
+        assert writer.flush() == []
+
+
+def test_objects_from_before_the_run_are_left_out(aws, export_parquet):
+    fake_estate, counter = aws
+    records = vm_records(fake_estate)
+    save_objects(records[:5])
+
+    # S3 keeps LastModified to the second
+    time.sleep(1.1)
+    run_started = int(time.time())
+    save_objects(records[5:])
+
+    read = list(export_parquet.read_object_records(run_started))
+    assert sorted(r['resourceId'] for r in read) == sorted(r['resourceId'] for r in records[5:])
+    assert len(list(export_parquet.read_object_records())) == 30
+
+
+def test_incremental_export_follows_the_manifests(aws, export_parquet, monkeypatch):
+    fake_estate, counter = aws
+    monkeypatch.setenv('INCREMENTAL_INVENTORY', "True")
+    tenant = fake_estate.tenants["tenant0"]
+    target_subs = [s for s in estate_subscriptions(fake_estate) if s.tenant_id == tenant['tenant_id']]
+    collectors = [COLLECTORS["microsoft.compute/virtualmachines"]]
+
+    with common.ResourceWriter() as writer:
+        run_collectors(target_subs, FakeResourceGraphClient(), writer, collectors=collectors)
+    # One virtual machine is deleted before the next run, which writes a delete marker in its place
+    deleted = fake_estate.vm_rows(tenant['subscriptions'][0]).pop()
+    with common.ResourceWriter() as writer:
+        run_collectors(target_subs, FakeResourceGraphClient(), writer, collectors=collectors)
+
+    read = list(export_parquet.read_object_records())
+    # Unchanged resources were not rewritten on the second run, but are still current
+    assert len(read) == 14
+    assert deleted['id'] not in [r['configuration']['id'] for r in read]
+    assert all(r.get('configurationItemStatus') != "ResourceDeleted" for r in read)
+
+
+def test_tenant_partitions_use_the_slug(aws, export_parquet):
+    fake_estate, counter = aws
+    records = vm_records(fake_estate)[:2]
+    records[0]['azureTenantName'] = "Contoso Ltd/EU"
+    writer = export_parquet.PartitionedParquetWriter("Azure-Parquet/2021-03-01")
+    for record in records:
+        writer.add(record)
+
+    assert sorted(writer.close()) == ["Azure-Parquet/2021-03-01/tenant=contoso-ltd-eu/resource_type=Azure_Compute_VM/part-0000.parquet",
+                                      "Azure-Parquet/2021-03-01/tenant=tenant0/resource_type=Azure_Compute_VM/part-0000.parquet"]
+
+
+def test_buffered_rows_and_parts_stay_under_the_budget(aws, export_parquet):
+    fake_estate, counter = aws
+    records = vm_records(fake_estate)
+    # Six partitions, one per subscription, and room for only a few rows across all of them. The parts are big
+    # enough that nothing is sent until a file is finished, so the budget has to finish some early
+    for record in records:
+        record['azureTenantName'] = record['azureSubscriptionId']
+    budget = 3 * max(export_parquet.row_size(export_parquet.flatten_record(r)) for r in records)
+    writer = export_parquet.PartitionedParquetWriter("Azure-Parquet/2021-03-01", row_group_size=1000, part_size=1024 * 1024, buffer_size=budget)
+
+    peak = 0
+    for record in records:
+        writer.add(record)
+        peak = max(peak, writer.buffered())
+        # The estimate matches what the partitions actually hold
+        assert writer.buffered_parts == sum(p['stream'].buffered for p in writer.partitions.values())
+        assert writer.buffered_rows == sum(p['bytes'] for p in writer.partitions.values())
+    objects = writer.close()
+
+    assert peak <= budget
+    # Partitions finished early carry on in a new file, and no row is lost
+    assert len(objects) > 6
+    assert sum(read_parquet(key).metadata.num_rows for key in objects) == 30
+    assert len(set(objects)) == len(objects)
+
+
+def test_abort_deletes_partitions_finished_early(aws, export_parquet):
+    fake_estate, counter = aws
+    records = vm_records(fake_estate)
+    for record in records:
+        record['azureTenantName'] = record['azureSubscriptionId']
+    writer = export_parquet.PartitionedParquetWriter("Azure-Parquet/2021-03-01", row_group_size=1000, part_size=1024 * 1024, buffer_size=4096)
+    for record in records:
+        writer.add(record)
+    assert writer.objects
+
+    writer.abort()
+
+    s3_client = boto3.client('s3')
+    assert s3_client.list_objects_v2(Bucket=os.environ['INVENTORY_BUCKET'], Prefix="Azure-Parquet/")['KeyCount'] == 0
+    assert 'Uploads' not in s3_client.list_multipart_uploads(Bucket=os.environ['INVENTORY_BUCKET'])
@@ -0,0 +1,99 @@
+import copy
+import time
+
+from collectors import COLLECTORS
+from incremental import ResourceManifest, content_hash, load_manifest
+from fakes import FakeEstate, estate_subscriptions
+
+DAY = 86400
+
+
+def fixture_rows(count=3):
+    """Fake resource graph rows for count VMs in one subscription"""
+    estate = FakeEstate(tenants=1, subscriptions_per_tenant=1, vms_per_subscription=count)
+    target_sub = estate_subscriptions(estate)[0]
+    return target_sub, estate.vm_rows(target_sub.subscription_id)
+
+
+def fixture_vms(count=3):
+    """VM resource_items built by the collector from fake resource graph rows, as inventory-vm would save them"""
+    target_sub, rows = fixture_rows(count)
+    collector = COLLECTORS["microsoft.compute/virtualmachines"]
+    return target_sub, [collector.build_resource_item(target_sub, row, {}) for row in rows]
+
+
+def test_content_hash_ignores_capture_time():
+    target_sub, vms = fixture_vms(1)
+    later = copy.deepcopy(vms[0])
+    later['configurationItemCaptureTime'] = "2099-01-01 00:00:00.000000"
+
+    assert later != vms[0]
+    assert content_hash(later) == content_hash(vms[0])
+
+
+def test_content_hash_sees_configuration_changes():
+    target_sub, vms = fixture_vms(1)
+    resized = copy.deepcopy(vms[0])
+    resized['configuration']['properties']['hardwareProfile']['vmSize'] = "Standard_D4s_v3"
+    retagged = copy.deepcopy(vms[0])
+    retagged['tags'] = {'environment': "production"}
+
+    assert content_hash(resized) != content_hash(vms[0])
+    assert content_hash(retagged) != content_hash(vms[0])
+
+
+def test_content_hash_does_not_depend_on_key_order():
+    target_sub, vms = fixture_vms(1)
+    reordered = dict(reversed(list(vms[0].items())))
+    assert content_hash(reordered) == content_hash(vms[0])
+
+
+def test_manifest_changed():
+    # The collectors hash the resource graph row, keyed by its id
+    target_sub, rows = fixture_rows(2)
+    now = 1600000000
+    manifest = ResourceManifest("vm/instance", target_sub.subscription_id)
+    manifest.max_age = 7 * DAY
+    row, other = rows
+    digest = content_hash(row)
+
+    # New, then unchanged, then changed
+    assert manifest.changed(row['id'], digest, now=now)
+    manifest.record(row['id'], digest, "object-0", now=now)
+    assert not manifest.changed(row['id'], digest, now=now + DAY)
+    assert manifest.changed(row['id'], content_hash(other), now=now + DAY)
+
+    # Unchanged but not written for max_age is written again, and ids are matched whatever their case
+    assert manifest.changed(row['id'].upper(), digest, now=now + 7 * DAY)
+
+
+def test_manifest_removed():
+    target_sub, rows = fixture_rows(3)
+    now = 1600000000
+    manifest = ResourceManifest("vm/instance", target_sub.subscription_id)
+    for n, row in enumerate(rows):
+        manifest.record(row['id'], content_hash(row), "object-{}".format(n), now=now)
+
+    # The next run only sees the first two
+    rerun = ResourceManifest("vm/instance", target_sub.subscription_id, entries=manifest.entries)
+    for row in rows[:2]:
+        rerun.changed(row['id'], content_hash(row), now=now + DAY)
+
+    assert rerun.removed() == {rows[2]['id'].lower(): "object-2"}
+    # Forgotten once reported, so it is only removed once
+    assert rerun.removed() == {}
+    assert len(rerun.entries) == 2
+
+
+def test_manifest_round_trip(aws):
+    target_sub, rows = fixture_rows(2)
+    manifest = load_manifest("vm/instance", target_sub.subscription_id)
+    assert manifest.entries == {}
+
+    for n, row in enumerate(rows):
+        manifest.record(row['id'], content_hash(row), "object-{}".format(n), now=int(time.time()))
+    manifest.save()
+
+    loaded = load_manifest("vm/instance", target_sub.subscription_id)
+    assert loaded.entries == manifest.entries
+    assert not loaded.changed(rows[0]['id'], content_hash(rows[0]))
@@ -0,0 +1,99 @@
+import pytest
+
+import common
+from subscription import SubscriptionLookupError
+
+TABLE = "test-subscriptions"
+
+
+class StubTable(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class StubDynamoDB(object):
+    """
+    Stands in for the boto3 DynamoDB resource. Holds the records, answers batch_get_item from them and keeps each
+    request's keys. unprocessed is how many keys to hand back unprocessed on each successive call.
+    """
+    def __init__(self, records, unprocessed=()):
+        self.records = {r['subscription_id']: r for r in records}
+        self.unprocessed = list(unprocessed)
+        self.requests = []
+
+    def Table(self, name):
+        return StubTable(name)
+
+    def batch_get_item(self, RequestItems):
+        keys = RequestItems[TABLE]['Keys']
+        assert len(keys) <= 100
+        self.requests.append([k['subscription_id'] for k in keys])
+
+        held_back = self.unprocessed.pop(0) if self.unprocessed else 0
+        served, unserved = keys[:len(keys) - held_back], keys[len(keys) - held_back:]
+        response = {'Responses': {TABLE: [self.records[k['subscription_id']] for k in served if k['subscription_id'] in self.records]}}
+        if unserved:
+            response['UnprocessedKeys'] = {TABLE: {'Keys': unserved}}
+        return response
+
+
+def records(count):
+    return [{'subscription_id': "sub-{:04d}".format(n), 'tenant_name': "tenant0"} for n in range(count)]
+
+
+@pytest.fixture
+def stub_dynamodb(monkeypatch):
+    monkeypatch.setenv('SUBSCRIPTION_TABLE', TABLE)
+    sleeps = []
+    monkeypatch.setattr(common.time, "sleep", sleeps.append)
+
+    def install(stub):
+        monkeypatch.setattr(common.boto3, "resource", lambda service_name, *args, **kwargs: stub)
+        return stub
+    install.sleeps = sleeps
+    return install
+
+
+def test_one_request_per_100_subscriptions(stub_dynamodb):
+    stub = stub_dynamodb(StubDynamoDB(records(250)))
+    ids = ["sub-{:04d}".format(n) for n in range(250)]
+
+    subs = common.load_subscriptions(ids)
+
+    assert [len(r) for r in stub.requests] == [100, 100, 50]
+    assert [s.subscription_id for s in subs] == ids
+    assert subs[0].tenant_name == "tenant0"
+    assert stub_dynamodb.sleeps == []
+
+
+def test_missing_subscriptions_are_left_out(stub_dynamodb):
+    stub = stub_dynamodb(StubDynamoDB(records(3)))
+
+    subs = common.load_subscriptions(["sub-0002", "sub-9999", "sub-0000"])
+
+    assert len(stub.requests) == 1
+    assert [s.subscription_id for s in subs] == ["sub-0002", "sub-0000"]
+
+
+def test_unprocessed_keys_are_retried(stub_dynamodb):
+    # The first request only gets to 60 of its 100 keys, the retry of the other 40 gets to 30, the next gets the last 10
+    stub = stub_dynamodb(StubDynamoDB(records(150), unprocessed=[40, 10]))
+    ids = ["sub-{:04d}".format(n) for n in range(150)]
+
+    subs = common.load_subscriptions(ids)
+
+    assert [len(r) for r in stub.requests] == [100, 40, 10, 50]
+    assert stub.requests[1] == ids[60:100]
+    assert [s.subscription_id for s in subs] == ids
+    assert stub_dynamodb.sleeps == [0.1, 0.2]
+
+
+def test_gives_up_after_eight_retries(stub_dynamodb):
+    stub = stub_dynamodb(StubDynamoDB(records(5), unprocessed=[1] * 20))
+
+    with pytest.raises(SubscriptionLookupError):
+        common.load_subscriptions(["sub-{:04d}".format(n) for n in range(5)])
+
+    assert len(stub.requests) == 9
+    assert len(stub_dynamodb.sleeps) == 8
+    assert max(stub_dynamodb.sleeps) <= 5
@@ -0,0 +1,122 @@
+import json
+import importlib
+
+import pytest
+
+import metrics
+from metrics import MetricsLogger, EMF_MAX_METRICS
+from fakes import FakeSubscriptionClient
+from conftest import FakeContext, load_handler
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def enabled_logger(monkeypatch, **kwargs):
+    monkeypatch.setenv('METRICS_ENABLED', "True")
+    monkeypatch.setenv('AWS_LAMBDA_FUNCTION_NAME', "inventory-vm")
+    lines = []
+    return MetricsLogger(namespace="Test/Azure", emit=lines.append, **kwargs), lines
+
+
+def test_payloads_are_embedded_metric_format(monkeypatch):
+    clock = FakeClock()
+    logger, lines = enabled_logger(monkeypatch, clock=clock)
+
+    logger.count("Resources", 5, Tenant="tenant0", Subscription="sub0")
+    logger.count("Resources", 2, Tenant="tenant0", Subscription="sub0")
+    logger.count("Throttles", Tenant="tenant0")
+    with logger.span("Collect", Tenant="tenant0"):
+        clock.now += 1.5
+
+    documents = logger.payloads(timestamp=1600000000000)
+
+    # One document per set of dimensions, with values under the same name and dimensions summed
+    assert documents == [
+        {
+            '_aws': {
+                'Timestamp': 1600000000000,
+                'CloudWatchMetrics': [{
+                    'Namespace': "Test/Azure",
+                    'Dimensions': [["Function", "Subscription", "Tenant"]],
+                    'Metrics': [{'Name': "Resources", 'Unit': "Count"}],
+                }],
+            },
+            'Function': "inventory-vm", 'Subscription': "sub0", 'Tenant': "tenant0",
+            'Resources': 7,
+        },
+        {
+            '_aws': {
+                'Timestamp': 1600000000000,
+                'CloudWatchMetrics': [{
+                    'Namespace': "Test/Azure",
+                    'Dimensions': [["Function", "Tenant"]],
+                    'Metrics': [{'Name': "CollectCount", 'Unit': "Count"}, {'Name': "CollectTime", 'Unit': "Milliseconds"},
+                                {'Name': "Throttles", 'Unit': "Count"}],
+                }],
+            },
+            'Function': "inventory-vm", 'Tenant': "tenant0",
+            'CollectCount': 1, 'CollectTime': 1500.0, 'Throttles': 1,
+        },
+    ]
+
+
+def test_documents_are_split_at_the_metric_limit(monkeypatch):
+    logger, lines = enabled_logger(monkeypatch)
+    for n in range(EMF_MAX_METRICS + 1):
+        logger.count("Metric{:03d}".format(n))
+
+    documents = logger.payloads()
+    assert [len(d['_aws']['CloudWatchMetrics'][0]['Metrics']) for d in documents] == [EMF_MAX_METRICS, 1]
+    assert "Metric100" in documents[1]
+
+
+def test_flush_writes_one_line_per_document_and_resets(monkeypatch):
+    logger, lines = enabled_logger(monkeypatch)
+    logger.count("Resources", 3, Tenant="tenant0")
+    logger.count("Resources", 4, Tenant="tenant1")
+
+    logger.flush()
+    assert [json.loads(line)['Resources'] for line in lines] == [3, 4]
+
+    del lines[:]
+    logger.flush()
+    assert lines == []
+    assert logger.payloads() == []
+
+
+def test_disabled_logger_records_nothing(monkeypatch):
+    monkeypatch.setenv('METRICS_ENABLED', "False")
+    lines = []
+    logger = MetricsLogger(emit=lines.append)
+    logger.count("Resources", 3)
+    logger.flush()
+
+    assert lines == []
+    assert logger.payloads() == []
+
+
+def test_handler_flushes_when_it_raises(aws, monkeypatch):
+    fake_estate, counter = aws
+
+    class BrokenSubscriptionClient(FakeSubscriptionClient):
+        def list(self):
+            raise Exception("AADSTS7000215: Invalid client secret")
+    monkeypatch.setattr(importlib.import_module("azure.mgmt.subscription"), "SubscriptionClient", BrokenSubscriptionClient)
+
+    lines = []
+    monkeypatch.setattr(metrics.metrics, "enabled", True)
+    monkeypatch.setattr(metrics.metrics, "emit", lines.append)
+    inventory_subs = load_handler("inventory-subs.py")
+
+    # Every tenant fails, so there are no subscriptions, but the tenants' discovery times are still written out
+    with pytest.raises(Exception, match="No Subscriptions found"):
+        inventory_subs.handler({}, FakeContext())
+    documents = [json.loads(line) for line in lines]
+    assert sorted(d['Tenant'] for d in documents) == sorted(t['tenant_id'] for t in fake_estate.tenants.values())
+    assert all(d['TenantDiscoveryCount'] == 1 for d in documents)
@@ -0,0 +1,106 @@
+import threading
+
+import collectors
+from collectors import run_collectors, COLLECTORS, ResourceCollector
+from pipeline import run_collectors_async
+from fakes import FakeResourceGraphClient, estate_subscriptions
+
+
+VM_COLLECTOR = COLLECTORS["microsoft.compute/virtualmachines"]
+
+
+class ListWriter(object):
+    """Keeps what would have been saved to S3"""
+    def __init__(self):
+        self.written = []
+
+    def write(self, prefix, resource_id, resource):
+        self.written.append((prefix, resource_id, resource))
+
+    def flush(self):
+        return []
+
+    def close(self):
+        return []
+
+
+def tenant_subs(fake_estate):
+    tenant = fake_estate.tenants["tenant0"]
+    return [s for s in estate_subscriptions(fake_estate) if s.tenant_id == tenant['tenant_id']]
+
+
+def saved(writer):
+    """What was written, without the capture time that differs from run to run"""
+    return sorted((prefix, resource_id, sorted((k, str(v)) for k, v in resource.items() if k != 'configurationItemCaptureTime'))
+                  for prefix, resource_id, resource in writer.written)
+
+
+def test_same_output_as_run_collectors(estate, monkeypatch):
+    fake_estate, counter = estate
+    # Several pages and batches, so the stages overlap
+    monkeypatch.setenv('GRAPH_QUERY_PAGE_SIZE', "4")
+    monkeypatch.setenv('ENRICH_BATCH_SIZE', "2")
+    target_subs = tenant_subs(fake_estate)
+
+    sync_writer = ListWriter()
+    expected = run_collectors(target_subs, FakeResourceGraphClient(), sync_writer, collectors=[VM_COLLECTOR])
+
+    # Routing pages and writing batches both use the Collection, so they have to run on the same thread
+    threads = {}
+    for name in ("route", "write_batch"):
+        def recording(self, *args, __method=getattr(collectors.Collection, name), __name=name):
+            threads.setdefault(__name, set()).add(threading.current_thread())
+            return __method(self, *args)
+        monkeypatch.setattr(collectors.Collection, name, recording)
+
+    async_writer = ListWriter()
+    result = run_collectors_async(target_subs, FakeResourceGraphClient(), async_writer, collectors=[VM_COLLECTOR])
+
+    assert result.resource_counts == expected.resource_counts == {sub_id.lower(): 5 for sub_id in fake_estate.tenants["tenant0"]['subscriptions']}
+    assert result.complete and result.skip_token is None
+    assert len(async_writer.written) == 15
+    assert saved(async_writer) == saved(sync_writer)
+    assert len(threads['route'] | threads['write_batch']) == 1
+    assert threads['route'] != {threading.main_thread()}
+
+
+def test_enrich_failure_stops_every_stage(estate, monkeypatch):
+    fake_estate, counter = estate
+    monkeypatch.setenv('GRAPH_QUERY_PAGE_SIZE', "4")
+    monkeypatch.setenv('ENRICH_BATCH_SIZE', "1")
+    monkeypatch.setenv('PIPELINE_QUEUE_SIZE', "1")
+    raised = []
+
+    def enrich(target_subs, rows, management_client):
+        raise ValueError("enrichment failed")
+    failing_collector = ResourceCollector(VM_COLLECTOR.resource_type, VM_COLLECTOR.graph_type, VM_COLLECTOR.prefix, enrich=enrich)
+
+    def run():
+        try:
+            run_collectors_async(tenant_subs(fake_estate), FakeResourceGraphClient(), ListWriter(), collectors=[failing_collector])
+        except Exception as e:
+            raised.append(e)
+
+    # The fetch stage is held up on a full queue when enrichment fails, it must not be left waiting there
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+
+    assert not thread.is_alive()
+    assert len(raised) == 1
+    assert isinstance(raised[0], ValueError)
+
+
+def test_should_stop_returns_the_next_skip_token(estate, monkeypatch):
+    fake_estate, counter = estate
+    monkeypatch.setenv('GRAPH_QUERY_PAGE_SIZE', "4")
+    writer = ListWriter()
+
+    result = run_collectors_async(tenant_subs(fake_estate), FakeResourceGraphClient(), writer, collectors=[VM_COLLECTOR], should_stop=lambda: True)
+
+    # Stopped after the first page, the continuation picks up from the second
+    assert result.skip_token == "4"
+    assert not result.complete
+    assert result.resume_state is not None
+    assert sum(result.resource_counts.values()) == 4
+    assert len(writer.written) == 4
@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+
+from planner import plan_groups, estimate_graph_calls, tenant_call_budget
+
+
+def subscription(sub_id, tenant, resource_count):
+    return SimpleNamespace(subscription_id=sub_id, tenant_name=tenant, resource_count=resource_count)
+
+
+def test_graph_calls_cover_pages_and_enrichment(monkeypatch):
+    monkeypatch.setenv('GRAPH_QUERY_PAGE_SIZE', '1000')
+    monkeypatch.setenv('ENRICH_BATCH_SIZE', '100')
+    assert estimate_graph_calls(subscription("a", "t", 0)) == 1
+    assert estimate_graph_calls(subscription("a", "t", 2500)) == 3 + 25
+
+
+def test_call_budget_follows_the_lambda_timeout(monkeypatch):
+    monkeypatch.setenv('LAMBDA_TIMEOUT', '900')
+    monkeypatch.setenv('CHECKPOINT_RESERVE_SECONDS', '120')
+    # 15 queries every 5 seconds for the 780 seconds before the checkpoint
+    assert tenant_call_budget() == 2340
+
+    monkeypatch.setenv('LAMBDA_TIMEOUT', '300')
+    assert tenant_call_budget() == 540
+
+
+def test_groups_split_when_a_tenant_would_run_out_of_queries(monkeypatch):
+    monkeypatch.setenv('NUM_SUBS_IN_GROUP', '10')
+    monkeypatch.setenv('ENRICH_BATCH_SIZE', '100')
+    subs = [subscription("sub-{}".format(i), "tenant", 5000) for i in range(4)]
+
+    # Each subscription is 5 pages and 50 enrichment queries, the resource budget alone would allow one group
+    assert len(plan_groups(subs, budget=100000, call_budget=10000)) == 1
+    groups = plan_groups(subs, budget=100000, call_budget=120)
+    assert [len(group) for group in groups] == [2, 2]
+
+    # Another tenant's subscriptions have their own quota
+    subs += [subscription("other-{}".format(i), "other", 5000) for i in range(2)]
+    groups = plan_groups(subs, budget=100000, call_budget=120)
+    assert len(groups) == 2
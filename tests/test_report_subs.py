@@ -0,0 +1,32 @@
+import re
+import datetime
+
+import boto3
+
+from conftest import load_handler
+
+
+def subscription_record(n, tenant_name):
+    return {'subscription_id': "20000000-0000-0000-0000-{:012d}".format(n), 'display_name': "subscription-{}".format(n),
+            'tenant_name': tenant_name, 'tenant_id': "10000000-0000-0000-0000-000000000000", 'subscription_state': "Enabled",
+            'queryable': "true", 'cost': 10.0 * n}
+
+
+def test_tenant_links_point_at_the_reports(aws):
+    tenant_names = ["Contoso Ltd", "contoso/ltd", "Fabrikam & Co", "東京"]
+    subscriptions = [subscription_record(n, name) for n, name in enumerate(tenant_names)]
+    json_data = {'subscriptions': subscriptions, 'timestamp': datetime.datetime.now(), 'subscription_count': len(subscriptions), 'bucket': "benchmark-inventory"}
+    s3_client = boto3.client('s3')
+
+    load_handler("report-subs.py").write_tenant_reports(json_data, s3_client)
+
+    index = s3_client.get_object(Bucket="benchmark-inventory", Key="Reports/azure_subscription_inventory.html")['Body'].read().decode('utf-8')
+    hrefs = re.findall(r'<a href="([^"]+)">', index)
+    assert hrefs == ["azure_subscription_inventory/contoso-ltd.html", "azure_subscription_inventory/contoso-ltd-2.html",
+                     "azure_subscription_inventory/fabrikam-co.html", "azure_subscription_inventory/tenant.html"]
+
+    # Each link, resolved against Reports/ like a browser would, is the key of that tenant's page
+    for href, tenant_name in zip(hrefs, tenant_names):
+        page = s3_client.get_object(Bucket="benchmark-inventory", Key="Reports/" + href)['Body'].read().decode('utf-8')
+        assert "<h1>Azure Subscription Inventory - {}</h1>".format(tenant_name) in page
+        assert '<a href="../azure_subscription_inventory.html">All tenants</a>' in page
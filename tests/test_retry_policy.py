@@ -0,0 +1,208 @@
+import datetime
+
+import pytest
+
+from retry_policy import RetryPolicy, TokenBucket, classify_error, parse_retry_after, parse_quota_headers
+
+
+class FakeClock(object):
+    """A clock that only moves when something sleeps on it"""
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class HttpResponse(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class HttpError(Exception):
+    """Shaped like the msrest errors, with the status code and headers on the response"""
+    def __init__(self, status_code, headers=None):
+        super(HttpError, self).__init__("HTTP {}".format(status_code))
+        self.status_code = status_code
+        self.response = HttpResponse(headers or {})
+
+
+class ClientRequestError(Exception):
+    """Shaped like msrest's ClientRequestError, no response and the cause in inner_exception"""
+    def __init__(self, inner_exception):
+        super(ClientRequestError, self).__init__(str(inner_exception))
+        self.inner_exception = inner_exception
+
+
+def failing(*errors):
+    """A callable raising each of errors in turn, then returning "ok" """
+    calls = []
+
+    def func():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return "ok"
+    func.calls = calls
+    return func
+
+
+def policy(clock, rand=lambda: 1.0, **kwargs):
+    return RetryPolicy(max_attempts=kwargs.pop('max_attempts', 5), base_delay=1, max_delay=30, max_elapsed=kwargs.pop('max_elapsed', 120),
+                       clock=clock, sleep=clock.sleep, rand=rand)
+
+
+def test_backoff_doubles_up_to_max_delay():
+    retry = policy(FakeClock())
+    assert [retry.backoff(attempt) for attempt in range(1, 8)] == [1, 2, 4, 8, 16, 30, 30]
+
+
+def test_backoff_jitter_stays_within_bounds():
+    for rand in (0.0, 0.25, 0.999):
+        retry = policy(FakeClock(), rand=lambda: rand)
+        for attempt in range(1, 10):
+            assert 0 <= retry.backoff(attempt) <= min(30, 2 ** (attempt - 1))
+
+
+def test_backoff_never_less_than_retry_after():
+    retry = policy(FakeClock(), rand=lambda: 0.1)
+    assert retry.backoff(1, retry_after=7) == 7
+    assert retry.backoff(6, retry_after=1) == pytest.approx(3.0)
+
+
+def test_retry_after_seconds():
+    assert parse_retry_after({'Retry-After': "12"}) == 12
+    assert parse_retry_after({'Retry-After': "-3"}) == 0
+    assert parse_retry_after({}) is None
+    assert parse_retry_after({'Retry-After': "soon"}) is None
+
+
+def test_retry_after_http_date():
+    now = datetime.datetime(2021, 3, 1, 12, 0, 0, tzinfo=datetime.timezone.utc)
+    assert parse_retry_after({'Retry-After': "Mon, 01 Mar 2021 12:00:45 GMT"}, now=now) == 45
+    # A date already gone means retry straight away
+    assert parse_retry_after({'Retry-After': "Mon, 01 Mar 2021 11:59:00 GMT"}, now=now) == 0
+
+
+def test_classify_retryable_and_fatal():
+    for status_code in (408, 429, 500, 502, 503, 504):
+        assert classify_error(HttpError(status_code)) == (True, None)
+    for status_code in (400, 401, 403, 404):
+        assert classify_error(HttpError(status_code)) == (False, None)
+
+    assert classify_error(HttpError(429, {'Retry-After': "5"})) == (True, 5)
+    assert classify_error(ClientRequestError(ConnectionResetError())) == (True, None)
+    assert classify_error(ClientRequestError(TimeoutError())) == (True, None)
+    assert classify_error(ValueError("bad query")) == (False, None)
+
+
+def test_call_retries_then_succeeds():
+    clock = FakeClock()
+    func = failing(HttpError(503), HttpError(500))
+
+    assert policy(clock).call(func) == "ok"
+    assert len(func.calls) == 3
+    assert clock.sleeps == [1, 2]
+
+
+def test_call_raises_fatal_error_at_once():
+    clock = FakeClock()
+    func = failing(HttpError(403))
+
+    with pytest.raises(HttpError):
+        policy(clock).call(func)
+    assert len(func.calls) == 1
+    assert clock.sleeps == []
+
+
+def test_call_gives_up_after_max_attempts():
+    clock = FakeClock()
+    func = failing(*[HttpError(503)] * 10)
+
+    with pytest.raises(HttpError):
+        policy(clock, max_attempts=3).call(func)
+    assert len(func.calls) == 3
+    assert clock.sleeps == [1, 2]
+
+
+def test_call_gives_up_when_retry_after_exceeds_budget():
+    clock = FakeClock()
+    func = failing(HttpError(429, {'Retry-After': "600"}))
+
+    with pytest.raises(HttpError):
+        policy(clock, max_elapsed=120).call(func)
+    assert clock.sleeps == []
+
+
+def test_call_waits_for_retry_after():
+    clock = FakeClock()
+    func = failing(HttpError(429, {'Retry-After': "10"}))
+
+    assert policy(clock).call(func) == "ok"
+    assert clock.sleeps == [10]
+
+
+def test_bucket_hands_out_capacity_then_waits_for_refill():
+    clock = FakeClock()
+    bucket = TokenBucket(capacity=15, window=5, clock=clock)
+
+    for n in range(15):
+        bucket.acquire(clock.sleep)
+    assert clock.sleeps == []
+
+    # 3 tokens a second, so the next one is a third of a second away
+    bucket.acquire(clock.sleep)
+    assert sum(clock.sleeps) == pytest.approx(1 / 3.0)
+
+
+def test_bucket_pause_holds_every_caller():
+    clock = FakeClock()
+    bucket = TokenBucket(capacity=15, window=5, clock=clock)
+
+    bucket.pause(8)
+    bucket.pause(2)
+    bucket.acquire(clock.sleep)
+    assert sum(clock.sleeps) == pytest.approx(8)
+
+
+def test_bucket_follows_quota_headers():
+    clock = FakeClock()
+    bucket = TokenBucket(capacity=15, window=5, clock=clock)
+
+    # The server says 2 are left, so the third query waits for a refill
+    bucket.observe({'x-ms-user-quota-remaining': "2", 'x-ms-user-quota-resets-after': "00:00:04"})
+    bucket.acquire(clock.sleep)
+    bucket.acquire(clock.sleep)
+    assert clock.sleeps == []
+    bucket.acquire(clock.sleep)
+    assert sum(clock.sleeps) == pytest.approx(1 / 3.0)
+
+
+def test_bucket_pauses_until_quota_resets():
+    clock = FakeClock()
+    bucket = TokenBucket(capacity=15, window=5, clock=clock)
+
+    bucket.observe({'x-ms-user-quota-remaining': "0", 'x-ms-user-quota-resets-after': "00:00:04"})
+    bucket.acquire(clock.sleep)
+    assert sum(clock.sleeps) == pytest.approx(4)
+
+
+def test_bucket_pauses_for_retry_after():
+    clock = FakeClock()
+    bucket = TokenBucket(capacity=15, window=5, clock=clock)
+
+    bucket.observe({}, retry_after=6)
+    bucket.acquire(clock.sleep)
+    assert sum(clock.sleeps) == pytest.approx(6)
+
+
+def test_quota_headers():
+    assert parse_quota_headers({'x-ms-user-quota-remaining': "7", 'x-ms-user-quota-resets-after': "00:01:02.5"}) == (7, 62.5)
+    assert parse_quota_headers({'x-ms-user-quota-remaining': "7"}) == (7, None)
+    assert parse_quota_headers({}) == (None, None)
+    assert parse_quota_headers({'x-ms-user-quota-remaining': "many"}) == (None, None)
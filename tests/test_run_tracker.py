@@ -0,0 +1,108 @@
+import time
+import json
+import logging
+
+import pytest
+
+from run_tracker import get_run_table, start_run, mark_group_done, get_run_status, extend_deadline
+from conftest import FakeContext, load_handler
+
+
+@pytest.fixture
+def trigger(aws):
+    return load_handler("trigger_sub_actions.py")
+
+
+def test_run_completes_when_every_group_is_done(trigger):
+    run = start_run(get_run_table(), 3, deadline_seconds=600)
+
+    for group_id in range(3):
+        assert trigger.check_run_status({'run_id': run['run_id']}, FakeContext())['run_complete'] is False
+        mark_group_done(get_run_table(), run['run_id'], group_id)
+
+    event = trigger.check_run_status({'run_id': run['run_id']}, FakeContext())
+    assert event['run_complete'] is True
+    assert get_run_status(get_run_table(), run['run_id']) == {'run_id': run['run_id'], 'complete': True, 'timed_out': False,
+                                                             'expected_groups': 3, 'completed_groups': 3}
+
+
+def test_marking_a_group_done_twice_counts_once(aws):
+    run = start_run(get_run_table(), 2, deadline_seconds=600)
+
+    # A redelivered message finishes the same group again
+    mark_group_done(get_run_table(), run['run_id'], "0")
+    mark_group_done(get_run_table(), run['run_id'], 0)
+
+    status = get_run_status(get_run_table(), run['run_id'])
+    assert status['completed_groups'] == 1
+    assert status['complete'] is False
+
+
+def test_deadline_completes_the_run_with_a_warning(trigger, monkeypatch, caplog):
+    run = start_run(get_run_table(), 2, deadline_seconds=600)
+    mark_group_done(get_run_table(), run['run_id'], 0)
+
+    assert get_run_status(get_run_table(), run['run_id'], now=run['deadline'] - 1)['complete'] is False
+
+    later = time.time() + 601
+    monkeypatch.setattr(time, "time", lambda: later)
+    with caplog.at_level(logging.WARNING):
+        event = trigger.check_run_status({'run_id': run['run_id']}, FakeContext())
+
+    assert event['run_complete'] is True
+    assert get_run_status(get_run_table(), run['run_id'])['timed_out'] is True
+    assert "passed its deadline with 1 subscription group(s) outstanding" in caplog.text
+
+
+def test_missing_run(trigger, caplog):
+    # Nothing to wait for, so the report is not held up
+    assert trigger.check_run_status({'run_id': "no-such-run"}, FakeContext())['run_complete'] is True
+
+    # Marking a group of it done is logged rather than creating a record
+    with caplog.at_level(logging.ERROR):
+        mark_group_done(get_run_table(), "no-such-run", 0)
+    assert "Run no-such-run not found" in caplog.text
+    assert 'Item' not in get_run_table().get_item(Key={'run_id': "no-such-run"})
+
+
+def test_continuations_push_the_deadline_out(aws, monkeypatch):
+    fake_estate, counter = aws
+    monkeypatch.setenv('COLLECTOR_TYPES', "Azure::Compute::VM")
+    monkeypatch.setenv('LAMBDA_TIMEOUT', "900")
+    monkeypatch.setenv('RUN_DEADLINE_MARGIN_SECONDS', "300")
+    monkeypatch.setenv('GRAPH_QUERY_PAGE_SIZE', "4")
+    run = start_run(get_run_table(), 1, deadline_seconds=1200)
+    inventory_vm = load_handler("inventory-vm.py")
+
+    sent = []
+    monkeypatch.setattr(inventory_vm, "send_to_queue", lambda messages, queue_url: sent.extend(m for delay, m in messages))
+
+    # Each invocation only has time for one page, and each one starts after the last one's deadline would have passed
+    now = [time.time()]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    message = {'subscription_id': fake_estate.tenants["tenant0"]['subscriptions'], 'run_id': run['run_id'], 'group_id': 0}
+    while message:
+        inventory_vm.lambda_handler({'Records': [{'body': json.dumps(message)}]}, FakeContext(remaining_millis=1000))
+        status = get_run_status(get_run_table(), run['run_id'])
+        if sent:
+            assert status['complete'] is False
+            now[0] += 1199
+        message = sent.pop() if sent else None
+
+    assert status['complete'] is True
+    assert status['timed_out'] is False
+    assert now[0] > run['deadline']
+
+
+def test_extending_never_brings_the_deadline_forward(aws):
+    run = start_run(get_run_table(), 1, deadline_seconds=5000)
+
+    extend_deadline(get_run_table(), run['run_id'], now=run['started'])
+    assert get_run_table().get_item(Key={'run_id': run['run_id']})['Item']['deadline'] == run['deadline']
+
+    extend_deadline(get_run_table(), run['run_id'], now=run['started'] + 4000)
+    assert get_run_table().get_item(Key={'run_id': run['run_id']})['Item']['deadline'] == run['started'] + 4000 + 1200
+
+    # Nothing is created for a run that does not exist
+    extend_deadline(get_run_table(), "no-such-run")
+    assert 'Item' not in get_run_table().get_item(Key={'run_id': "no-such-run"})
@@ -0,0 +1,154 @@
+import json
+import datetime
+from enum import Enum
+from decimal import Decimal
+
+import pytest
+from msrest.serialization import Model
+
+import serialization
+from serialization import json_default, dumps, dumps_bytes, canonical_dumps, to_json_native, to_dynamodb
+
+
+class State(Enum):
+    ENABLED = "Enabled"
+    DISABLED = "Disabled"
+
+
+class Policies(Model):
+    _attribute_map = {
+        'location_placement_id': {'key': 'locationPlacementId', 'type': 'str'},
+        'spending_limit': {'key': 'spendingLimit', 'type': 'str'},
+    }
+
+    def __init__(self, **kwargs):
+        super(Policies, self).__init__(**kwargs)
+        self.location_placement_id = kwargs.get('location_placement_id')
+        self.spending_limit = kwargs.get('spending_limit')
+
+
+class Subscription(Model):
+    _attribute_map = {
+        'additional_properties': {'key': '', 'type': '{object}'},
+        'subscription_id': {'key': 'subscriptionId', 'type': 'str'},
+        'state': {'key': 'state', 'type': 'str'},
+        'policies': {'key': 'subscriptionPolicies', 'type': 'Policies'},
+    }
+
+    def __init__(self, **kwargs):
+        super(Subscription, self).__init__(**kwargs)
+        self.additional_properties = kwargs.get('additional_properties')
+        self.subscription_id = kwargs.get('subscription_id')
+        self.state = kwargs.get('state')
+        self.policies = kwargs.get('policies')
+
+
+def subscription_model():
+    return Subscription(subscription_id="1234", state=State.ENABLED, additional_properties={'tags': {'env': "prod"}},
+                        policies=Policies(location_placement_id="Public_2014-09-01"))
+
+
+DOCUMENT = {
+    'name': "vm1",
+    'created': datetime.datetime(2020, 1, 2, 3, 4, 5),
+    'day': datetime.date(2020, 1, 2),
+    'state': State.DISABLED,
+    'cost': Decimal("12.5"),
+    'count': Decimal("3"),
+    'regions': {"eastus"},
+    'pair': (1, 2),
+    'empty': "",
+    'owner': "José Müller",
+    'nested': [{'ratio': 0.25, 'flag': True, 'missing': None}],
+}
+
+
+def test_msrest_models_use_the_attribute_map():
+    # Unset attributes are left out and additional_properties are merged in, as Model.as_dict() does
+    assert json.loads(dumps(subscription_model())) == {
+        'subscription_id': "1234",
+        'state': "Enabled",
+        'policies': {'location_placement_id': "Public_2014-09-01"},
+        'tags': {'env': "prod"},
+    }
+
+
+def test_values_the_encoders_cannot_handle():
+    assert json_default(State.ENABLED) == "Enabled"
+    assert json_default(datetime.datetime(2020, 1, 2, 3, 4, 5)) == "2020-01-02T03:04:05"
+    assert json_default(datetime.date(2020, 1, 2)) == "2020-01-02"
+    assert json_default(datetime.time(3, 4)) == "03:04:00"
+    assert json_default(Decimal("3")) == 3 and type(json_default(Decimal("3"))) is int
+    assert json_default(Decimal("12.5")) == 12.5
+    assert json_default(frozenset(["a"])) == ["a"]
+    assert json_default(object).startswith("<class")
+
+    assert to_json_native(DOCUMENT) == {
+        'name': "vm1",
+        'created': "2020-01-02T03:04:05",
+        'day': "2020-01-02",
+        'state': "Disabled",
+        'cost': 12.5,
+        'count': 3,
+        'regions': ["eastus"],
+        'pair': [1, 2],
+        'empty': "",
+        'owner': "José Müller",
+        'nested': [{'ratio': 0.25, 'flag': True, 'missing': None}],
+    }
+
+
+def test_to_dynamodb_uses_decimals():
+    item = to_dynamodb({'count': 3, 'ratio': 0.1, 'cost': Decimal("12.50"), 'flag': False, 'created': datetime.date(2020, 1, 2),
+                        'bad': float("nan"), 'huge': float("inf"), 'model': subscription_model()})
+
+    # Floats go through repr() so 0.1 is stored as 0.1, not the binary expansion Decimal(0.1) would give
+    assert item['ratio'] == Decimal("0.1")
+    assert item['count'] == Decimal(3) and type(item['count']) is Decimal
+    assert item['cost'] == Decimal("12.50")
+    assert item['flag'] is False
+    assert item['created'] == "2020-01-02"
+    assert item['bad'] == "nan" and item['huge'] == "inf"
+    assert item['model']['state'] == "Enabled"
+    assert item['model']['tags'] == {'env': "prod"}
+
+
+def test_to_dynamodb_keeps_empty_values():
+    # DynamoDB accepts empty strings, lists and maps outside of keys, so they are kept rather than dropped
+    assert to_dynamodb({'display_name': "", 'tags': {}, 'regions': [], 'missing': None}) == {'display_name': "", 'tags': {}, 'regions': [], 'missing': None}
+    assert to_dynamodb("") == ""
+    assert to_dynamodb({1: ""}) == {"1": ""}
+
+
+@pytest.mark.parametrize("options", [{}, {'sort_keys': True}, {'indent': 2}, {'indent': 2, 'sort_keys': True}, {'indent': 4}])
+def test_orjson_and_json_agree(monkeypatch, options):
+    pytest.importorskip("orjson")
+    document = dict(DOCUMENT, model=subscription_model(), big=2 ** 70)
+
+    with_orjson = dumps_bytes(document, **options)
+    monkeypatch.setattr(serialization, "orjson", None)
+    without_orjson = dumps_bytes(document, **options)
+
+    assert json.loads(with_orjson) == json.loads(without_orjson)
+    if 'indent' not in options:
+        assert with_orjson == without_orjson
+
+
+def test_stdlib_fallback_without_orjson(monkeypatch):
+    monkeypatch.setattr(serialization, "orjson", None)
+
+    assert dumps({'b': 1, 'a': [State.ENABLED]}) == '{"b":1,"a":["Enabled"]}'
+    assert dumps({'b': 1, 'a': 2}, sort_keys=True) == '{"a":2,"b":1}'
+    assert dumps({'a': 1}, indent=2) == '{\n  "a": 1\n}'
+    assert dumps_bytes({'name': "café"}) == '{"name":"café"}'.encode('utf-8')
+
+
+def test_canonical_dumps_does_not_depend_on_orjson(monkeypatch):
+    document = dict(DOCUMENT, model=subscription_model())
+    canonical = canonical_dumps(document)
+
+    monkeypatch.setattr(serialization, "orjson", None)
+    assert canonical_dumps(document) == canonical
+    assert json.loads(canonical) == json.loads(dumps(document, sort_keys=True))
+    # Non-ASCII characters are escaped, as they were when the manifests' content hashes were first saved
+    assert '"owner":"Jos\\u00e9 M\\u00fcller"' in canonical
@@ -0,0 +1,56 @@
+from botocore.exceptions import ClientError
+
+from conftest import load_handler
+
+
+class StubSNS(object):
+    """Fails the entries whose Id is in fail_ids on the call numbered fail_call, or raises when error is set"""
+    def __init__(self, fail_call=None, fail_ids=(), error=False):
+        self.fail_call = fail_call
+        self.fail_ids = fail_ids
+        self.error = error
+        self.calls = []
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.calls.append([e['Id'] for e in PublishBatchRequestEntries])
+        if self.error:
+            raise ClientError({'Error': {'Code': "InternalError", 'Message': "Internal Error"}}, "PublishBatch")
+        failed = self.fail_ids if len(self.calls) == self.fail_call else ()
+        return {
+            'Successful': [{'Id': e['Id']} for e in PublishBatchRequestEntries if e['Id'] not in failed],
+            'Failed': [{'Id': n, 'Code': "InternalError", 'SenderFault': False} for n in failed],
+        }
+
+
+def records(count):
+    return [("{:04d}".format(n), {'subscription_id': "sub{}".format(n)}) for n in range(count)]
+
+
+def send(monkeypatch, sns, count):
+    sub_handler = load_handler("sub_handler.py")
+    monkeypatch.setattr(sub_handler, "_sns_client", sns)
+    return sub_handler.send_messages(records(count), "arn:aws:sns:us-east-1:123456789012:test")
+
+
+def test_batches_of_ten(monkeypatch):
+    sns = StubSNS()
+    assert send(monkeypatch, sns, 25) == []
+    assert [len(ids) for ids in sns.calls] == [10, 10, 5]
+
+
+def test_everything_from_the_first_failed_entry_is_retried(monkeypatch):
+    # Entries 3 and 7 of the second batch fail, the stream retries from record 13
+    sns = StubSNS(fail_call=2, fail_ids=("3", "7"))
+    failed = send(monkeypatch, sns, 25)
+
+    assert failed == ["{:04d}".format(n) for n in range(13, 25)]
+    # The third batch is not sent at all
+    assert len(sns.calls) == 2
+
+
+def test_a_failed_call_fails_the_batch_and_the_rest(monkeypatch):
+    sns = StubSNS(error=True)
+    failed = send(monkeypatch, sns, 15)
+
+    assert failed == ["{:04d}".format(n) for n in range(15)]
+    assert len(sns.calls) == 1
@@ -0,0 +1,80 @@
+import os
+import json
+import importlib
+
+import boto3
+
+from fakes import FakeSubscriptionClient
+from conftest import FakeContext, load_handler
+
+
+def test_failing_tenant_is_skipped_and_order_is_stable(aws, monkeypatch):
+    fake_estate, counter = aws
+    broken_tenant_id = fake_estate.tenants["tenant0"]['tenant_id']
+
+    class BrokenTenantSubscriptionClient(FakeSubscriptionClient):
+        def list(self):
+            if self.credentials.tenant == broken_tenant_id:
+                raise Exception("AADSTS7000215: Invalid client secret")
+            return super(BrokenTenantSubscriptionClient, self).list()
+    monkeypatch.setattr(importlib.import_module("azure.mgmt.subscription"), "SubscriptionClient", BrokenTenantSubscriptionClient)
+    error_queue = boto3.client('sqs').create_queue(QueueName="test-errors")['QueueUrl']
+    monkeypatch.setenv('ERROR_QUEUE', error_queue)
+
+    inventory_subs = load_handler("inventory-subs.py")
+    event = inventory_subs.handler({}, FakeContext())
+
+    # tenant1's subscriptions in the order the tenant listed them, and the tenant0 failure reported rather than raised
+    assert event['subscription_list'] == fake_estate.tenants["tenant1"]['subscriptions']
+    errors = boto3.client('sqs').receive_message(QueueUrl=error_queue, MaxNumberOfMessages=10).get('Messages', [])
+    assert len(errors) == 1
+    assert "tenant0" in errors[0]['Body']
+
+
+def test_tenants_merge_in_name_order(aws, monkeypatch):
+    fake_estate, counter = aws
+    subscriptions = [s for name in sorted(fake_estate.tenants) for s in fake_estate.tenants[name]['subscriptions']]
+
+    for threads in ("1", "8"):
+        monkeypatch.setenv('TENANT_DISCOVERY_THREADS', threads)
+        event = load_handler("inventory-subs.py").handler({}, FakeContext())
+        assert event['subscription_list'] == subscriptions
+
+
+def test_unchanged_subscriptions_are_not_written(aws, monkeypatch):
+    fake_estate, counter = aws
+    update_items = []
+
+    def count_update(params, **kwargs):
+        update_items.append(params)
+    boto3.DEFAULT_SESSION.events.register('before-call.dynamodb.UpdateItem', count_update)
+    try:
+        inventory_subs = load_handler("inventory-subs.py")
+        # The table's records have no SubscriptionClass yet, so the first run writes every subscription
+        inventory_subs.handler({}, FakeContext())
+        assert len(update_items) == 6
+
+        # Nothing changed in Azure, so nothing is written and the stream stays quiet
+        del update_items[:]
+        inventory_subs.handler({}, FakeContext())
+        assert update_items == []
+
+        # One subscription is disabled
+        disabled = fake_estate.tenants["tenant1"]['subscriptions'][0]
+
+        class DisablingSubscriptionClient(FakeSubscriptionClient):
+            def list(self):
+                for subscription in super(DisablingSubscriptionClient, self).list():
+                    if subscription.subscription_id == disabled:
+                        subscription.state = "Disabled"
+                    yield subscription
+        monkeypatch.setattr(importlib.import_module("azure.mgmt.subscription"), "SubscriptionClient", DisablingSubscriptionClient)
+
+        del update_items[:]
+        inventory_subs.handler({}, FakeContext())
+        assert [json.loads(params['body'])['Key']['subscription_id'] for params in update_items] == [{'S': disabled}]
+    finally:
+        boto3.DEFAULT_SESSION.events.unregister('before-call.dynamodb.UpdateItem', count_update)
+
+    record = boto3.resource('dynamodb').Table(os.environ['SUBSCRIPTION_TABLE']).get_item(Key={'subscription_id': disabled})['Item']
+    assert record['subscription_state'] == "Disabled"
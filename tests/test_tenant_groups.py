@@ -0,0 +1,158 @@
+import os
+import json
+
+import boto3
+
+import subscription
+from common import split_rows_by_subscription
+from collectors import run_collectors, COLLECTORS
+from fakes import FakeResourceGraphClient, estate_subscriptions
+from conftest import FakeContext, load_handler
+
+
+class RecordingGraphClient(FakeResourceGraphClient):
+    """Keeps the subscriptions each resource query (not the network interface joins) was sent for"""
+    def __init__(self, *args, **kwargs):
+        super(RecordingGraphClient, self).__init__(*args, **kwargs)
+        self.resource_queries = []
+
+    def resources(self, query, raw=False):
+        if "mvexpand" not in query.query:
+            self.resource_queries.append(list(query.subscriptions))
+        return super(RecordingGraphClient, self).resources(query, raw)
+
+
+class ListWriter(object):
+    """Keeps what would have been saved to S3"""
+    def __init__(self):
+        self.written = []
+
+    def write(self, prefix, resource_id, resource):
+        self.written.append((prefix, resource_id, resource))
+
+    def flush(self):
+        return []
+
+    def close(self):
+        return []
+
+
+def test_split_rows_by_subscription():
+    rows = [
+        {'id': "vm1", 'subscriptionId': "AAAA-1"},
+        {'id': "vm2", 'subscriptionId': "bbbb-2"},
+        {'id': "vm3", 'subscriptionId': "aaaa-1"},
+    ]
+    split = split_rows_by_subscription(rows)
+
+    # Keyed by the lower cased id, with rows from either case together and in their original order
+    assert list(split) == ["aaaa-1", "bbbb-2"]
+    assert [r['id'] for r in split["aaaa-1"]] == ["vm1", "vm3"]
+    assert [r['id'] for r in split["bbbb-2"]] == ["vm2"]
+    assert split_rows_by_subscription([]) == {}
+
+
+def test_one_query_covers_a_tenant_group(estate):
+    fake_estate, counter = estate
+    tenant = fake_estate.tenants["tenant0"]
+    target_subs = [s for s in estate_subscriptions(fake_estate) if s.tenant_id == tenant['tenant_id']]
+    client = RecordingGraphClient()
+    writer = ListWriter()
+
+    result = run_collectors(target_subs, client, writer, collectors=[COLLECTORS["microsoft.compute/virtualmachines"]])
+
+    assert client.resource_queries == [tenant['subscriptions']]
+    assert result.complete
+    assert result.resource_counts == {sub_id.lower(): 5 for sub_id in tenant['subscriptions']}
+
+    # Every resource is saved under the subscription it came from
+    assert len(writer.written) == 15
+    for prefix, resource_id, resource in writer.written:
+        assert resource['configuration']['subscriptionId'] == resource['azureSubscriptionId']
+
+
+def test_inventory_vm_queries_once_per_tenant(aws, monkeypatch):
+    fake_estate, counter = aws
+    monkeypatch.setenv('COLLECTOR_TYPES', "Azure::Compute::VM")
+    inventory_vm = load_handler("inventory-vm.py")
+    subscription_ids = [s for t in fake_estate.tenants.values() for s in t['subscriptions']]
+    counter.reset()
+
+    inventory_vm.lambda_handler({'Records': [{'body': json.dumps({'subscription_id': subscription_ids})}]}, FakeContext())
+
+    calls = counter.reset()
+    assert calls['resourcegraph.query'] == 2
+    assert calls['aad.token'] == 2
+
+    objects = boto3.client('s3').list_objects_v2(Bucket="benchmark-inventory", Prefix="Azure-Resources/vm/instance/")
+    assert objects['KeyCount'] == 30
+
+
+def test_resource_count_is_only_written_when_it_changes(aws, monkeypatch):
+    fake_estate, counter = aws
+    monkeypatch.setenv('COLLECTOR_TYPES', "Azure::Compute::VM")
+    subscription_ids = [s for t in fake_estate.tenants.values() for s in t['subscriptions']]
+    event = {'Records': [{'body': json.dumps({'subscription_id': subscription_ids})}]}
+
+    updates = []
+    update_attribute = subscription.AntiopeAzureSubscription.update_attribute
+
+    def recording_update(self, table_name, key, value):
+        updates.append((self.subscription_id, key))
+        return update_attribute(self, table_name, key, value)
+    monkeypatch.setattr(subscription.AntiopeAzureSubscription, "update_attribute", recording_update)
+    inventory_vm = load_handler("inventory-vm.py")
+
+    inventory_vm.lambda_handler(event, FakeContext())
+    assert sorted(updates) == [(sub_id, "resource_count") for sub_id in sorted(subscription_ids)]
+
+    # Nothing changed, so nothing is written
+    del updates[:]
+    inventory_vm.lambda_handler(event, FakeContext())
+    assert updates == []
+
+    # One subscription lost a virtual machine
+    fake_estate.vm_rows(subscription_ids[0]).pop()
+    inventory_vm.lambda_handler(event, FakeContext())
+    assert updates == [(subscription_ids[0], "resource_count")]
+
+    record = boto3.resource('dynamodb').Table(os.environ['SUBSCRIPTION_TABLE']).get_item(Key={'subscription_id': subscription_ids[0]})['Item']
+    assert record['resource_count'] == 4
+
+
+def test_continuations_finish_the_counts_and_deletions(aws, monkeypatch):
+    fake_estate, counter = aws
+    monkeypatch.setenv('COLLECTOR_TYPES', "Azure::Compute::VM")
+    monkeypatch.setenv('INCREMENTAL_INVENTORY', "True")
+    tenant = fake_estate.tenants["tenant0"]
+    subscription_ids = tenant['subscriptions']
+    inventory_vm = load_handler("inventory-vm.py")
+
+    sent = []
+    monkeypatch.setattr(inventory_vm, "send_to_queue", lambda messages, queue_url: sent.extend(m for delay, m in messages))
+
+    # A first, uninterrupted run fills in the manifests and counts
+    inventory_vm.lambda_handler({'Records': [{'body': json.dumps({'subscription_id': subscription_ids})}]}, FakeContext())
+    assert sent == []
+
+    # A virtual machine is deleted, then the next run only has time for one page of 4 rows per invocation
+    deleted = fake_estate.vm_rows(subscription_ids[0]).pop()
+    monkeypatch.setenv('GRAPH_QUERY_PAGE_SIZE', "4")
+    message = {'subscription_id': subscription_ids}
+    invocations = 0
+    while message:
+        inventory_vm.lambda_handler({'Records': [{'body': json.dumps(message)}]}, FakeContext(remaining_millis=1000))
+        invocations += 1
+        message = sent.pop() if sent else None
+    assert invocations == 4
+
+    table = boto3.resource('dynamodb').Table(os.environ['SUBSCRIPTION_TABLE'])
+    counts = {sub_id: table.get_item(Key={'subscription_id': sub_id})['Item']['resource_count'] for sub_id in subscription_ids}
+    assert counts == {subscription_ids[0]: 4, subscription_ids[1]: 5, subscription_ids[2]: 5}
+
+    # The last invocation knew every page had been read, so it wrote the delete marker
+    s3_client = boto3.client('s3')
+    objects = s3_client.list_objects_v2(Bucket="benchmark-inventory", Prefix="Azure-Resources/vm/instance/")['Contents']
+    markers = [json.loads(s3_client.get_object(Bucket="benchmark-inventory", Key=o['Key'])['Body'].read()) for o in objects]
+    markers = [m for m in markers if m.get('configurationItemStatus') == "ResourceDeleted"]
+    assert [m['azureResourceId'] for m in markers] == [deleted['id'].lower()]